@@ -0,0 +1,669 @@
+import asyncio
+import os
+import time
+from http.cookies import SimpleCookie
+from pathlib import Path
+
+import requests
+from loguru import logger
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from tqdm import tqdm
+
+try:
+    import aiohttp
+except ImportError:  # optional, see the "async" extra in pyproject.toml
+    aiohttp = None
+try:
+    from aiohttp_socks import ProxyConnector
+    from python_socks import ProxyError
+except ImportError:
+    ProxyConnector = None
+    ProxyError = OSError
+
+from diskio import fsync_path
+from extract import episode_links, video_sources
+from integrity import BlockHasher, IntegrityError, is_mp4_start
+from main import MAX_INTEGRITY_ATTEMPTS, THROTTLING_STATUSES, AnimeDownloader
+from metrics import host_of
+from ratelimit import backoff_delay, retry_after
+from segments import MAX_FAILOVERS, STATE_SAVE_INTERVAL, RangeNotSupported
+
+# Errors of a request that are worth retrying (possibly through another proxy)
+TRANSPORT_ERRORS = (
+    (aiohttp.ClientError, asyncio.TimeoutError, OSError, ProxyError)
+    if aiohttp is not None
+    else (OSError,)
+)
+
+
+class AsyncAnimeDownloader(AnimeDownloader):
+    """AnimeDownloader that runs its downloads on asyncio and aiohttp
+
+    Episode pages, HEAD requests and video transfers are coroutines sharing a
+    connection pool per route (direct, or one per proxy of proxies.txt), so
+    keep-alive connections to the site and the CDN are reused across episodes
+    and a single thread can keep hundreds of page requests in flight. The
+    proxy pool, page cache, rate limits, resume state and verification are the
+    ones of AnimeDownloader; its synchronous methods keep working as well.
+    """
+
+    def __init__(self, *args, connections=100, connections_per_host=16, **kwargs):
+        if aiohttp is None:
+            raise RuntimeError(
+                "The async engine needs aiohttp: pip install 'jutsu-anime-downloader[async]'"
+            )
+        super().__init__(*args, **kwargs)
+        if self.proxies and ProxyConnector is None:
+            raise RuntimeError(
+                "Proxies with the async engine need aiohttp-socks: "
+                "pip install 'jutsu-anime-downloader[async]'"
+            )
+        # Connection limits of every route, in total and per host
+        self.connections = max(1, connections)
+        self.connections_per_host = max(1, connections_per_host)
+        self._sessions = {}
+
+    def _session(self, proxy):
+        """The aiohttp session of a route, created in the running event loop"""
+        key = proxy.url if proxy is not None else None
+        session = self._sessions.get(key)
+        if session is None:
+            options = {
+                "limit": self.connections,
+                "limit_per_host": self.connections_per_host,
+                "keepalive_timeout": 60,
+                "ttl_dns_cache": 300,
+            }
+            if key is None:
+                connector = aiohttp.TCPConnector(**options)
+            else:
+                connector = ProxyConnector.from_url(key, **options)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                cookie_jar=self._cookie_jar(),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout, sock_read=self.timeout
+                ),
+            )
+            self._sessions[key] = session
+        return session
+
+    def _cookie_jar(self):
+        """Copy the cookies loaded from cookies.txt into an aiohttp cookie jar"""
+        jar = aiohttp.CookieJar()
+        for cookie in self.session.cookies:
+            morsel = SimpleCookie()
+            morsel[cookie.name] = cookie.value
+            morsel[cookie.name]["domain"] = cookie.domain
+            morsel[cookie.name]["path"] = cookie.path
+            jar.update_cookies(morsel)
+        return jar
+
+    async def aclose(self):
+        """Close the connections of every route"""
+        sessions = list(self._sessions.values())
+        self._sessions = {}
+        for session in sessions:
+            await session.close()
+
+    async def _asend(self, url, method="GET", headers=None, stream=False, avoid=None):
+        """Send a request with the retries of `safe_request`; returns (response, proxy)
+
+        The body of a page is read before returning; a stream has to be read
+        (and released) by the caller. `avoid` is a proxy not to send it through.
+        """
+        phase = "head" if method == "HEAD" else "ttfb" if stream else "page"
+        host = host_of(url)
+        previous_proxy = None
+        proxy_switches = 0
+        max_retries = 3
+        for attempt in range(max_retries):
+            if self.page_limiter is not None and not stream:
+                await asyncio.sleep(self.page_limiter.reserve(url))
+            if self.proxy_pool is not None and not self.proxy_pool.wait_ready(0):
+                # The proxies are still being checked; wait without blocking the loop
+                await asyncio.to_thread(self.proxy_pool.wait_ready)
+            proxy = (
+                self.proxy_pool.acquire(exclude=avoid)
+                if self.proxy_pool is not None
+                else None
+            )
+            if attempt and proxy is not previous_proxy:
+                proxy_switches += 1
+            previous_proxy = proxy
+            started = time.perf_counter()
+            try:
+                response = await self._session(proxy).request(method, url, headers=headers)
+                if not stream:
+                    await response.read()
+                elapsed = time.perf_counter() - started
+                if self.proxy_pool is not None:
+                    self.proxy_pool.record_success(proxy, elapsed)
+                self.metrics.observe("seconds", elapsed, phase, host)
+            except TRANSPORT_ERRORS as e:
+                logger.error(
+                    f"Request error ({attempt + 1}/{max_retries}): {type(e).__name__} {e}"
+                )
+                self.metrics.increment("errors", phase, host)
+                if self.proxy_pool is not None:
+                    self.proxy_pool.record_failure(proxy)
+                if self.concurrency is not None:
+                    self.concurrency.on_error()
+                if attempt == max_retries - 1:
+                    self.metrics.observe("retries", attempt, phase, host)
+                    self.metrics.observe("proxy_switches", proxy_switches, phase, host)
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            finally:
+                if self.proxy_pool is not None:
+                    self.proxy_pool.release(proxy)
+
+            if response.status in THROTTLING_STATUSES:
+                self.metrics.increment("throttled", phase, host)
+                if self.concurrency is not None:
+                    self.concurrency.on_error()
+                if attempt < max_retries - 1:
+                    delay = retry_after(response.headers) or backoff_delay(attempt)
+                    logger.error(
+                        f"Server answered {response.status} "
+                        f"({attempt + 1}/{max_retries}), retrying in {delay:.1f}s"
+                    )
+                    response.release()
+                    await asyncio.sleep(delay)
+                    continue
+            break
+
+        self.metrics.observe("retries", attempt, phase, host)
+        self.metrics.observe("proxy_switches", proxy_switches, phase, host)
+        return response, proxy
+
+    async def asafe_request(self, url, headers=None, method="GET"):
+        """Async counterpart of `safe_request` for pages
+
+        Returns a requests.Response holding the body, so pages go through the
+        same page cache and parsers as with the threaded engine.
+        """
+        cached = None
+        cacheable = self.page_cache is not None and method == "GET" and not headers
+        if cacheable:
+            # SQLite calls would block the event loop and every transfer on it
+            cached, hit, headers = await asyncio.to_thread(self._cache_lookup, url, headers)
+            if hit is not None:
+                return hit
+
+        response, proxy = await self._asend(url, method, headers)
+        result = requests.Response()
+        result.status_code = response.status
+        result.url = str(response.url)
+        result.headers = CaseInsensitiveDict(response.headers)
+        result.encoding = get_encoding_from_headers(result.headers)
+        result._content = await response.read()
+        result.proxy = proxy
+        response.release()
+        if cacheable:
+            return await asyncio.to_thread(self._cache_update, url, cached, result)
+        return result
+
+    async def aget_episodes_list(self, url):
+        """Get the list of all anime episodes"""
+        logger.info(f"Getting episode list from {url}...")
+        try:
+            response = await self.asafe_request(url)
+        except TRANSPORT_ERRORS as e:
+            logger.error(f"Error getting episode list: {e}")
+            return []
+        with self.metrics.timer("parse", url):
+            episodes = episode_links(response.content, response.encoding)
+        if not episodes:
+            logger.error("No episodes found or page is unavailable")
+            return []
+        logger.info(f"Found {len(episodes)} episodes")
+        return episodes
+
+    async def aget_available_qualities(self, episode_url):
+        """Get available video qualities"""
+        logger.info(f"Getting available qualities for {episode_url}...")
+        try:
+            response = await self.asafe_request(episode_url)
+        except TRANSPORT_ERRORS as e:
+            logger.error(f"Error getting video qualities: {e}")
+            return []
+        with self.metrics.timer("parse", episode_url):
+            sources = video_sources(response.content, response.encoding)
+        qualities = [source.get("res") for source in sources if source.get("res")]
+        if not qualities:
+            logger.error("No video sources found or page is unavailable")
+        return qualities
+
+    async def aresolve_episode(self, url, quality):
+        """Async counterpart of `resolve_episode`"""
+        with self.metrics.timer("resolve", url):
+            response = await self.asafe_request(url)
+            with self.metrics.timer("parse", url):
+                sources = video_sources(response.content, response.encoding)
+            picked = self._pick_source(sources, quality)
+            if picked is None:
+                return None
+            current_quality, video_source = picked
+
+            video_url = video_source["src"]
+            try:
+                head, _ = await self._asend(video_url, method="HEAD")
+                video_headers = (
+                    CaseInsensitiveDict(head.headers) if head.status == 200 else None
+                )
+                head.release()
+            except TRANSPORT_ERRORS as e:
+                logger.info(f"Could not get video size for {url}: {e}")
+                video_headers = None
+
+        return {
+            "url": url,
+            "quality": current_quality,
+            "video_url": video_url,
+            "video_headers": video_headers,
+        }
+
+    async def adownload_episode(
+        self, url, output_path, quality, episode_num, total_episodes, resolved=None
+    ):
+        """Async counterpart of `download_episode`"""
+        os.makedirs(Path("/".join(output_path.rsplit("/")[:-1])), exist_ok=True)
+
+        if os.path.exists(output_path):
+            logger.info(f"Episode already downloaded: {output_path}")
+            await asyncio.to_thread(self._record_download, url, output_path)
+            return True
+
+        try:
+            if resolved is None:
+                logger.info(
+                    f"Getting information about episode {episode_num}/{total_episodes}..."
+                )
+                resolved = await self.aresolve_episode(url, quality)
+                if resolved is None:
+                    return False
+
+            tqdm.write(
+                f"Downloading [{episode_num}/{total_episodes}]: {output_path} ({resolved['quality']}p)"
+            )
+
+            digest = await self._adownload_video(
+                resolved["video_url"],
+                output_path,
+                episode_num,
+                total_episodes,
+                resolved["video_headers"],
+            )
+            await asyncio.to_thread(
+                self._record_download, url, output_path, resolved["quality"], digest
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error downloading {url}: {type(e).__name__} {e}")
+            await asyncio.to_thread(
+                self._record_download, url, output_path, resolved and resolved["quality"]
+            )
+            return False
+
+    async def _adownload_video(
+        self, video_url, output_path, episode_num, total_episodes, video_headers=None
+    ):
+        """Async counterpart of `_download_video`, with the same .part files
+
+        Reading, hashing and creating the .part file, and the SQLite manifest,
+        run in worker threads so they don't hold up the other transfers on
+        the event loop.
+        """
+        part_path = f"{output_path}.part"
+        state_path = f"{part_path}.json"
+
+        segments = self.segments
+        rejected = 0
+        while True:
+            state = await asyncio.to_thread(self._load_part_state, part_path, state_path)
+            resumed = state is not None
+            opened = None
+            if state is None:
+                if (
+                    video_headers is not None
+                    and video_headers.get("accept-ranges", "").lower() == "bytes"
+                    and int(video_headers.get("content-length", 0))
+                ):
+                    state = self._new_part_state(video_url, video_headers, segments)
+                else:
+                    opened = await self._asend(video_url, stream=True)
+                    state = self._new_part_state(
+                        video_url, CaseInsensitiveDict(opened[0].headers), segments
+                    )
+                video_headers = None
+                await asyncio.to_thread(self._create_part, part_path, state_path, state)
+
+            total_size = state["size"]
+            done = sum(segment["written"] for segment in state["segments"])
+            self._add_total(total_size - done if total_size else 0)
+
+            position = self._acquire_position()
+            try:
+                with tqdm(
+                    total=total_size,
+                    initial=done,
+                    unit="B",
+                    unit_scale=True,
+                    desc=f"Episode {episode_num}/{total_episodes}",
+                    bar_format="{l_bar}{bar:30}{r_bar}",
+                    position=position,
+                    leave=position is None,
+                ) as pbar:
+
+                    def progress(size):
+                        pbar.update(size)
+                        self._update_total(size)
+
+                    try:
+                        await self._afetch_segments(
+                            video_url, part_path, state_path, state, opened, progress
+                        )
+                        digest, hashes = self._verify_part(state)
+                        break
+                    except IntegrityError as e:
+                        rejected += 1
+                        self.metrics.increment(
+                            "integrity_errors", "transfer", host_of(video_url)
+                        )
+                        self._update_total(-(pbar.n - done))
+                        os.remove(part_path)
+                        os.remove(state_path)
+                        if rejected >= MAX_INTEGRITY_ATTEMPTS:
+                            raise
+                        logger.error(f"Rejected {output_path} ({e}), downloading it again")
+                        await asyncio.sleep(backoff_delay(rejected - 1))
+                    except RangeNotSupported as e:
+                        logger.info(f"Cannot resume {output_path} ({e}), starting over")
+                        self._update_total(-(pbar.n - done))
+                        os.remove(part_path)
+                        os.remove(state_path)
+                        if not resumed:
+                            segments = 1
+            finally:
+                self._release_position(position)
+
+        await asyncio.to_thread(
+            self._finish_part, part_path, state_path, output_path, digest, hashes
+        )
+        return digest
+
+    async def _afetch_segments(self, video_url, part_path, state_path, state, opened, progress):
+        """Async counterpart of `_fetch_segments`: one task per unfinished segment
+
+        `opened` is the (response, proxy) of the probe request, used for the
+        first segment. When a segment fails the others are cancelled; their
+        progress is kept in the sidecar.
+        """
+        host = host_of(video_url)
+
+        async def save_state():
+            if self.fsync:
+                # The sidecar must not record bytes that are not on the disk yet
+                await asyncio.to_thread(fsync_path, part_path)
+            self._save_part_state(state_path, state)
+
+        async def open_range(segment, position, avoid=None):
+            """Request the rest of a segment from `position`, not through proxy `avoid`"""
+            range_end = "" if segment["end"] is None else segment["end"]
+            headers = {"Range": f"bytes={position}-{range_end}"}
+            validator = state["etag"] or state["last_modified"]
+            if validator:
+                headers["If-Range"] = validator
+            opened = await self._asend(video_url, headers=headers, stream=True, avoid=avoid)
+            response = opened[0]
+            content_range = response.headers.get("content-range", "")
+            if (
+                response.status != 206
+                or not content_range.startswith(f"bytes {position}-")
+                or (state["size"] and not content_range.endswith(f"/{state['size']}"))
+            ):
+                response.close()
+                raise RangeNotSupported(
+                    f"Unexpected answer to a range request: {response.status}"
+                )
+            return opened
+
+        async def fetch(segment, segment_opened):
+            start = segment["start"] + segment["written"]
+            if segment_opened is None:
+                segment_opened = await open_range(segment, start)
+
+            limit = None if segment["end"] is None else segment["end"] - start + 1
+            # Like in `_fetch_segments`, the shared state only learns what this
+            # segment has flushed to its file
+            hasher = BlockHasher(list(segment["hashes"]))
+            written = 0
+            unsaved = 0
+            failovers = 0
+
+            def publish():
+                segment["written"] = start + written - segment["start"]
+                segment["hashes"] = list(hasher.hashes)
+
+            started = time.monotonic()
+            try:
+                with open(part_path, "r+b", buffering=self.buffer_size) as f:
+                    f.seek(start)
+                    while True:
+                        response, proxy = segment_opened
+                        if self.proxy_pool is not None:
+                            self.proxy_pool.hold(proxy)
+                        route_started = time.monotonic()
+                        route_written = written
+                        error = None
+                        try:
+                            async for chunk in response.content.iter_chunked(self.buffer_size):
+                                if limit is not None and len(chunk) > limit - written:
+                                    chunk = chunk[: limit - written]
+                                if not chunk:
+                                    break
+                                if start + written == 0 and not is_mp4_start(chunk):
+                                    raise IntegrityError(
+                                        f"not an MP4 file, starts with {bytes(chunk[:16])!r}"
+                                    )
+                                if self.bandwidth is not None:
+                                    delay = self.bandwidth.reserve(len(chunk))
+                                    if delay > 0:
+                                        await asyncio.sleep(delay)
+                                f.write(chunk)
+                                hasher.update(chunk)
+                                if self.concurrency is not None:
+                                    self.concurrency.record_bytes(len(chunk))
+                                written += len(chunk)
+                                unsaved += len(chunk)
+                                progress(len(chunk))
+                                if unsaved >= STATE_SAVE_INTERVAL:
+                                    f.flush()
+                                    publish()
+                                    await save_state()
+                                    unsaved = 0
+                                if limit is not None and written >= limit:
+                                    break
+                        except TRANSPORT_ERRORS as e:
+                            error = e
+                            if self.proxy_pool is not None:
+                                self.proxy_pool.record_failure(proxy)
+                            self.metrics.increment("errors", "transfer", host)
+                        finally:
+                            # Returns the connection to the pool once the body was read
+                            # completely, closes it otherwise (e.g. when cancelled)
+                            response.release()
+                            if self.proxy_pool is not None:
+                                self.proxy_pool.release(proxy)
+                                self.proxy_pool.record_transfer(
+                                    proxy, written - route_written, time.monotonic() - route_started
+                                )
+
+                        if error is None and (limit is None or written >= limit):
+                            break
+                        # The connection failed or closed half-way: continue from
+                        # the same byte through another route, like `_fetch_segments`
+                        if error is None:
+                            error = IOError(
+                                f"Connection closed after {start + written} "
+                                f"of {segment['end'] + 1} bytes"
+                            )
+                        failovers += 1
+                        if limit is None or failovers > MAX_FAILOVERS:
+                            raise error
+                        try:
+                            segment_opened = await open_range(
+                                segment, start + written, avoid=proxy
+                            )
+                        except RangeNotSupported:
+                            # Without byte ranges the download can only start over
+                            raise error
+                        self.metrics.increment("failovers", "transfer", host)
+                        if self.proxy_pool is not None:
+                            self.proxy_pool.record_failover(proxy)
+                        logger.info(
+                            f"Transfer of {part_path} failed at {start + written} ({error}), "
+                            "continuing through another route"
+                        )
+            finally:
+                publish()
+                await save_state()
+                elapsed = time.monotonic() - started
+                self.metrics.observe("seconds", elapsed, "transfer", host)
+                self.metrics.increment("bytes", "transfer", host, written)
+                if written and elapsed > 0:
+                    self.metrics.observe(
+                        "bytes_per_second", written / elapsed, "transfer", host
+                    )
+
+            if segment["end"] is None:
+                segment["end"] = segment["start"] + segment["written"] - 1
+            hasher.finish()
+            publish()
+            await save_state()
+
+        pending = [
+            segment
+            for segment in state["segments"]
+            if segment["end"] is None
+            or segment["start"] + segment["written"] <= segment["end"]
+        ]
+        if not pending:
+            # Everything was written before the process stopped, e.g. right
+            # before the rename; the caller verifies and renames the file
+            if opened is not None:
+                opened[0].close()
+            return
+        if opened is not None and pending[0]["start"] != 0:
+            opened[0].close()
+            opened = None
+        if len(pending) > 1:
+            logger.info(f"Downloading {part_path} in {len(pending)} segments")
+        tasks = [
+            asyncio.create_task(fetch(segment, opened if index == 0 else None))
+            for index, segment in enumerate(pending)
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def adownload_anime(
+        self, url, quality, start_season=1, start_episode=1, include_films=False
+    ):
+        """Async counterpart of `download_anime`; returns the failed episodes"""
+        try:
+            episodes = await self.aget_episodes_list(url)
+            if not episodes:
+                logger.error("Failed to get episode list")
+                return []
+            planned = self._plan_from_links(
+                episodes, start_season, start_episode, include_films
+            )
+            print(f"Total episodes found for download: {len(planned)}")
+            if not planned:
+                logger.error("No episodes to download from the specified season and episode")
+                return []
+            return await self._arun_downloads(planned, quality)
+        finally:
+            await self.aclose()
+
+    def _run_downloads(self, planned, quality):
+        """Download the planned episodes on the event loop (see `_arun_downloads`)"""
+        return asyncio.run(self._arun_downloads(planned, quality))
+
+    async def _arun_downloads(self, planned, quality):
+        """Download the planned episodes, `self.jobs` at a time
+
+        Up to `self.lookahead` episodes beyond the running downloads are
+        resolved concurrently, without the thread pool cap of the threaded
+        engine, so a large lookahead keeps that many page requests in flight.
+        """
+        total_episodes = len(planned)
+        failures = []
+        # Episodes being resolved or downloaded; both are taken in episode order
+        ahead = asyncio.Semaphore(self.jobs + self.lookahead)
+        downloads = asyncio.Semaphore(self.jobs)
+
+        async def run(current_episode, episode_data):
+            async with ahead:
+                if await asyncio.to_thread(self._already_downloaded, episode_data):
+                    logger.info(f"Episode already downloaded: {episode_data['output_path']}")
+                    return
+                try:
+                    resolved = await self.aresolve_episode(episode_data["url"], quality)
+                except Exception as e:
+                    # adownload_episode resolves the page again
+                    logger.info(f"Could not resolve {episode_data['url']} ahead of time: {e}")
+                    resolved = None
+                async with downloads:
+                    if self.concurrency is not None:
+                        # The controller blocks, so it waits off the event loop
+                        await asyncio.to_thread(self.concurrency.acquire)
+                    try:
+                        success = await self.adownload_episode(
+                            episode_data["url"],
+                            episode_data["output_path"],
+                            quality,
+                            current_episode,
+                            total_episodes,
+                            resolved=resolved,
+                        )
+                        error = None
+                    except Exception as e:
+                        success = False
+                        error = str(e)
+                    finally:
+                        if self.concurrency is not None:
+                            self.concurrency.release()
+
+            if success:
+                logger.info(
+                    f"Successfully downloaded episode {current_episode}/{total_episodes}"
+                )
+                return
+            logger.error(f"Failed to download episode {current_episode}/{total_episodes}")
+            failures.append({**episode_data, "index": current_episode, "error": error})
+
+        self._start_progress()
+        try:
+            await asyncio.gather(
+                *(
+                    run(current_episode, episode_data)
+                    for current_episode, episode_data in enumerate(planned, start=1)
+                )
+            )
+        finally:
+            self._stop_progress()
+            await self.aclose()
+
+        return self._report_failures(failures, total_episodes)
@@ -0,0 +1,173 @@
+"""Benchmark of the catalog crawler and of lookups in the catalog index
+
+Usage:
+    python benchmarks/bench_catalog.py [--json] [--titles N] [--latency S]
+                                       [--concurrency N ...] [--index-titles N]
+
+"crawl" indexes a catalog of --titles titles served by benchmarks/server.py
+with the page cache and rate limit turned off, once per --concurrency, and
+reports the time and pages per second of each run.
+
+"index" builds a synthetic index of --index-titles titles with a realistic
+spread of seasons and episodes and reports its size on disk (next to the
+same episode lists as JSON), the time to load it, and the median time of an
+exact lookup, a prefix lookup, suggestions for a misspelled name and
+planning every episode of a title, next to planning the same title from its
+series index on the server.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def median_ms(function, repeat=200):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def crawl(server, concurrency):
+    from catalog import crawl_catalog
+    from main import AnimeDownloader
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # The downloader reads cookies.txt and proxies.txt from here
+        os.chdir(directory)
+        downloader = AnimeDownloader(base_url=server.url)
+        before = server.stats()
+        start = time.perf_counter()
+        entries, failed = crawl_catalog(downloader, concurrency=concurrency)
+        seconds = time.perf_counter() - start
+        pages = server.stats()["requests"] - before["requests"]
+        os.chdir(cwd)
+    return {
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "pages": pages,
+        "pages_per_second": pages / seconds,
+        "titles": len(entries),
+        "failed": len(failed),
+    }
+
+
+def synthetic_titles(count, seed=0):
+    """Titles with 1-6 seasons of 12-50 episodes (a few long ones) and some films"""
+    import fixtures
+    from catalog import FILMS, NO_SEASON_PATH, Title
+
+    rng = random.Random(seed)
+    titles = []
+    for name in fixtures.catalog_names(count, seed):
+        if rng.random() < 0.05:
+            runs = [(1 | NO_SEASON_PATH, 1, rng.randint(200, 1100))]
+        else:
+            runs = [(s, 1, rng.randint(12, 50)) for s in range(1, rng.randint(1, 6) + 1)]
+        films = rng.choice((0, 0, 0, 1, 3))
+        if films:
+            runs.append((FILMS, 1, films))
+        titles.append(Title(name, name.replace("-", " ").title(), runs, ("1080", "720")))
+    return titles
+
+
+def index(server, count):
+    from catalog import CatalogIndex
+    from main import AnimeDownloader
+
+    titles = synthetic_titles(count)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalog.idx")
+        CatalogIndex.build(titles).save(path)
+        size = os.path.getsize(path)
+        load_ms = median_ms(lambda: CatalogIndex.load(path), 20)
+        catalog = CatalogIndex.load(path)
+        # What the same data takes as a JSON list of episode links per title
+        as_json = len(
+            json.dumps({title.name: [link["href"] for link in title.links()] for title in titles})
+        )
+
+        os.chdir(directory)
+        downloader = AnimeDownloader(base_url=server.url, page_cache=None)
+        name = titles[len(titles) // 2].name
+        misspelled = name[:3] + name[4:]
+        results = {
+            "titles": len(catalog),
+            "episodes": sum(title.episodes for title in titles),
+            "size_bytes": size,
+            "json_bytes": as_json,
+            "load_ms": load_ms,
+            "get_ms": median_ms(lambda: catalog.get(name)),
+            "prefix_ms": median_ms(lambda: catalog.prefix(name[:4])),
+            "fuzzy_ms": median_ms(lambda: catalog.search(misspelled), 5),
+            "plan_ms": median_ms(
+                lambda: downloader._plan_from_links(catalog.get(name).links(), 1, 1, True), 20
+            ),
+            "page_plan_ms": median_ms(
+                lambda: downloader.plan_episodes(f"{server.url}/{name}/", 1, 1, True), 5
+            ),
+        }
+        os.chdir(cwd)
+    return results
+
+
+def main():
+    from server import StandInServer
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--titles", type=int, default=300, help="titles crawled")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--concurrency", type=int, action="append")
+    parser.add_argument(
+        "--index-titles", type=int, default=20000, help="titles in the synthetic index"
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    server = StandInServer(
+        seasons=2, episodes_per_season=24, films=1, titles=args.titles, latency=args.latency
+    ).start()
+    try:
+        crawls = [crawl(server, concurrency) for concurrency in args.concurrency or (1, 8)]
+        lookups = index(server, args.index_titles)
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps({"crawl": crawls, "index": lookups}, indent=2))
+        return
+
+    print(f"{'concurrency':>12}{'seconds':>9}{'pages':>7}{'pages/s':>9}{'titles':>8}{'failed':>8}")
+    for r in crawls:
+        print(
+            f"{r['concurrency']:>12}{r['seconds']:>9.2f}{r['pages']:>7}"
+            f"{r['pages_per_second']:>9.1f}{r['titles']:>8}{r['failed']:>8}"
+        )
+    r = lookups
+    print(
+        f"index: {r['titles']} titles, {r['episodes']} episodes, "
+        f"{r['size_bytes'] / 1024:.0f} KB ({r['size_bytes'] / r['episodes']:.2f} bytes per "
+        f"episode; {r['json_bytes'] / 1024:.0f} KB as JSON), loaded in {r['load_ms']:.1f} ms"
+    )
+    print(
+        f"lookup ms: exact {r['get_ms']:.4f}, prefix {r['prefix_ms']:.4f}, "
+        f"misspelled {r['fuzzy_ms']:.1f}, plan {r['plan_ms']:.2f} "
+        f"(from the page: {r['page_plan_ms']:.1f})"
+    )
+
+
+if __name__ == "__main__":
+    main()
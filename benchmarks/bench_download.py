@@ -0,0 +1,296 @@
+"""End-to-end benchmark of AnimeDownloader against a local stand-in server
+
+Usage:
+    python benchmarks/bench_download.py [--json] [--output FILE] [--scenario NAME ...]
+                                        [--engine threads|async] [--jobs N]
+                                        [--segments N] [--lookahead N] [--episodes N]
+                                        [--video-size SIZE] [--latency S]
+                                        [--bandwidth RATE] [--no-ranges]
+                                        [--failure-rate F] [--drop-rate F]
+                                        [--trickle-rate F] [--stall-rate RATE]
+                                        [--stall-window S]
+
+Starts benchmarks/server.py in the background and runs every scenario in a
+fresh interpreter inside an empty directory:
+
+    index      get_episodes_list() on a 3 x 100 episode series
+    qualities  get_available_qualities() on an episode page
+    episode    download_episode() of a single episode
+    anime      download_anime() of the last --episodes episodes of the series
+
+Each scenario reports its wall time, bytes downloaded, throughput, time to
+the first video byte, time spent parsing pages and the peak RSS of the
+process, and how many transfers stalled and were moved to another route
+(see --trickle-rate). With --json (or --output) the results are written as JSON together
+with the commit they were measured on, so runs of different versions can be
+compared. With --engine async the scenarios run the coroutines of
+async_engine.py (aget_episodes_list() etc.) instead.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("index", "qualities", "episode", "anime")
+ANIME = "testanime"
+SEASONS = 3
+EPISODES_PER_SEASON = 100
+
+
+def run_worker(scenario, base_url, config):
+    """Run one scenario in this process and return its measurements"""
+    import extract
+    import main
+
+    parse_seconds = 0.0
+
+    def timed(parse):
+        def wrapper(*args, **kwargs):
+            nonlocal parse_seconds
+            start = time.perf_counter()
+            try:
+                return parse(*args, **kwargs)
+            finally:
+                parse_seconds += time.perf_counter() - start
+
+        return wrapper
+
+    extract.episode_links = timed(extract.episode_links)
+    extract.video_sources = timed(extract.video_sources)
+    base = main.AnimeDownloader
+    if config["engine"] == "async":
+        import async_engine
+
+        async_engine.episode_links = extract.episode_links
+        async_engine.video_sources = extract.video_sources
+        base = async_engine.AsyncAnimeDownloader
+
+    class Downloader(base):
+        """Notes when the first video byte arrives and how many follow"""
+
+        first_byte = None
+        received = 0
+        _received_lock = threading.Lock()
+
+        def _update_total(self, size):
+            with self._received_lock:
+                if self.first_byte is None and size > 0:
+                    self.first_byte = time.perf_counter()
+                self.received += size
+            super()._update_total(size)
+
+    downloader = Downloader(
+        jobs=config["jobs"],
+        segments=config["segments"],
+        lookahead=config["lookahead"],
+        base_url=base_url,
+        stall_rate=config["stall_rate"],
+        stall_window=config["stall_window"],
+    )
+    series_url = f"{base_url}/{ANIME}/"
+    episode_url = f"{base_url}/{ANIME}/season-1/episode-1.html"
+
+    def call(method, *args):
+        if config["engine"] != "async":
+            return getattr(downloader, method)(*args)
+
+        async def run():
+            try:
+                return await getattr(downloader, f"a{method}")(*args)
+            finally:
+                await downloader.aclose()
+
+        return asyncio.run(run())
+
+    start = time.perf_counter()
+    if scenario == "index":
+        success = len(call("get_episodes_list", series_url)) > 0
+    elif scenario == "qualities":
+        success = len(call("get_available_qualities", episode_url)) > 0
+    elif scenario == "episode":
+        success = call(
+            "download_episode",
+            episode_url,
+            f"{ANIME}/season-1/episode-1.mp4",
+            config["quality"],
+            1,
+            1,
+        )
+    else:
+        first = EPISODES_PER_SEASON - config["episodes"] + 1
+        failures = call("download_anime", series_url, config["quality"], SEASONS, max(1, first))
+        success = not failures
+    seconds = time.perf_counter() - start
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    transfer = downloader.metrics.summary()["phases"].get("transfer", {})
+    return {
+        "scenario": scenario,
+        "success": bool(success),
+        "seconds": seconds,
+        "bytes": downloader.received,
+        "throughput_mb_s": downloader.received / seconds / 1024**2,
+        "ttfb_seconds": (
+            downloader.first_byte - start if downloader.first_byte is not None else None
+        ),
+        "parse_seconds": parse_seconds,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": usage.ru_maxrss,
+        "stalls": transfer.get("stalls", 0),
+        "failovers": transfer.get("failovers", 0),
+    }
+
+
+def measure(scenario, base_url, config):
+    with tempfile.TemporaryDirectory() as directory:
+        completed = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--worker",
+                scenario,
+                base_url,
+                json.dumps(config),
+            ],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+        )
+    if completed.returncode != 0:
+        raise SystemExit(f"Scenario {scenario} crashed:\n{completed.stderr}")
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--worker":
+        _, _, scenario, base_url, config = sys.argv
+        print(json.dumps(run_worker(scenario, base_url, json.loads(config))))
+        return
+
+    from ratelimit import parse_rate, parse_size
+    from server import StandInServer
+    from stalls import STALL_RATE, STALL_WINDOW
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--segments", type=int, default=1)
+    parser.add_argument("--lookahead", type=int, default=2)
+    parser.add_argument("--episodes", type=int, default=6, help="episodes of 'anime'")
+    parser.add_argument("--quality", default="720")
+    parser.add_argument("--video-size", type=parse_size, default=32 * 1024 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--bandwidth", type=parse_rate, help="bytes/s per connection")
+    parser.add_argument("--no-ranges", action="store_true")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--trickle-rate", type=float, default=0.0, help="video bodies that slow to a trickle"
+    )
+    parser.add_argument("--stall-rate", type=parse_rate, default=STALL_RATE)
+    parser.add_argument("--stall-window", type=float, default=STALL_WINDOW)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    server = StandInServer(
+        seasons=SEASONS,
+        episodes_per_season=EPISODES_PER_SEASON,
+        video_size=args.video_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        ranges=not args.no_ranges,
+        failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate,
+        trickle_rate=args.trickle_rate,
+    ).start()
+    config = {
+        "engine": args.engine,
+        "jobs": args.jobs,
+        "segments": args.segments,
+        "lookahead": args.lookahead,
+        "episodes": args.episodes,
+        "quality": args.quality,
+        "stall_rate": args.stall_rate,
+        "stall_window": args.stall_window,
+    }
+
+    results = []
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            before = server.stats()
+            result = measure(scenario, server.url, config)
+            after = server.stats()
+            result["requests"] = after["requests"] - before["requests"]
+            result["injected_failures"] = (after["failures"] - before["failures"]) + (
+                after["drops"] - before["drops"]
+            )
+            result["trickles"] = after["trickles"] - before["trickles"]
+            results.append(result)
+    finally:
+        server.stop()
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "config": config,
+        "server": {
+            "video_size": args.video_size,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "ranges": not args.no_ranges,
+            "failure_rate": args.failure_rate,
+            "drop_rate": args.drop_rate,
+            "trickle_rate": args.trickle_rate,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(
+        f"{'scenario':<12}{'ok':>4}{'seconds':>9}{'MB/s':>9}{'TTFB ms':>9}"
+        f"{'parse ms':>10}{'RSS MB':>8}{'requests':>10}{'stalls':>8}{'failovers':>11}"
+    )
+    for r in results:
+        ttfb = f"{r['ttfb_seconds'] * 1000:.0f}" if r["ttfb_seconds"] is not None else "-"
+        print(
+            f"{r['scenario']:<12}{'yes' if r['success'] else 'no':>4}"
+            f"{r['seconds']:>9.2f}{r['throughput_mb_s']:>9.1f}{ttfb:>9}"
+            f"{r['parse_seconds'] * 1000:>10.1f}{r['peak_rss_kb'] / 1024:>8.1f}"
+            f"{r['requests']:>10}{r['stalls']:>8}{r['failovers']:>11}"
+        )
+
+
+if __name__ == "__main__":
+    main()
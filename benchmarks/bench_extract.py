@@ -0,0 +1,170 @@
+"""Micro-benchmark of page parsing: full BeautifulSoup trees vs extract.py
+
+Usage:
+    python benchmarks/bench_extract.py [--json] [--repeat N] [PAGE.html ...]
+
+Without arguments the benchmark runs over synthetic fixture pages (see
+fixtures.py). Saved jut.su pages can be passed instead; files whose name
+starts with "episode" are treated as episode pages, everything else as a
+series index. Each implementation is measured in a fresh interpreter so
+the peak RSS of one does not hide the other.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def bs4_extract(kind, content):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content.decode("utf-8"), "lxml")
+    if kind == "series":
+        elements = soup.find_all("a", {"class": "video"})
+    else:
+        elements = soup.find_all("source")
+    return [
+        {k: " ".join(v) if isinstance(v, list) else v for k, v in el.attrs.items()}
+        for el in elements
+    ]
+
+
+def lxml_extract(kind, content):
+    from extract import episode_links, video_sources
+
+    if kind == "series":
+        return episode_links(content, "utf-8")
+    return video_sources(content, "utf-8")
+
+
+IMPLEMENTATIONS = {"bs4": bs4_extract, "extract": lxml_extract}
+
+
+def run_worker(impl, kind, path, repeat):
+    """Parse one page `repeat` times and report the best time and peak RSS growth"""
+    with open(path, "rb") as f:
+        content = f.read()
+    extract = IMPLEMENTATIONS[impl]
+    # Import the parser modules before taking the baseline
+    extract(kind, b"<html></html>")
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = extract(kind, content)
+        best = min(best, time.perf_counter() - start)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "seconds": best,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": peak - baseline,
+        "elements": len(result),
+        "result": result,
+    }
+
+
+def measure(impl, kind, path, repeat):
+    output = subprocess.run(
+        [sys.executable, __file__, "--worker", impl, kind, path, str(repeat)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def fixture_pages(directory):
+    import fixtures
+
+    pages = {
+        "series-small.html": (
+            "series",
+            fixtures.series_page(seasons=1, episodes_per_season=12, films=0),
+        ),
+        "series-3x100.html": ("series", fixtures.series_page()),
+        "series-1100.html": (
+            "series",
+            fixtures.series_page(seasons=1, episodes_per_season=1100),
+        ),
+        "episode.html": ("episode", fixtures.episode_page("https://video.example")),
+    }
+    paths = []
+    for name, (kind, page) in pages.items():
+        path = os.path.join(directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(page)
+        paths.append((kind, path))
+    return paths
+
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == "--worker":
+        _, _, impl, kind, path, repeat = sys.argv
+        print(json.dumps(run_worker(impl, kind, path, int(repeat))))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pages", nargs="*", help="saved jut.su pages")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.pages:
+            pages = [
+                ("episode" if os.path.basename(p).startswith("episode") else "series", p)
+                for p in args.pages
+            ]
+        else:
+            pages = fixture_pages(directory)
+
+        results = []
+        for kind, path in pages:
+            measured = {
+                impl: measure(impl, kind, path, args.repeat) for impl in IMPLEMENTATIONS
+            }
+            if measured["bs4"]["result"] != measured["extract"]["result"]:
+                raise SystemExit(f"extract.py disagrees with BeautifulSoup on {path}")
+            results.append(
+                {
+                    "page": os.path.basename(path),
+                    "bytes": os.path.getsize(path),
+                    "elements": measured["extract"]["elements"],
+                    **{
+                        f"{impl}_{key}": measured[impl][key]
+                        for impl in IMPLEMENTATIONS
+                        for key in ("seconds", "peak_rss_kb")
+                    },
+                }
+            )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'page':<20}{'elements':>9}{'bs4 ms':>10}{'lxml ms':>10}{'speedup':>9}"
+        f"{'bs4 KB':>10}{'lxml KB':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['page']:<20}{r['elements']:>9}"
+            f"{r['bs4_seconds'] * 1000:>10.2f}{r['extract_seconds'] * 1000:>10.2f}"
+            f"{r['bs4_seconds'] / r['extract_seconds']:>8.1f}x"
+            f"{r['bs4_peak_rss_kb']:>10}{r['extract_peak_rss_kb']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Benchmark of the start-up time of main.py
+
+Usage:
+    python benchmarks/bench_startup.py [--json] [--repeat N] [--top N]
+                                       [--scenario NAME ...]
+
+Every scenario runs in fresh interpreters in an empty directory and reports
+the median wall time, the number of modules imported and the slowest
+top-level imports as measured by `python -X importtime`:
+
+- "help", "status", "duplicates" and "search" are commands that need no
+  network. They must not import any of HEAVY_MODULES; the script exits with
+  status 1 if one of them does, so a new top-level import cannot slip in
+  unnoticed.
+- "downloader" imports main.py and creates an AnimeDownloader with a
+  proxies.txt whose only proxy accepts connections but never answers, like
+  a dead proxy behind a firewall. Checking the proxies must not hold up the
+  start.
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main.py")
+
+# Modules that only commands which talk to the site may load
+HEAVY_MODULES = ("requests", "urllib3", "loguru", "tqdm", "lxml", "bs4", "aiohttp")
+
+SCENARIOS = {
+    "help": ([MAIN, "--help"], False),
+    "status": ([MAIN, "status", "testanime"], False),
+    "duplicates": ([MAIN, "duplicates"], False),
+    "search": ([MAIN, "search", "naruto"], False),
+    # Exits right away, without waiting for the proxy check at shutdown
+    "downloader": (
+        ["-c", f"import os, sys; sys.path.insert(0, {ROOT!r}); import main; "
+         "main.AnimeDownloader(); os._exit(0)"],
+        True,
+    ),
+}
+
+
+def silent_proxy():
+    """A TCP port that accepts connections and never sends a byte"""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+    held = []
+
+    def accept():
+        while True:
+            held.append(listener.accept()[0])
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def parse_importtime(stderr):
+    """Cumulative microseconds of every imported module, and the top-level ones"""
+    modules = {}
+    top = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+        # Nested imports are indented below the module that imported them
+        if not name[1:].startswith(" "):
+            top[name.strip()] = int(cumulative)
+    return modules, top
+
+
+def run(name, directory, repeat, top):
+    command, network = SCENARIOS[name]
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *command],
+            cwd=directory,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    profile = subprocess.run(
+        [sys.executable, "-X", "importtime", *command],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    modules, top_level = parse_importtime(profile.stderr)
+    slowest = sorted(top_level.items(), key=lambda item: -item[1])[:top]
+    return {
+        "scenario": name,
+        "seconds": statistics.median(times),
+        "min_seconds": min(times),
+        "modules": len(modules),
+        "import_ms": sum(top_level.values()) / 1000,
+        "slowest": [{"module": module, "ms": us / 1000} for module, us in slowest],
+        "heavy": [] if network else sorted(
+            {module.split(".")[0] for module in modules} & set(HEAVY_MODULES)
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10, help="runs per scenario")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports to show")
+    parser.add_argument(
+        "--scenario", choices=sorted(SCENARIOS), action="append", help="default: all"
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "proxies.txt"), "w") as f:
+            f.write(f"127.0.0.1:{silent_proxy()}\n")
+        results = [
+            run(name, directory, args.repeat, args.top)
+            for name in args.scenario or SCENARIOS
+        ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'scenario':<12}{'median ms':>11}{'min ms':>9}{'modules':>9}{'imports ms':>12}")
+        for r in results:
+            print(
+                f"{r['scenario']:<12}{r['seconds'] * 1000:>11.1f}"
+                f"{r['min_seconds'] * 1000:>9.1f}{r['modules']:>9}{r['import_ms']:>12.1f}"
+            )
+            slowest = ", ".join(f"{s['module']} {s['ms']:.1f}" for s in r["slowest"])
+            print(f"  slowest imports (ms): {slowest}")
+            if r["heavy"]:
+                print(f"  imports heavy modules: {', '.join(r['heavy'])}")
+
+    if any(r["heavy"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
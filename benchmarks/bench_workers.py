@@ -0,0 +1,168 @@
+"""Benchmark of several batch workers sharing one job queue
+
+Usage:
+    python benchmarks/bench_workers.py [--json] [--workers N ...] [--episodes N]
+                                       [--video-size SIZE] [--bandwidth RATE]
+                                       [--lease S] [--kill-after S]
+
+Starts benchmarks/server.py in the background and, for every worker count,
+runs that many `main.py batch` processes in one empty directory. They share
+jobs.db, downloads.db and the download directory, like hosts that mount the
+same storage. Each run reports its wall time, throughput and speedup over
+the first worker count. It also checks three things: every episode is done,
+every file matches its digest, and the server sent no more video bytes than
+the episodes needed ("sent ratio" 1.00 means nothing was downloaded twice).
+
+With --kill-after one worker is killed (SIGKILL) that many seconds into each
+run with two or more workers. Its episodes are taken over by the others once
+their --lease has run out, continuing its .part files.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ANIME = "testanime"
+
+
+def file_digest(path, block_size):
+    """Digest of a file as computed by integrity.py, from the file itself"""
+    hashes = []
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            hashes.append(hashlib.sha256(block).digest())
+    return hashlib.sha256(b"".join(hashes)).hexdigest()
+
+
+def check(directory, block_size):
+    """Count the finished tasks and the files that do not match their digest"""
+    db = sqlite3.connect(os.path.join(directory, "jobs.db"))
+    rows = db.execute("SELECT output_path, status FROM tasks").fetchall()
+    db.close()
+    done = 0
+    corrupt = []
+    for output_path, status in rows:
+        path = os.path.join(directory, output_path)
+        if status != "done" or not os.path.exists(path):
+            continue
+        done += 1
+        with open(f"{path}.digest", "r") as f:
+            if json.load(f)["digest"] != file_digest(path, block_size):
+                corrupt.append(output_path)
+    return len(rows), done, corrupt
+
+
+def run(server, workers, args):
+    from integrity import BLOCK_SIZE
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "jobs.json"), "w") as f:
+            json.dump([{"title": ANIME, "quality": "720"}], f)
+        before = server.stats()
+        start = time.perf_counter()
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(ROOT, "main.py"),
+                    "--base-url",
+                    server.url,
+                    "batch",
+                    "jobs.json",
+                    "--lease",
+                    str(args.lease),
+                    "--worker-id",
+                    f"worker-{index}",
+                ],
+                cwd=directory,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for index in range(workers)
+        ]
+        killed = False
+        if args.kill_after and workers > 1:
+            try:
+                processes[0].wait(args.kill_after)
+            except subprocess.TimeoutExpired:
+                processes[0].kill()
+                killed = True
+        for process in processes:
+            process.wait()
+        seconds = time.perf_counter() - start
+        after = server.stats()
+
+        tasks, done, corrupt = check(directory, BLOCK_SIZE)
+        needed = tasks * server.video_size
+        sent = after["bytes_sent"] - before["bytes_sent"]
+        return {
+            "workers": workers,
+            "killed": killed,
+            "seconds": seconds,
+            "throughput_mb_s": needed / seconds / 1024**2,
+            "tasks": tasks,
+            "done": done,
+            "corrupt": corrupt,
+            # Pages are a few KB, so this is about video bytes
+            "sent_ratio": sent / needed if needed else None,
+        }
+
+
+def main():
+    from ratelimit import parse_rate, parse_size
+    from server import StandInServer
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, action="append")
+    parser.add_argument("--episodes", type=int, default=12, help="episodes in the queue")
+    parser.add_argument("--video-size", type=parse_size, default=8 * 1024 * 1024)
+    parser.add_argument(
+        "--bandwidth", type=parse_rate, default=8 * 1024 * 1024, help="bytes/s per connection"
+    )
+    parser.add_argument("--lease", type=float, default=5)
+    parser.add_argument("--kill-after", type=float, help="kill one worker after S seconds")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    server = StandInServer(
+        seasons=1,
+        episodes_per_season=args.episodes,
+        films=0,
+        video_size=args.video_size,
+        bandwidth=args.bandwidth,
+    ).start()
+    results = []
+    try:
+        for workers in args.workers or (1, 2, 4):
+            results.append(run(server, workers, args))
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'workers':>8}{'killed':>8}{'seconds':>9}{'MB/s':>8}{'speedup':>9}"
+        f"{'done':>8}{'corrupt':>9}{'sent ratio':>12}"
+    )
+    for r in results:
+        print(
+            f"{r['workers']:>8}{'yes' if r['killed'] else 'no':>8}{r['seconds']:>9.2f}"
+            f"{r['throughput_mb_s']:>8.1f}{results[0]['seconds'] / r['seconds']:>9.2f}"
+            f"{r['done']:>4}/{r['tasks']:<3}{len(r['corrupt']):>9}{r['sent_ratio']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
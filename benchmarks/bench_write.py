@@ -0,0 +1,171 @@
+"""Benchmark of the download write path: iter_content + append vs diskio.py
+
+Usage:
+    python benchmarks/bench_write.py [--json] [--size MB] [--buffer-size SIZE]
+
+A local HTTP server streams a file from memory and each implementation
+downloads it in a fresh interpreter, so the CPU time and peak RSS reported
+belong to the client alone. "append" is the original loop
+(`iter_content(1 MiB)` + `f.write`), "readinto" preallocates the file and
+reads the socket into one reusable buffer.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def append_download(url, path, buffer_size):
+    import requests
+
+    with requests.get(url, stream=True) as response, open(path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+
+
+def readinto_download(url, path, buffer_size):
+    import requests
+
+    from diskio import preallocate, stream_into
+
+    with requests.get(url, stream=True) as response:
+        with open(path, "wb", buffering=buffer_size) as f:
+            preallocate(f, int(response.headers["content-length"]))
+        with open(path, "r+b", buffering=buffer_size) as f:
+            buffer = bytearray(buffer_size)
+            for chunk in stream_into(response, buffer):
+                f.write(chunk)
+
+
+IMPLEMENTATIONS = {"append": append_download, "readinto": readinto_download}
+
+
+def run_worker(impl, url, path, buffer_size):
+    """Download once and report wall time, CPU time, page faults and peak RSS growth"""
+    import requests  # noqa: F401  (imported before taking the baseline)
+
+    import diskio  # noqa: F401
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    IMPLEMENTATIONS[impl](url, path, buffer_size)
+    seconds = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "seconds": seconds,
+        "cpu_seconds": (usage.ru_utime - baseline.ru_utime)
+        + (usage.ru_stime - baseline.ru_stime),
+        # Every freshly allocated chunk shows up as page faults
+        "minor_faults": usage.ru_minflt - baseline.ru_minflt,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": usage.ru_maxrss - baseline.ru_maxrss,
+        "bytes": os.path.getsize(path),
+    }
+
+
+def serve(size):
+    """Start a server that answers every GET with `size` bytes"""
+    body = os.urandom(1024 * 1024)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            view = memoryview(body)
+            remaining = size
+            while remaining:
+                sent = min(remaining, len(body))
+                self.wfile.write(view[:sent])
+                remaining -= sent
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(impl, url, path, buffer_size):
+    output = subprocess.run(
+        [sys.executable, __file__, "--worker", impl, url, path, str(buffer_size)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    os.remove(path)
+    return json.loads(output)
+
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == "--worker":
+        _, _, impl, url, path, buffer_size = sys.argv
+        print(json.dumps(run_worker(impl, url, path, int(buffer_size))))
+        return
+
+    from ratelimit import parse_size
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="file size in MB")
+    parser.add_argument("--buffer-size", type=parse_size, default=CHUNK_SIZE)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    server = serve(args.size * 1024 * 1024)
+    url = f"http://127.0.0.1:{server.server_address[1]}/video.mp4"
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for impl in IMPLEMENTATIONS:
+            runs = [
+                measure(impl, url, os.path.join(directory, "video.mp4"), args.buffer_size)
+                for _ in range(args.repeat)
+            ]
+            best = min(runs, key=lambda run: run["cpu_seconds"])
+            gigabytes = best["bytes"] / 1024**3
+            results.append(
+                {
+                    "implementation": impl,
+                    "bytes": best["bytes"],
+                    "seconds": best["seconds"],
+                    "cpu_seconds_per_gb": best["cpu_seconds"] / gigabytes,
+                    "throughput_mb_s": best["bytes"] / best["seconds"] / 1024**2,
+                    "minor_faults": best["minor_faults"],
+                    "peak_rss_kb": max(run["peak_rss_kb"] for run in runs),
+                }
+            )
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'implementation':<16}{'CPU s/GB':>10}{'MB/s':>10}{'faults':>10}"
+        f"{'peak RSS KB':>13}"
+    )
+    for r in results:
+        print(
+            f"{r['implementation']:<16}{r['cpu_seconds_per_gb']:>10.3f}"
+            f"{r['throughput_mb_s']:>10.0f}{r['minor_faults']:>10}{r['peak_rss_kb']:>13}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Synthetic jut.su pages for benchmarks
+
+The pages mimic the structure of real jut.su pages: a series index with
+one `a.video` link per episode surrounded by the usual site chrome, and
+episode pages with one `<source res=...>` tag per quality.
+"""
+
+import random
+
+QUALITIES = ("1080", "720", "480", "360")
+
+_CHROME = """
+<div class="header"><div class="logo"><a href="/">Jut.su</a></div>
+<ul class="menu">{menu}</ul></div>
+<script>var player_config = {{"autoplay": false, "items": [{items}]}};</script>
+"""
+
+_COMMENT = """
+<div class="comment" id="comment_{n}"><div class="comment_head">
+<a class="comment_author" href="/user/{n}/">user{n}</a><span class="date">{n} days ago</span>
+</div><div class="comment_text">{text}</div>
+<div class="comment_buttons"><a class="reply" href="#reply_{n}">Reply</a></div></div>
+"""
+
+
+def _chrome(rng):
+    menu = "".join(f'<li><a href="/anime/{i}/">Genre {i}</a></li>' for i in range(40))
+    items = ", ".join(str(rng.randint(0, 10**6)) for _ in range(200))
+    return _CHROME.format(menu=menu, items=items)
+
+
+def _comments(rng, count):
+    words = ["anime", "episode", "season", "great", "watch", "again", "best", "ever"]
+    return "".join(
+        _COMMENT.format(n=n, text=" ".join(rng.choice(words) for _ in range(40)))
+        for n in range(count)
+    )
+
+
+def episode_hrefs(anime, seasons=3, episodes_per_season=100, films=3):
+    """The episode hrefs listed on the index page of a synthetic series"""
+    hrefs = []
+    if seasons == 1:
+        hrefs += [f"/{anime}/episode-{e}.html" for e in range(1, episodes_per_season + 1)]
+    else:
+        hrefs += [
+            f"/{anime}/season-{s}/episode-{e}.html"
+            for s in range(1, seasons + 1)
+            for e in range(1, episodes_per_season + 1)
+        ]
+    hrefs += [f"/{anime}/film-{f}.html" for f in range(1, films + 1)]
+    return hrefs
+
+
+def series_page(anime="testanime", seasons=3, episodes_per_season=100, films=3, seed=0):
+    """A series index page with one `a.video` link per episode"""
+    rng = random.Random(seed)
+    links = "\n".join(
+        f'<a href="{href}" class="short-btn black video the_hildi">{n} episode</a>'
+        for n, href in enumerate(
+            episode_hrefs(anime, seasons, episodes_per_season, films), start=1
+        )
+    )
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Series</title></head>"
+        f"<body>{_chrome(rng)}<div class=\"content\"><h1>{anime}</h1>"
+        f"<div class=\"watch_list\">{links}</div>{_comments(rng, 150)}</div></body></html>"
+    )
+
+
+def episode_page(video_base, name="video", qualities=QUALITIES, seed=0):
+    """An episode page with one `<source res=...>` tag per quality"""
+    rng = random.Random(seed)
+    sources = "\n".join(
+        f'<source src="{video_base}/{name}-{quality}.mp4?hash={rng.getrandbits(64):x}" '
+        f'type="video/mp4" lang="ru" label="{quality}p" res="{quality}"/>'
+        for quality in qualities
+    )
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Episode</title></head>"
+        f"<body>{_chrome(rng)}<div class=\"videoContent\">"
+        f"<video id=\"my-player\" class=\"video-js\" controls preload=\"none\">{sources}</video>"
+        f"</div>{_comments(rng, 80)}</body></html>"
+    )
+
+
+_WORDS = (
+    "kimi", "no", "sora", "hikari", "yume", "kaze", "hoshi", "tsuki", "shinobi",
+    "ken", "mahou", "shoujo", "gakuen", "sensei", "tenshi", "akuma", "ryuu", "umi",
+    "hana", "yoru", "sekai", "monogatari", "densetsu", "kishi", "boku", "hero",
+)
+# Title cards on one page of the catalog
+CATALOG_PAGE_SIZE = 30
+
+
+def catalog_names(count, seed=0):
+    """Distinct URL names of a synthetic catalog, like "hoshi-no-kishi" """
+    rng = random.Random(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = "-".join(rng.choice(_WORDS) for _ in range(rng.randint(2, 4)))
+        if name in seen:
+            name = f"{name}-{len(names)}"
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def catalog_page(names, page=1, seed=0):
+    """One page of the catalog (/anime/, /anime/page-N/) with a card per title
+
+    Pages after the last title have no cards.
+    """
+    rng = random.Random(seed + page)
+    cards = "\n".join(
+        f'<div class="all_anime_global"><a href="/{name}/"><div class="all_anime">'
+        f'<div class="all_anime_image" style="background: url(/posters/{name}.jpg)"></div>'
+        f'<div class="aaname">{name.replace("-", " ").title()}</div>'
+        f'<div class="aailines">{rng.randint(1, 5)} seasons</div></div></a></div>'
+        for name in names[(page - 1) * CATALOG_PAGE_SIZE : page * CATALOG_PAGE_SIZE]
+    )
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Anime</title></head>"
+        f"<body>{_chrome(rng)}<div class=\"content\"><h1>Anime</h1>"
+        f"<div class=\"all_anime_content\">{cards}</div></div></body></html>"
+    )
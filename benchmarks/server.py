@@ -0,0 +1,366 @@
+"""Local stand-in for jut.su used by the benchmarks
+
+Usage:
+    python benchmarks/server.py [--port N] [--latency S] [--bandwidth RATE]
+                                [--no-ranges] [--failure-rate F] [--drop-rate F]
+                                [--trickle-rate F]
+
+Serves synthetic series indexes and episode pages from fixtures.py and video
+files of a configurable size:
+
+    /anime/, /anime/page-<N>/              catalog with a card per title
+    /<anime>/                              series index
+    /<anime>/season-<S>/episode-<E>.html   episode page (also /<anime>/episode-<E>.html)
+    /<anime>/film-<F>.html                 film page
+    /video/<name>-<quality>.mp4            video file
+
+Every request can be delayed (`latency`), every connection is limited to
+`bandwidth` bytes per second, byte ranges can be turned off, and a fraction
+of the requests can be answered with 503 (`failure_rate`), have their
+video body cut off half-way (`drop_rate`) or slow down to a trickle
+half-way (`trickle_rate`), like a bad route through a proxy: the rest of
+the body comes at TRICKLE_BANDWIDTH until the connection is dropped after
+TRICKLE_SECONDS. Pages carry an ETag and are
+answered with 304 when it matches If-None-Match; `set_episodes` adds
+episodes to every season, like a series that is still airing.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+
+# Videos repeat a block of random bytes that starts with an MP4 "ftyp" box
+BLOCK_SIZE = 1024 * 1024
+# Amount of data written to the socket at a time
+WRITE_SIZE = 64 * 1024
+# Speed of a trickling video body, and how long it trickles before hanging up
+TRICKLE_BANDWIDTH = 2 * 1024
+TRICKLE_SECONDS = 60
+
+CATALOG_PAGE = re.compile(r"^/anime/(?:page-(?P<page>\d+)/)?$")
+EPISODE_PAGE = re.compile(
+    r"^/(?P<anime>[\w-]+)/(?:season-(?P<season>\d+)/)?(?:episode|film)-(?P<num>\d+)\.html$"
+)
+VIDEO = re.compile(r"^/video/(?P<name>[\w-]+)\.mp4$")
+
+
+def _block():
+    rng = random.Random(0)
+    ftyp = b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2"
+    return ftyp + rng.randbytes(BLOCK_SIZE - len(ftyp))
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up (e.g. cancelled segments) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandInServer:
+    """A threaded HTTP server that behaves like the parts of jut.su we use"""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        seasons=3,
+        episodes_per_season=100,
+        films=3,
+        titles=0,
+        qualities=fixtures.QUALITIES,
+        video_size=64 * 1024 * 1024,
+        latency=0.0,
+        bandwidth=None,
+        ranges=True,
+        failure_rate=0.0,
+        drop_rate=0.0,
+        trickle_rate=0.0,
+        seed=0,
+    ):
+        self.seasons = seasons
+        self.episodes_per_season = episodes_per_season
+        self.films = films
+        # URL names listed in the catalog; every name has a series index
+        self.titles = fixtures.catalog_names(titles)
+        self.qualities = qualities
+        self.video_size = video_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.trickle_rate = trickle_rate
+        self.block = _block()
+        self.requests = 0
+        self.failures = 0
+        self.drops = 0
+        self.trickles = 0
+        self.bytes_sent = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._httpd = _HTTPServer((host, port), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "drops": self.drops,
+                "trickles": self.trickles,
+                "bytes_sent": self.bytes_sent,
+            }
+
+    def _roll(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+    def page(self, path):
+        """HTML of a series index or episode page, or None for unknown paths"""
+        if path in self._pages:
+            return self._pages[path]
+        parts = path.strip("/").split("/")
+        catalog = CATALOG_PAGE.match(path)
+        if catalog:
+            page = fixtures.catalog_page(self.titles, int(catalog.group("page") or 1))
+        elif len(parts) == 1 and parts[0]:
+            page = fixtures.series_page(
+                parts[0], self.seasons, self.episodes_per_season, self.films
+            )
+        elif EPISODE_PAGE.match(path):
+            name = re.sub(r"\W+", "-", path.strip("/").removesuffix(".html"))
+            page = fixtures.episode_page(
+                f"{self.url}/video", name, self.qualities, seed=zlib.crc32(path.encode())
+            )
+        else:
+            return None
+        page = page.encode("utf-8")
+        with self._lock:
+            self._pages[path] = page
+        return page
+
+    def set_episodes(self, episodes_per_season):
+        """Change the number of episodes per season (their indexes change too)"""
+        with self._lock:
+            self.episodes_per_season = episodes_per_season
+            self._pages.clear()
+
+    def video_bytes(self, start, end):
+        """Content of every video between two offsets (inclusive), in pieces"""
+        position = start
+        while position <= end:
+            offset = position % BLOCK_SIZE
+            size = min(WRITE_SIZE, BLOCK_SIZE - offset, end - position + 1)
+            yield memoryview(self.block)[offset : offset + size]
+            position += size
+
+
+def _handler(server):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.respond(head=True)
+
+        def do_GET(self):
+            self.respond()
+
+        def respond(self, head=False):
+            with server._lock:
+                server.requests += 1
+            if server.latency:
+                time.sleep(server.latency)
+            path = self.path.split("?")[0]
+
+            if server._roll(server.failure_rate):
+                with server._lock:
+                    server.failures += 1
+                self.send_response(503)
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if VIDEO.match(path):
+                self.send_video(path, head)
+                return
+
+            page = server.page(path)
+            if page is None:
+                self.send_error(404)
+                return
+            etag = f'"{zlib.crc32(page):08x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if not head:
+                self.send_body([page])
+
+        def send_video(self, path, head):
+            size = server.video_size
+            etag = f'"{VIDEO.match(path).group("name")}-{size}"'
+            start, end = 0, size - 1
+            partial = False
+            range_header = self.headers.get("Range", "")
+            if_range = self.headers.get("If-Range")
+            match = re.match(r"^bytes=(\d+)-(\d*)$", range_header)
+            if server.ranges and match and (if_range is None or if_range == etag):
+                start = int(match.group(1))
+                end = min(int(match.group(2) or size - 1), size - 1)
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                partial = True
+
+            self.send_response(206 if partial else 200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("ETag", etag)
+            if server.ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            if partial:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if head:
+                return
+
+            if server._roll(server.drop_rate):
+                # Send half of the body and hang up
+                with server._lock:
+                    server.drops += 1
+                end = start + (end - start) // 2
+                self.close_connection = True
+            trickle_after = None
+            if server._roll(server.trickle_rate):
+                with server._lock:
+                    server.trickles += 1
+                trickle_after = (end - start + 1) // 2
+            self.send_body(server.video_bytes(start, end), trickle_after)
+
+        def send_body(self, pieces, trickle_after=None):
+            started = time.monotonic()
+            trickling = None
+            sent = 0
+            try:
+                for piece in pieces:
+                    if trickle_after is not None and sent >= trickle_after:
+                        trickling = trickling or time.monotonic()
+                        sent += self.trickle(piece)
+                        if time.monotonic() - trickling >= TRICKLE_SECONDS:
+                            self.close_connection = True
+                            return
+                        continue
+                    self.wfile.write(piece)
+                    sent += len(piece)
+                    if server.bandwidth:
+                        ahead = sent / server.bandwidth - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+            finally:
+                with server._lock:
+                    server.bytes_sent += sent
+
+        def trickle(self, piece):
+            """Send a piece at TRICKLE_BANDWIDTH, a kilobyte at a time"""
+            for offset in range(0, len(piece), 1024):
+                self.wfile.write(piece[offset : offset + 1024])
+                self.wfile.flush()
+                time.sleep(1024 / TRICKLE_BANDWIDTH)
+            return len(piece)
+
+    return Handler
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from ratelimit import parse_rate, parse_size
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seasons", type=int, default=3)
+    parser.add_argument("--episodes", type=int, default=100, help="episodes per season")
+    parser.add_argument("--films", type=int, default=3)
+    parser.add_argument("--titles", type=int, default=0, help="titles in the catalog")
+    parser.add_argument("--video-size", type=parse_size, default=64 * 1024 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--bandwidth", type=parse_rate, help="bytes/s per connection")
+    parser.add_argument("--no-ranges", action="store_true")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--trickle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StandInServer(
+        args.host,
+        args.port,
+        seasons=args.seasons,
+        episodes_per_season=args.episodes,
+        films=args.films,
+        titles=args.titles,
+        video_size=args.video_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        ranges=not args.no_ranges,
+        failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate,
+        trickle_rate=args.trickle_rate,
+    )
+    print(f"Serving on {server.url}, e.g. python main.py --base-url {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+from lazy import logger
+
+
+class PageCache:
+    """Persistent cache of HTML pages keyed by URL
+
+    Pages are stored compressed in a SQLite database. An entry younger than
+    `ttl` seconds is served without touching the network; an older one is
+    revalidated with its ETag/Last-Modified validators. When the stored pages
+    exceed `max_size` bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path="page_cache.db", ttl=3600, max_size=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                encoding TEXT,
+                content_type TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)"
+        )
+        self._db.commit()
+
+    def get(self, url):
+        """Return the cached entry for a URL (or None) and mark it as recently used"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, encoding, content_type, etag, last_modified, fetched_at "
+                "FROM pages WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), url)
+            )
+            self._db.commit()
+
+        body, encoding, content_type, etag, last_modified, fetched_at = row
+        return {
+            "body": zlib.decompress(body),
+            "encoding": encoding,
+            "content_type": content_type,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": time.time() - fetched_at < self.ttl,
+        }
+
+    def validators(self, entry):
+        """Conditional request headers that revalidate a cached entry"""
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def refresh(self, url):
+        """Mark an entry as fresh again after the server answered 304 Not Modified"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url)
+            )
+            self._db.commit()
+
+    def store(self, url, response):
+        """Store a successful HTML response, evicting old pages if needed"""
+        content_type = response.headers.get("content-type", "")
+        if response.status_code != 200 or "text/html" not in content_type:
+            return
+
+        body = zlib.compress(response.content)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    body,
+                    len(body),
+                    response.encoding,
+                    content_type,
+                    response.headers.get("etag"),
+                    response.headers.get("last-modified"),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """Drop least recently used pages until the cache fits into `max_size`"""
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pages"
+        ).fetchone()
+        if total <= self.max_size:
+            return
+        for url, size in self._db.execute(
+            "SELECT url, size FROM pages ORDER BY accessed_at"
+        ).fetchall():
+            self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            logger.info(f"Evicted {url} from the page cache")
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def record(self, outcome):
+        """Count a lookup outcome (hits, revalidated or misses)"""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        """Hit/miss counters of this run"""
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,432 @@
+"""Local index of the jut.su catalog: every title with its seasons, episodes and films
+
+`crawl_catalog` walks the catalog pages and the series index of every title
+concurrently through the downloader, and `CatalogIndex` keeps the result in
+a compact file. Looking a name up, completing a prefix, suggesting titles
+for a misspelled name and listing the episodes of a title are then answered
+from it without loading a single page.
+"""
+
+import array
+import bisect
+import itertools
+import os
+import re
+import struct
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from lazy import LazyImport, logger
+
+# Only needed for suggestions and crawling
+difflib = LazyImport("difflib")
+extract = LazyImport("extract")
+tqdm = LazyImport("tqdm", "tqdm")
+
+# Pages of the catalog: the first one and the ones after it
+CATALOG_PATH = "/anime/"
+CATALOG_PAGE_PATH = "/anime/page-{page}/"
+# Page requests per second to the site while crawling, unless --page-rate is given
+CRAWL_PAGE_RATE = 5
+# Qualities recorded in the index, one bit each
+QUALITIES = ("1080", "720", "480", "360")
+# Season number of the films in the episode runs
+FILMS = 0
+# Added to the season number of episodes whose URL has no season part
+NO_SEASON_PATH = 0x8000
+# Similarity (0-1) a name needs to be suggested for a misspelled one
+FUZZY_CUTOFF = 0.6
+# Names sharing the most trigrams with a misspelled one that difflib compares it to
+FUZZY_CANDIDATES = 200
+
+MAGIC = b"JCAT"
+VERSION = 1
+# Magic, version, number of titles, number of runs, time of the crawl
+HEADER = struct.Struct("<4sHIId")
+# Unsigned ints per title: first run, number of runs, bit mask of the qualities
+RECORD_FIELDS = 3
+# Unsigned shorts per run: season, first and last episode number
+RUN_FIELDS = 3
+
+
+def slug(text):
+    """A name as it appears in URLs: lower case words joined by dashes"""
+    return re.sub(r"[\W_]+", "-", text.casefold()).strip("-")
+
+
+class Title:
+    """One title of the catalog
+
+    `runs` are the episode numbers as (season, first, last) ranges in the
+    order of the series index, with the films in season FILMS.
+    """
+
+    __slots__ = ("name", "title", "runs", "qualities")
+
+    def __init__(self, name, title="", runs=(), qualities=()):
+        self.name = name
+        self.title = title or name
+        self.runs = list(runs)
+        self.qualities = list(qualities)
+
+    @classmethod
+    def from_links(cls, name, title, links, episode_info, qualities=()):
+        """Build a title from the `a.video` links of its series index
+
+        `episode_info` is `AnimeDownloader.extract_episode_info`.
+        """
+        numbers = {}
+        for link in links:
+            path = link["href"].strip("/")
+            info = episode_info(path)
+            if info is None:
+                continue
+            if info["episode_type"] == "film":
+                season = FILMS
+            elif len(path.split("/")) == 2:
+                season = info["season_num"] | NO_SEASON_PATH
+            else:
+                season = info["season_num"]
+            numbers.setdefault(season, set()).add(info["episode_num"])
+
+        runs = []
+        # Seasons in order, the films after them
+        for season in sorted(numbers, key=lambda s: (s == FILMS, s & ~NO_SEASON_PATH)):
+            first = last = None
+            for number in sorted(numbers[season]):
+                if last is not None and number == last + 1:
+                    last = number
+                    continue
+                if first is not None:
+                    runs.append((season, first, last))
+                first = last = number
+            runs.append((season, first, last))
+        return cls(name, title, runs, qualities)
+
+    @property
+    def seasons(self):
+        return len({s & ~NO_SEASON_PATH for s, _, _ in self.runs if s != FILMS})
+
+    @property
+    def episodes(self):
+        return sum(last - first + 1 for s, first, last in self.runs if s != FILMS)
+
+    @property
+    def films(self):
+        return sum(last - first + 1 for s, first, last in self.runs if s == FILMS)
+
+    def links(self):
+        """The links of the series index, like `extract.episode_links` returns them"""
+        links = []
+        for season, first, last in self.runs:
+            for number in range(first, last + 1):
+                if season == FILMS:
+                    href = f"/{self.name}/film-{number}.html"
+                elif season & NO_SEASON_PATH:
+                    href = f"/{self.name}/episode-{number}.html"
+                else:
+                    href = f"/{self.name}/season-{season}/episode-{number}.html"
+                links.append({"href": href})
+        return links
+
+    def __repr__(self):
+        return f"<Title {self.name}: {self.seasons} seasons, {self.episodes} episodes>"
+
+
+class CatalogIndex:
+    """The titles of the catalog in flat arrays, sorted by name
+
+    Every title takes a fixed slot of RECORD_FIELDS unsigned ints in
+    `records`; its runs of episode numbers are RUN_FIELDS unsigned shorts
+    each in `runs`. Names and displayed titles are plain lists searched with
+    bisect. Title objects are only built for the titles that are looked up,
+    so tens of thousands of episodes take a few bytes per title in memory
+    and on disk.
+    """
+
+    def __init__(self, names=(), titles=(), records=None, runs=None, crawled_at=None):
+        self.names = list(names)
+        self.titles = list(titles)
+        self.records = records if records is not None else array.array("I")
+        self.runs = runs if runs is not None else array.array("H")
+        self.crawled_at = crawled_at
+        self._title_keys = None
+        # All names in one string, and where each of them starts in it
+        self._blob = None
+        self._starts = None
+
+    @classmethod
+    def build(cls, entries, crawled_at=None):
+        """Pack Title objects into an index"""
+        index = cls(crawled_at=crawled_at if crawled_at is not None else time.time())
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            mask = 0
+            for quality in entry.qualities:
+                if quality in QUALITIES:
+                    mask |= 1 << QUALITIES.index(quality)
+            index.names.append(entry.name)
+            index.titles.append(" ".join(entry.title.split()))
+            index.records.extend((len(index.runs) // RUN_FIELDS, len(entry.runs), mask))
+            for run in entry.runs:
+                index.runs.extend(run)
+        return index
+
+    def merge(self, entries):
+        """A new index with `entries` added, replacing the titles of the same name
+
+        Displayed names and qualities that an entry lacks are kept from the
+        title it replaces.
+        """
+        titles = {title.name: title for title in self}
+        for entry in entries:
+            old = titles.get(entry.name)
+            if old is not None:
+                if entry.title == entry.name:
+                    entry.title = old.title
+                if not entry.qualities:
+                    entry.qualities = old.qualities
+            titles[entry.name] = entry
+        return CatalogIndex.build(titles.values())
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by `save`; None if there is none yet"""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < HEADER.size:
+            raise ValueError(f"{path} is not a catalog index")
+        magic, version, count, run_count, crawled_at = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a catalog index of this version")
+        offset = HEADER.size
+        strings = []
+        for _ in range(2):
+            (size,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            blob = data[offset : offset + size].decode("utf-8")
+            strings.append(blob.split("\n") if count else [])
+            offset += size
+        records = array.array("I")
+        records.frombytes(data[offset : offset + count * RECORD_FIELDS * records.itemsize])
+        offset += count * RECORD_FIELDS * records.itemsize
+        runs = array.array("H")
+        runs.frombytes(data[offset : offset + run_count * RUN_FIELDS * runs.itemsize])
+        if sys.byteorder == "big":
+            records.byteswap()
+            runs.byteswap()
+        return cls(strings[0], strings[1], records, runs, crawled_at)
+
+    def save(self, path):
+        """Write the index to `path` (little endian, replaced atomically)"""
+        records = array.array("I", self.records)
+        runs = array.array("H", self.runs)
+        if sys.byteorder == "big":
+            records.byteswap()
+            runs.byteswap()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    len(self.names),
+                    len(self.runs) // RUN_FIELDS,
+                    self.crawled_at or 0,
+                )
+            )
+            for strings in (self.names, self.titles):
+                blob = "\n".join(strings).encode("utf-8")
+                f.write(struct.pack("<I", len(blob)))
+                f.write(blob)
+            f.write(records.tobytes())
+            f.write(runs.tobytes())
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (self._title(i) for i in range(len(self.names)))
+
+    def _position(self, name):
+        i = bisect.bisect_left(self.names, name)
+        return i if i < len(self.names) and self.names[i] == name else None
+
+    def _title(self, i):
+        first, count, mask = self.records[i * RECORD_FIELDS : (i + 1) * RECORD_FIELDS]
+        runs = self.runs[first * RUN_FIELDS : (first + count) * RUN_FIELDS]
+        return Title(
+            self.names[i],
+            self.titles[i],
+            zip(runs[0::3], runs[1::3], runs[2::3]),
+            [quality for bit, quality in enumerate(QUALITIES) if mask & 1 << bit],
+        )
+
+    def get(self, name):
+        """The title with this URL name, or None"""
+        i = self._position(name)
+        return self._title(i) if i is not None else None
+
+    def prefix(self, text, limit=10):
+        """Titles whose URL name starts with `text`, in name order"""
+        key = slug(text)
+        found = []
+        i = bisect.bisect_left(self.names, key)
+        while i < len(self.names) and self.names[i].startswith(key) and len(found) < limit:
+            found.append(self._title(i))
+            i += 1
+        return found
+
+    def search(self, text, limit=10):
+        """Titles matching `text` best first: by URL name, displayed name, then similarity"""
+        key = slug(text)
+        if not key:
+            return []
+        found = []
+
+        def add(i):
+            if i not in found and len(found) < limit:
+                found.append(i)
+
+        i = bisect.bisect_left(self.names, key)
+        while i < len(self.names) and self.names[i].startswith(key) and len(found) < limit:
+            add(i)
+            i += 1
+        if len(found) < limit:
+            if self._title_keys is None:
+                self._title_keys = sorted(
+                    (title.casefold(), i) for i, title in enumerate(self.titles)
+                )
+            text = " ".join(text.split()).casefold()
+            j = bisect.bisect_left(self._title_keys, (text,))
+            while (
+                j < len(self._title_keys)
+                and self._title_keys[j][0].startswith(text)
+                and len(found) < limit
+            ):
+                add(self._title_keys[j][1])
+                j += 1
+        if len(found) < limit:
+            for name in self._similar(key, limit):
+                add(self._position(name))
+        return [self._title(i) for i in found]
+
+    def _similar(self, key, limit):
+        """Names like `key`, best first
+
+        Comparing `key` with every name in Python takes too long for a large
+        catalog, so difflib only ranks the names that share the most
+        character trigrams with it. They are found by searching all names at
+        once, joined into one string.
+        """
+        if self._blob is None:
+            self._blob = "\n" + "\n".join(self.names) + "\n"
+            self._starts = list(
+                itertools.accumulate((len(name) + 1 for name in self.names), initial=1)
+            )
+        padded = f"\n{key}\n"
+        shared = Counter()
+        for gram in {padded[i : i + 3] for i in range(len(padded) - 2)}:
+            # The middle character of a trigram is always part of the name
+            shared.update(
+                bisect.bisect_right(self._starts, match.start() + 1) - 1
+                for match in re.finditer(re.escape(gram), self._blob)
+            )
+        candidates = [self.names[i] for i, _ in shared.most_common(FUZZY_CANDIDATES)]
+        return difflib.get_close_matches(key, candidates, limit, FUZZY_CUTOFF)
+
+    def resolve(self, text, limit=5):
+        """The title meant by a name typed by the user, or None and suggestions
+
+        An exact URL name, or a prefix of only one, resolves to that title.
+        """
+        key = slug(text)
+        title = self.get(key)
+        if title is not None:
+            return title, []
+        matches = self.prefix(key, 2)
+        if len(matches) == 1:
+            return matches[0], []
+        return None, self.search(text, limit)
+
+
+def _name_from_href(href):
+    if href.startswith("http"):
+        href = urlparse(href).path
+    return href.strip("/").split("/")[0]
+
+
+def crawl_catalog(downloader, names=None, concurrency=8, qualities=False):
+    """Index the titles of the catalog, or only `names`, through `downloader`
+
+    The catalog pages are fetched `concurrency` at a time until one lists no
+    titles, then the series index of every title (and with `qualities` the
+    page of its last episode) the same way. All requests go through
+    `downloader.safe_request`, so they use its cookies, proxies, page rate
+    limit and page cache. Returns the Title objects and the names of the
+    titles that could not be indexed.
+    """
+    base_url = downloader.base_url
+    concurrency = max(1, concurrency)
+
+    def catalog_page(page):
+        path = CATALOG_PATH if page == 1 else CATALOG_PAGE_PATH.format(page=page)
+        url = f"{base_url}{path}"
+        try:
+            response = downloader.safe_request(url)
+        except Exception as e:
+            logger.error(f"Could not load catalog page {page}: {e}")
+            return None
+        if response.status_code == 404:
+            return []
+        with downloader.metrics.timer("parse", url):
+            return extract.catalog_titles(response.content, response.encoding)
+
+    def index_title(card):
+        name, display = card
+        links = downloader.get_episodes_list(f"{base_url}/{name}/")
+        if not links:
+            return name, None
+        found = ()
+        if qualities:
+            found = downloader.get_available_qualities(f"{base_url}{links[-1]['href']}")
+        title = Title.from_links(name, display, links, downloader.extract_episode_info, found)
+        return name, title if title.runs else None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        cards = {}
+        if names is None:
+            page = 1
+            last_page = False
+            while not last_page:
+                batch = range(page, page + concurrency)
+                for result in executor.map(catalog_page, batch):
+                    if result is None:
+                        # A page that failed may hide later ones; stop here
+                        last_page = True
+                        continue
+                    if not result:
+                        last_page = True
+                    for card in result:
+                        cards.setdefault(_name_from_href(card["href"]), card["title"])
+                page += concurrency
+            logger.info(f"Found {len(cards)} titles in the catalog")
+        else:
+            cards = {name: "" for name in names}
+
+        entries = []
+        failed = []
+        with tqdm(total=len(cards), desc="Indexing titles", unit="title") as pbar:
+            for name, title in executor.map(index_title, cards.items()):
+                if title is None:
+                    failed.append(name)
+                else:
+                    entries.append(title)
+                pbar.update(1)
+    return entries, failed
@@ -0,0 +1,105 @@
+import os
+import socket
+import time
+
+from lazy import LazyImport
+
+# Only needed when a transfer fails
+http_client = LazyImport("http.client")
+requests = LazyImport("requests")
+
+
+def preallocate(f, size):
+    """Reserve `size` bytes for a file on disk so it is not grown by appending
+
+    Falls back to a sparse file on platforms or file systems without
+    posix_fallocate.
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f.truncate(size)
+
+
+def stream_into(response, buffer, limit=None, interval=None):
+    """Yield the body of a streamed response in pieces read into `buffer`
+
+    The socket is read with readinto() straight into the reusable buffer, so
+    no bytes object is allocated per chunk. Each yielded memoryview is only
+    valid until the next one is requested and must be consumed (written) first.
+    At most `limit` bytes are read when it is given.
+
+    With `interval`, the buffer is filled with partial reads (readinto1()) and
+    a piece is yielded once it is full or `interval` seconds after the previous
+    one, so a slow body still arrives as it comes instead of in one read that
+    waits for a whole buffer.
+
+    Bodies with a Content-Encoding are decoded by requests and yielded as the
+    bytes objects it produces.
+    """
+    fp = getattr(response.raw, "_fp", None)
+    encoding = response.headers.get("content-encoding", "identity").lower()
+    if fp is None or not hasattr(fp, "readinto") or encoding != "identity":
+        for chunk in response.iter_content(chunk_size=len(buffer)):
+            if limit is not None:
+                chunk = chunk[:limit]
+                limit -= len(chunk)
+            if chunk:
+                yield chunk
+            if limit == 0:
+                return
+        return
+
+    view = memoryview(buffer)
+    while limit is None or limit > 0:
+        size = len(view) if limit is None else min(len(view), limit)
+        try:
+            if interval is None:
+                read = fp.readinto(view[:size])
+            else:
+                read = 0
+                deadline = time.monotonic() + interval
+                while read < size:
+                    count = fp.readinto1(view[read:size])
+                    if not count:
+                        break
+                    read += count
+                    if time.monotonic() >= deadline:
+                        break
+        except (OSError, http_client.HTTPException) as e:
+            # Surface transport errors the same way iter_content does
+            raise requests.exceptions.ConnectionError(e) from e
+        if not read:
+            return
+        if limit is not None:
+            limit -= read
+        yield view[:read]
+
+
+def abort(response):
+    """Make a read of a streamed response that blocks another thread return now
+
+    Closing the response does not wake up a thread blocked in recv(); shutting
+    its socket down does, and the read then returns what it has or fails.
+    """
+    fp = getattr(response.raw, "_fp", None)
+    sock = getattr(getattr(getattr(fp, "fp", None), "raw", None), "_sock", None)
+    if sock is None:
+        sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def fsync_path(path):
+    """Flush a file, or the entries of a directory, to stable storage"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
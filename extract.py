@@ -0,0 +1,73 @@
+"""Targeted extraction of the few elements the downloader needs from jut.su pages
+
+Building a full BeautifulSoup tree of a large series index only to read the
+`a.video` links costs far more CPU and memory than the links themselves.
+These helpers parse the raw bytes with lxml's C parser and select the
+elements with XPath, returning plain attribute dicts that can be used like
+the bs4 tags they replace (`link["href"]`, `source.get("res")`).
+"""
+
+from functools import lru_cache
+
+from lxml import etree, html
+
+_EPISODE_LINKS = etree.XPath(
+    "//a[contains(concat(' ', normalize-space(@class), ' '), ' video ')]"
+)
+_VIDEO_SOURCES = etree.XPath("//source")
+# Title cards of the catalog (/anime/): a link around the poster and the name
+_CATALOG_CARDS = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' all_anime_global ')]"
+    "/a[@href]"
+)
+_CARD_NAME = etree.XPath(
+    ".//div[contains(concat(' ', normalize-space(@class), ' '), ' aaname ')]"
+)
+
+
+@lru_cache(maxsize=None)
+def _parser(encoding):
+    return html.HTMLParser(encoding=encoding)
+
+
+def _parse(content, encoding=None):
+    """Parse a page given as bytes, decoding it with `encoding` when known"""
+    if not content or not content.strip():
+        return None
+    try:
+        return html.document_fromstring(content, parser=_parser(encoding))
+    except etree.ParserError:
+        return None
+
+
+def episode_links(content, encoding=None):
+    """Return the attributes of every `a.video` element of a series index page"""
+    root = _parse(content, encoding)
+    if root is None:
+        return []
+    return [dict(link.attrib) for link in _EPISODE_LINKS(root)]
+
+
+def video_sources(content, encoding=None):
+    """Return the attributes of every `<source>` element of an episode page"""
+    root = _parse(content, encoding)
+    if root is None:
+        return []
+    return [dict(source.attrib) for source in _VIDEO_SOURCES(root)]
+
+
+def catalog_titles(content, encoding=None):
+    """Return the href and displayed name of every title card of a catalog page"""
+    root = _parse(content, encoding)
+    if root is None:
+        return []
+    titles = []
+    for link in _CATALOG_CARDS(root):
+        name = _CARD_NAME(link)
+        titles.append(
+            {
+                "href": link.get("href"),
+                "title": name[0].text_content().strip() if name else "",
+            }
+        )
+    return titles
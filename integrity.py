@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+# Downloads are hashed in blocks of this size; segments start on block boundaries
+BLOCK_SIZE = 4 * 1024 * 1024
+# SHA-256 of the concatenated SHA-256 digests of the 4 MiB blocks of a file.
+# Unlike a plain SHA-256 it can be computed while segments arrive out of order.
+ALGORITHM = "sha256-blocks-4m"
+
+
+class IntegrityError(Exception):
+    """A downloaded file is not the video it should be"""
+
+
+def is_mp4_start(data):
+    """Whether the first bytes of a file are an MP4 "ftyp" box"""
+    return bytes(data[4:8]) == b"ftyp"
+
+
+class BlockHasher:
+    """Hashes a stream that starts on a block boundary, one block at a time
+
+    The hex digest of every completed block is appended to `hashes`, which can
+    be the list stored in the resume state of a segment.
+    """
+
+    def __init__(self, hashes, block_size=BLOCK_SIZE):
+        self.hashes = hashes
+        self.block_size = block_size
+        self._hash = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self.block_size - self._filled)
+            self._hash.update(view[:size])
+            self._filled += size
+            view = view[size:]
+            if self._filled == self.block_size:
+                self._next_block()
+
+    def copy(self):
+        """A hasher in the same state that appends to a copy of `hashes`"""
+        clone = BlockHasher(list(self.hashes), self.block_size)
+        clone._hash = self._hash.copy()
+        clone._filled = self._filled
+        return clone
+
+    def finish(self):
+        """Account the last, shorter block at the end of the stream"""
+        if self._filled:
+            self._next_block()
+
+    def _next_block(self):
+        self.hashes.append(self._hash.hexdigest())
+        self._hash = hashlib.sha256()
+        self._filled = 0
+
+
+def block_count(size, block_size=BLOCK_SIZE):
+    return -(-size // block_size)
+
+
+def matching_blocks(f, start, size, hashes, first=0, block_size=BLOCK_SIZE):
+    """Number of leading blocks of `size` bytes at `start` in `f` that match `hashes`
+
+    Used to check the block hashes of a resume state against the bytes that
+    actually reached the file before they are trusted. Blocks before `first`
+    are taken as matching without being read.
+    """
+    f.seek(start + first * block_size)
+    for index in range(first, len(hashes)):
+        data = f.read(min(block_size, size - index * block_size))
+        if hashlib.sha256(data).hexdigest() != hashes[index]:
+            return index
+    return len(hashes)
+
+
+def combine(hashes):
+    """Digest of a whole file from the hex digests of its blocks"""
+    return hashlib.sha256(b"".join(bytes.fromhex(h) for h in hashes)).hexdigest()
+
+
+def digest_path(path):
+    return f"{path}.digest"
+
+
+def write_digest(path, digest, size, hashes):
+    """Store the digest of a file (and its block digests) next to it"""
+    tmp_path = f"{digest_path(path)}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "algorithm": ALGORITHM,
+                "digest": digest,
+                "size": size,
+                "block_size": BLOCK_SIZE,
+                "blocks": hashes,
+            },
+            f,
+        )
+    os.replace(tmp_path, digest_path(path))
+
+
+def read_digest(path):
+    """The digest stored next to a file, or None"""
+    try:
+        with open(digest_path(path), "r") as f:
+            data = json.load(f)
+        if data["algorithm"] != ALGORITHM:
+            return None
+        return data["digest"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
@@ -0,0 +1,267 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from lazy import logger
+
+
+def load_jobs(path, base_url="https://jut.su"):
+    """Read a job file: a JSON list of jobs (or an object with a "jobs" list)
+
+    Each job names a title or URL and may set "quality", "start_season",
+    "start_episode", "include_films" and "priority" (higher runs first).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    jobs = data["jobs"] if isinstance(data, dict) else data
+
+    normalized = []
+    for job in jobs:
+        if isinstance(job, str):
+            job = {"title": job}
+        url = job.get("url") or job.get("title")
+        if not url:
+            raise ValueError(f"Job without a title or URL: {job}")
+        if not url.startswith("http"):
+            url = f"{base_url}/{url}"
+        normalized.append(
+            {
+                "url": url,
+                "quality": str(job.get("quality", "1080")),
+                "start_season": int(job.get("start_season", 1)),
+                "start_episode": int(job.get("start_episode", 1)),
+                "include_films": bool(job.get("include_films", False)),
+                "priority": int(job.get("priority", 0)),
+            }
+        )
+    return normalized
+
+
+class JobQueue:
+    """Durable queue of episode downloads stored in SQLite
+
+    Jobs (titles) are expanded once into episode-level tasks. Tasks are
+    deduplicated by output path, so the same episode requested by several
+    jobs is downloaded once, at the highest priority any of them asked for.
+    Every state change is committed immediately, so a restarted process
+    continues exactly where the previous one stopped.
+
+    Several processes, also on different hosts sharing the database file, can
+    work on the same queue. A claimed task is leased to its worker for `lease`
+    seconds and the lease is kept alive with `renew`; a task whose lease ran
+    out (its worker died or hung) is claimed again by the next worker, which
+    continues the .part file left behind. Other stores can replace this class
+    by providing the same methods.
+    """
+
+    def __init__(self, path="jobs.db", max_attempts=3, lease=60, worker_id=None):
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                key TEXT PRIMARY KEY,
+                expanded_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                url TEXT NOT NULL,
+                output_path TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_next
+                ON tasks (status, priority DESC, id);
+            """
+        )
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(tasks)")}
+        # Queues created before leases existed
+        if "owner" not in columns:
+            self._db.execute("ALTER TABLE tasks ADD COLUMN owner TEXT")
+        if "lease_until" not in columns:
+            self._db.execute("ALTER TABLE tasks ADD COLUMN lease_until REAL")
+
+    @staticmethod
+    def job_key(job):
+        return json.dumps(
+            [job[k] for k in ("url", "quality", "start_season", "start_episode", "include_films")]
+        )
+
+    def is_expanded(self, job):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM jobs WHERE key = ?", (self.job_key(job),)
+            ).fetchone()
+        return row is not None
+
+    def add_job(self, job, episodes):
+        """Store the episode tasks of a job and remember that it was expanded"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for episode in episodes:
+                    self._db.execute(
+                        "INSERT INTO tasks (key, url, output_path, quality, priority, "
+                        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET "
+                        "priority = MAX(priority, excluded.priority), "
+                        "updated_at = excluded.updated_at",
+                        (
+                            episode["output_path"],
+                            episode["url"],
+                            episode["output_path"],
+                            job["quality"],
+                            job["priority"],
+                            now,
+                            now,
+                        ),
+                    )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO jobs VALUES (?, ?)", (self.job_key(job), now)
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def reset_running(self):
+        """Return tasks whose worker stopped (their lease ran out) to the queue"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE tasks SET status = 'pending', owner = NULL, lease_until = NULL, "
+                "updated_at = ? WHERE status = 'running' "
+                "AND (lease_until IS NULL OR lease_until < ?)",
+                (time.time(), time.time()),
+            )
+
+    def claim(self):
+        """Lease the next task to this worker (highest priority, then oldest), or None
+
+        Pending tasks and running tasks with an expired lease are both eligible.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT * FROM tasks WHERE status = 'pending' OR (status = 'running' "
+                    "AND (lease_until IS NULL OR lease_until < ?)) "
+                    "ORDER BY priority DESC, id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE tasks SET status = 'running', attempts = attempts + 1, "
+                        "owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                        (self.worker_id, now + self.lease, now, row["id"]),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        if row["status"] == "running":
+            owner = row["owner"] or "a stopped worker"
+            logger.info(f"Taking over {row['output_path']} from {owner}")
+        task = dict(row)
+        task["attempts"] += 1
+        task["owner"] = self.worker_id
+        return task
+
+    def renew(self):
+        """Extend the leases of every task this worker is running
+
+        Returns the number of leases renewed.
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE tasks SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                (time.time() + self.lease, self.worker_id),
+            )
+        return cursor.rowcount
+
+    def release(self):
+        """Give the tasks this worker is running back to the queue, e.g. on Ctrl+C
+
+        Other workers can take them over at once instead of waiting for the
+        leases to run out. The stopped attempt does not count.
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE tasks SET status = 'pending', owner = NULL, lease_until = NULL, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? "
+                "WHERE status = 'running' AND owner = ?",
+                (time.time(), self.worker_id),
+            )
+        return cursor.rowcount
+
+    def next_expiry(self):
+        """When the earliest lease held by another worker runs out, or None"""
+        with self._lock:
+            (expiry,) = self._db.execute(
+                "SELECT MIN(COALESCE(lease_until, 0)) FROM tasks "
+                "WHERE status = 'running' AND owner IS NOT ?",
+                (self.worker_id,),
+            ).fetchone()
+        return expiry
+
+    def complete(self, task):
+        """Mark a task done; the file is in place, so whoever finished it may do so"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE tasks SET status = 'done', last_error = NULL, owner = NULL, "
+                "lease_until = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), task["id"]),
+            )
+
+    def fail(self, task, error):
+        """Put a failed task back in the queue, or give up after `max_attempts`
+
+        A worker that lost the lease of the task leaves it to the new owner;
+        "lost" is returned then.
+        """
+        status = "failed" if task["attempts"] >= self.max_attempts else "pending"
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE tasks SET status = ?, last_error = ?, owner = NULL, "
+                "lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                (status, error, time.time(), task["id"], self.worker_id),
+            )
+        return status if cursor.rowcount else "lost"
+
+    def counts(self):
+        """Number of tasks per status"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def failed(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM tasks WHERE status = 'failed' ORDER BY id"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
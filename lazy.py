@@ -0,0 +1,45 @@
+import importlib
+import threading
+
+
+class LazyImport:
+    """A module, or an attribute of one, that is imported on first use
+
+    Stands in for `import requests` or `from loguru import logger` at the top
+    of a module, so that commands which never touch the network (status,
+    duplicates, --help) start without loading requests, loguru, tqdm or lxml.
+    Attribute access and calls are forwarded to the real object.
+    """
+
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                if self._target is None:
+                    target = importlib.import_module(self._module)
+                    if self._attribute is not None:
+                        target = getattr(target, self._attribute)
+                    self._target = target
+                target = self._target
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module if self._attribute is None else f"{self._module}.{self._attribute}"
+        state = "imported" if self._target is not None else "not imported yet"
+        return f"<lazy {name}, {state}>"
+
+
+# Shared by all modules that log
+logger = LazyImport("loguru", "logger")
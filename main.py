@@ -1,33 +1,167 @@
-from bs4 import BeautifulSoup
-import requests
 from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+import argparse
+import hashlib
+import itertools
+import json
 import os
+import queue
+import random
+import sqlite3
 import sys
-from tqdm import tqdm
+import threading
 import time
-from loguru import logger
+
+from cache import PageCache
+from catalog import CRAWL_PAGE_RATE, CatalogIndex, crawl_catalog
+from diskio import fsync_path, preallocate
+from integrity import (
+    BLOCK_SIZE,
+    IntegrityError,
+    block_count,
+    combine,
+    matching_blocks,
+    write_digest,
+)
+from jobqueue import JobQueue, load_jobs
+from lazy import LazyImport, logger
+from manifest import Manifest
+from metrics import Metrics, host_of
+from proxy_pool import ProxyPool
+from segments import RangeNotSupported, SegmentFetcher
+from stalls import STALL_RATE, STALL_WINDOW
+from streaming import GrowingFile, StreamServer, pipe
+from ratelimit import (
+    AIMDController,
+    HostRateLimiter,
+    TokenBucket,
+    backoff_delay,
+    parse_rate,
+    parse_size,
+    retry_after,
+)
+
+# Imported on first use: commands that only read the manifest need none of them
+requests = LazyImport("requests")
+tqdm = LazyImport("tqdm", "tqdm")
+extract = LazyImport("extract")
+
+CHUNK_SIZE = 1024 * 1024
+# Segments smaller than this are not worth a separate connection
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# Answers that mean the server is overloaded or throttling us
+THROTTLING_STATUSES = (429, 503)
+# Upper bound for the pool that resolves episode pages ahead of the downloads
+MAX_RESOLVERS = 4
+# Downloads of an episode before a file that fails verification is given up
+MAX_INTEGRITY_ATTEMPTS = 3
+# Times a page without links, or an episode that hit a proxy error, is tried
+# again through another proxy
+MAX_PROXY_RETRIES = 3
+# How often an idle batch worker checks on the tasks leased to other workers
+QUEUE_POLL_INTERVAL = 1
+# Streamed episodes are split into segments of this size, fetched in file order
+STREAM_SEGMENT_SIZE = 2 * BLOCK_SIZE
+
+
+class DownloadStopped(Exception):
+    """A download was stopped (e.g. with Ctrl+C) before it was complete"""
 
 
 class AnimeDownloader:
-    def __init__(self):
+    def __init__(
+        self,
+        jobs=1,
+        segments=1,
+        lookahead=2,
+        page_cache=None,
+        manifest=None,
+        catalog=None,
+        max_rate=None,
+        page_rate=None,
+        adaptive=False,
+        buffer_size=CHUNK_SIZE,
+        fsync=False,
+        base_url="https://jut.su",
+        metrics=None,
+        stall_rate=STALL_RATE,
+        stall_window=STALL_WINDOW,
+    ):
         # Logging setup
         logger.remove()
         logger.add(sys.stderr, level="ERROR")
-        logger.add("anime_downloader.log", rotation="10 MB", level="ERROR")
+        # The log file is only created once something is logged to it
+        logger.add("anime_downloader.log", rotation="10 MB", level="ERROR", delay=True)
 
         self.headers = {
             # To bypass Cloudflare protection, replace the User-Agent with your own.
             # You can find it in your browser's developer tools (F12 -> Network -> any request -> Headers).
             "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:141.0) Gecko/20100101 Firefox/141.0"
         }
-        self.session = requests.Session()
-        self.load_cookies()
+        # Site the episode links are resolved against (a local stand-in in benchmarks)
+        self.base_url = base_url.rstrip("/")
+        self.jobs = max(1, jobs)
+        self.segments = max(1, segments)
+        self.lookahead = max(0, lookahead)
+        self.page_cache = page_cache
+        self.manifest = manifest
+        # Index of the site's titles written by `crawl`, when there is one
+        self.catalog = catalog
+        # Size of the buffer a download is read into and written from, and
+        # whether finished files are flushed to stable storage
+        self.buffer_size = max(64 * 1024, buffer_size)
+        self.fsync = fsync
+        # Global bytes/sec cap, per-host page request rate and adaptive
+        # concurrency; each of them is optional.
+        self.bandwidth = TokenBucket(max_rate) if max_rate else None
+        self.page_limiter = HostRateLimiter(page_rate) if page_rate else None
+        self.concurrency = AIMDController(self.jobs) if adaptive else None
+        # A video transfer slower than `stall_rate` bytes/sec over `stall_window`
+        # seconds is hedged through another route (0 turns this off). Under a
+        # global cap every transfer only gets its share, so the bar is lowered.
+        if max_rate and stall_rate:
+            stall_rate = min(stall_rate, max_rate / (4 * self.jobs * self.segments))
+        self.stall_rate = stall_rate
+        self.stall_window = stall_window
+        # Created with the first request, see `session`
+        self._requests_session = None
+        self._session_lock = threading.Lock()
+        self._positions = None
+        self._total_pbar = None
+        self._pbar_lock = threading.Lock()
         self.proxies = []
+        self.proxy_pool = None
+        self._route = threading.local()
         self.timeout = 10
-        self.current_proxy = None
+        # Set by `stop`; every running download has its own cancel event in
+        # `_cancels`, which `stop` sets too
+        self._stopping = threading.Event()
+        self._cancels = set()
+        self._cancels_lock = threading.Lock()
+        # Timings per phase and host; always collected, exporting them is optional
+        self.metrics = metrics if metrics is not None else Metrics()
         self.load_proxies()
 
-    def load_cookies(self):
+    @property
+    def session(self):
+        """The requests session, set up with the cookies from cookies.txt on first use"""
+        if self._requests_session is None:
+            with self._session_lock:
+                if self._requests_session is None:
+                    session = requests.Session()
+                    # The session is shared by all download workers, so its connection
+                    # pool must be large enough to keep one connection per segment alive.
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_maxsize=max(10, self.jobs * (self.segments + 1))
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self.load_cookies(session)
+                    self._requests_session = session
+        return self._requests_session
+
+    def load_cookies(self, session):
         """Load cookies from cookies.txt file (Netscape format)"""
         cookie_file = Path("cookies.txt")
         if not cookie_file.exists():
@@ -43,7 +177,7 @@ class AnimeDownloader:
                     parts = line.strip().split('\t')
                     if len(parts) == 7:
                         domain, _, path, secure, _, name, value = parts
-                        self.session.cookies.set(
+                        session.cookies.set(
                             name=name,
                             value=value,
                             domain=domain,
@@ -55,7 +189,11 @@ class AnimeDownloader:
             logger.error(f"Error loading cookies from file: {e}")
 
     def load_proxies(self):
-        """Load proxies from proxies.txt file"""
+        """Load proxies from proxies.txt file and start checking them all at once
+
+        The checks run in the background; the first request that needs a proxy
+        waits until one of them has passed (or all have failed).
+        """
         proxy_file = Path("proxies.txt")
         if proxy_file.exists():
             with open(proxy_file, "r") as f:
@@ -67,76 +205,195 @@ class AnimeDownloader:
                         self.proxies.append(line)
             if self.proxies:
                 logger.info(f"Loaded {len(self.proxies)} proxies")
-                self.apply_proxy()
+                self.proxy_pool = ProxyPool(self.proxies, self._check_proxy)
+                self.proxy_pool.start()
             else:
                 logger.info("No proxies found in the file. Continuing without proxies.")
         else:
             logger.info("proxies.txt file not found. Continuing without proxies.")
 
-    def apply_proxy(self):
-        """Apply a proxy from the list"""
-        if not self.proxies:
-            logger.info("No proxies found. Continuing without proxies.")
-            self.session.proxies.clear()
-            self.current_proxy = None
-            return False
-
-        try:
-            self.current_proxy = self.proxies
-            self.session.proxies.update(
-                {"http": self.current_proxy, "https": self.current_proxy}
+    def _check_proxy(self, proxy):
+        """Return the latency of a test request to the site through a proxy"""
+        start = time.monotonic()
+        with self.metrics.timer("proxy_check", proxy):
+            self.session.head(
+                self.base_url,
+                headers=self.headers,
+                proxies={"http": proxy, "https": proxy},
+                timeout=self.timeout,
             )
-            logger.info(f"Using proxy: {self.current_proxy}")
+        return time.monotonic() - start
 
-            # Proxy check
-            test_url = "https://jut.su"
-            try:
-                test_response = self.session.get(test_url, timeout=self.timeout)
-                logger.info(f"Proxy is working, status: {test_response.status_code}")
-                return True
-            except Exception as e:
-                logger.error(f"Proxy is not working: {str(e)}")
-                self.proxies.remove(self.current_proxy)
-                if self.proxies:
-                    logger.info("Trying another proxy...")
-                    return self.apply_proxy()
-                else:
-                    logger.info("No working proxies found. Continuing without proxies.")
-                    self.session.proxies.clear()
-                    self.current_proxy = None
-                    return False
-        except Exception as e:
-            logger.error(f"Error setting proxy: {str(e)}")
-            self.session.proxies.clear()
-            self.current_proxy = None
+    @property
+    def current_proxy(self):
+        """The proxy used by the last request of the calling thread"""
+        proxy = getattr(self._route, "proxy", None)
+        return proxy.url if proxy is not None else None
+
+    def apply_proxy(self):
+        """Check whether requests can still be routed through a working proxy
+
+        Every request picks the best healthy proxy of the pool by itself, and
+        failing proxies are taken out of rotation by their circuit breaker, so
+        a retry after a proxy error automatically goes through another one.
+        """
+        if self.proxy_pool is None or not self.proxy_pool.healthy_count():
+            logger.info("No working proxies left. Continuing without proxies.")
             return False
+        logger.info(f"{self.proxy_pool.healthy_count()} working proxies left")
+        return True
 
-    def safe_request(self, url, stream=False):
-        """Safe request with error handling and retries"""
+    def safe_request(
+        self, url, stream=False, headers=None, method="GET", avoid=None, cache=True
+    ):
+        """Safe request with error handling and retries
+
+        Plain page requests go through the page cache when it is enabled: fresh
+        pages are served from disk and stale ones are revalidated. `cache=False`
+        always asks the server. `avoid` is a proxy the request must not go
+        through; it goes directly when no other proxy is healthy.
+        """
+        cached = None
+        cacheable = (
+            cache
+            and self.page_cache is not None
+            and method == "GET"
+            and not stream
+            and not headers
+        )
+        if cacheable:
+            cached, hit, headers = self._cache_lookup(url, headers)
+            if hit is not None:
+                return hit
+
+        request_headers = {**self.headers, **headers} if headers else self.headers
+        # For a video stream the request lasts until the headers arrive (TTFB)
+        phase = "head" if method == "HEAD" else "ttfb" if stream else "page"
+        host = host_of(url)
+        previous_proxy = None
+        proxy_switches = 0
         max_retries = 3
         for attempt in range(max_retries):
+            # Each attempt goes through the best healthy proxy at that moment,
+            # or directly when there is none.
+            if self.page_limiter is not None and not stream:
+                self.page_limiter.wait(url)
+            proxy = (
+                self.proxy_pool.acquire(exclude=avoid)
+                if self.proxy_pool is not None
+                else None
+            )
+            if attempt and proxy is not previous_proxy:
+                proxy_switches += 1
+            previous_proxy = proxy
+            self._route.proxy = proxy
+            proxies = {"http": proxy.url, "https": proxy.url} if proxy else None
+            started = time.perf_counter()
             try:
                 if stream:
-                    return self.session.get(
-                        url, headers=self.headers, stream=True, timeout=self.timeout
+                    response = self.session.request(
+                        method,
+                        url,
+                        headers=request_headers,
+                        stream=True,
+                        timeout=self.timeout,
+                        proxies=proxies,
                     )
                 else:
-                    return self.session.get(
-                        url, headers=self.headers, timeout=self.timeout
+                    response = self.session.request(
+                        method,
+                        url,
+                        headers=request_headers,
+                        timeout=self.timeout,
+                        proxies=proxies,
                     )
+                if self.proxy_pool is not None:
+                    self.proxy_pool.record_success(
+                        proxy, response.elapsed.total_seconds()
+                    )
+                response.proxy = proxy
+                self.metrics.observe(
+                    "seconds", time.perf_counter() - started, phase, host
+                )
             except requests.exceptions.RequestException as e:
                 logger.error(f"Request error ({attempt + 1}/{max_retries}): {str(e)}")
+                self.metrics.increment("errors", phase, host)
+                if self.proxy_pool is not None:
+                    self.proxy_pool.record_failure(proxy)
+                if self.concurrency is not None:
+                    self.concurrency.on_error()
                 if "Tunnel connection failed" in str(
                     e
                 ) or "SOCKSHTTPConnectionPool" in str(e):
                     logger.info("Problem with proxy, trying another one...")
                     if not self.apply_proxy() and attempt == max_retries - 1:
                         logger.info("Trying without proxy...")
-                        self.session.proxies.clear()
-                        self.current_proxy = None
                 if attempt == max_retries - 1:
+                    self.metrics.observe("retries", attempt, phase, host)
+                    self.metrics.observe("proxy_switches", proxy_switches, phase, host)
                     raise
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt))
+                continue
+            finally:
+                if self.proxy_pool is not None:
+                    self.proxy_pool.release(proxy)
+
+            if response.status_code in THROTTLING_STATUSES:
+                # The server is overloaded or throttling us: back off instead of
+                # hammering it, and run fewer transfers in parallel.
+                self.metrics.increment("throttled", phase, host)
+                if self.concurrency is not None:
+                    self.concurrency.on_error()
+                if attempt < max_retries - 1:
+                    delay = retry_after(response.headers) or backoff_delay(attempt)
+                    logger.error(
+                        f"Server answered {response.status_code} "
+                        f"({attempt + 1}/{max_retries}), retrying in {delay:.1f}s"
+                    )
+                    response.close()
+                    time.sleep(delay)
+                    continue
+            break
+
+        self.metrics.observe("retries", attempt, phase, host)
+        self.metrics.observe("proxy_switches", proxy_switches, phase, host)
+        if cacheable:
+            return self._cache_update(url, cached, response)
+        return response
+
+    def _cache_lookup(self, url, headers):
+        """Look a page up in the page cache before requesting it
+
+        Returns the cache entry, a response when the entry is fresh enough to be
+        used as is, and the request headers (with validators for a stale entry).
+        """
+        cached = self.page_cache.get(url)
+        if cached is not None and cached["fresh"]:
+            self.page_cache.record("hits")
+            return cached, self._cached_response(url, cached), headers
+        if cached is not None:
+            headers = self.page_cache.validators(cached)
+        return cached, None, headers
+
+    def _cache_update(self, url, cached, response):
+        """Store a fetched page, or serve the cached copy if the server confirmed it"""
+        if response.status_code == 304 and cached is not None:
+            self.page_cache.record("revalidated")
+            self.page_cache.refresh(url)
+            return self._cached_response(url, cached)
+        self.page_cache.record("misses")
+        self.page_cache.store(url, response)
+        return response
+
+    def _cached_response(self, url, cached):
+        """Build a response object for a page served from the page cache"""
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = cached["body"]
+        response.encoding = cached["encoding"]
+        response.headers["Content-Type"] = cached["content_type"]
+        return response
 
     def extract_episode_info(self, url_path):
         """Extract episode information from URL"""
@@ -187,151 +444,608 @@ class AnimeDownloader:
             return None
         return result
 
-    def download_episode(self, url, output_path, quality, episode_num, total_episodes):
-        """Download a single episode with a progress bar"""
-        os.makedirs(Path("/".join(output_path.rsplit("/")[:-1])), exist_ok=True)
+    def stop(self):
+        """Stop all downloads, e.g. on Ctrl+C
 
-        if output_path.split("/")[-1] in os.listdir(
-            Path("/".join(output_path.rsplit("/")[:-1]))
-        ):
-            logger.info(f"Episode already downloaded: {output_path}")
-            return True
+        Running transfers end at their next chunk and keep their progress in
+        the .part sidecar; episodes that have not started are skipped.
+        """
+        self._stopping.set()
+        with self._cancels_lock:
+            for cancel in self._cancels:
+                cancel.set()
 
-        try:
-            logger.info(
-                f"Getting information about episode {episode_num}/{total_episodes}..."
-            )
-            response = self.safe_request(url)
-            soup = BeautifulSoup(response.text, "lxml")
+    def _acquire_position(self):
+        """Reserve a progress bar line for an episode (None when downloading sequentially)"""
+        if self._positions is None:
+            return None
+        return self._positions.get()
 
-            # Attempt to find video in the specified quality
-            all_qualities = ["1080", "720", "480", "360"]
-            current_quality = quality
-            video_source = None
+    def _release_position(self, position):
+        """Return a progress bar line to the pool of free lines"""
+        if position is not None and self._positions is not None:
+            self._positions.put(position)
 
-            logger.info(f"Searching for video in {current_quality}p quality...")
-            while not video_source:
-                video_source = soup.find("source", {"res": current_quality})
+    def _add_total(self, size):
+        """Account the size of a newly started episode in the total-bytes bar"""
+        if self._total_pbar is None or not size:
+            return
+        with self._pbar_lock:
+            self._total_pbar.total += size
+            self._total_pbar.refresh()
 
-                if not video_source:
-                    try:
-                        # Trying the next lower quality
-                        quality_index = all_qualities.index(current_quality)
-                        if quality_index < len(all_qualities) - 1:
-                            current_quality = all_qualities[quality_index + 1]
-                            logger.info(
-                                f"Quality {quality} is not available, trying {current_quality}"
-                            )
-                        else:
-                            logger.error("No available video qualities found")
-                            return False
-                    except ValueError:
-                        logger.error(f"Invalid quality: {current_quality}")
-                        return False
+    def _update_total(self, size):
+        """Advance the total-bytes bar"""
+        if self._total_pbar is None:
+            return
+        with self._pbar_lock:
+            self._total_pbar.update(size)
 
-            # Downloading video with a progress bar
-            video_url = video_source["src"]
-            print(
-                f"Downloading [{episode_num}/{total_episodes}]: {output_path} ({current_quality}p)"
-            )
+    def _load_part_state(self, part_path, state_path):
+        """Load the sidecar of an interrupted download, if it can be resumed"""
+        if not os.path.exists(part_path) or not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+            written = sum(segment["written"] for segment in state["segments"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring broken resume state {state_path}: {e}")
+            return None
+        for segment in state["segments"]:
+            # Block hashes cannot be resumed mid-block, so an unfinished segment
+            # continues from the end of its last hashed block.
+            hashes = segment.setdefault("hashes", [])
+            if segment["end"] is not None:
+                length = segment["end"] - segment["start"] + 1
+                if segment["written"] >= length and len(hashes) == block_count(length):
+                    continue
+            blocks = min(len(hashes), segment["written"] // BLOCK_SIZE)
+            segment["written"] = blocks * BLOCK_SIZE
+            del hashes[blocks:]
+        written = sum(segment["written"] for segment in state["segments"])
+        if os.path.getsize(part_path) < max(
+            segment["start"] + segment["written"] for segment in state["segments"]
+        ):
+            logger.error(f"Ignoring resume state {state_path}: .part file is too short")
+            return None
+        # The final digest is built from these hashes, so they are checked against
+        # the bytes on disk. The sidecar only records flushed blocks (and with
+        # --fsync, synced ones), so only the last block of a segment is read
+        # back: if it differs (e.g. power was lost without --fsync), every block
+        # is checked and the segment continues from the first one that differs.
+        with open(part_path, "rb") as f:
+            for segment in state["segments"]:
+                hashes = segment["hashes"]
+                start, size = segment["start"], segment["written"]
+                blocks = matching_blocks(f, start, size, hashes, max(len(hashes) - 1, 0))
+                if blocks < len(hashes):
+                    blocks = matching_blocks(f, start, size, hashes)
+                if blocks < len(hashes):
+                    logger.error(
+                        f"Block {blocks} of the segment at {segment['start']} of "
+                        f"{part_path} does not match its resume state, downloading it again"
+                    )
+                    segment["written"] = blocks * BLOCK_SIZE
+                    del hashes[blocks:]
+        written = sum(segment["written"] for segment in state["segments"])
+        logger.info(f"Resuming {part_path} from {written} bytes")
+        return state
+
+    def _save_part_state(self, state_path, state):
+        """Atomically replace the sidecar of a download in progress"""
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def _create_part(self, part_path, state_path, state):
+        """Start the .part file of a new download and its sidecar"""
+        with open(part_path, "wb") as f:
+            # Reserve the whole file up front instead of growing it
+            preallocate(f, state["size"])
+        self._save_part_state(state_path, state)
+
+    def _finish_part(self, part_path, state_path, output_path, digest, hashes):
+        """Move a verified .part file into place, next to its digest"""
+        if self.fsync:
+            fsync_path(part_path)
+        # Written first, so a crash before the rename only repeats this step
+        write_digest(output_path, digest, os.path.getsize(part_path), hashes)
+        os.replace(part_path, output_path)
+        os.remove(state_path)
+        if self.fsync:
+            # Make the rename itself durable
+            fsync_path(os.path.dirname(os.path.abspath(output_path)))
+
+    def _new_part_state(self, video_url, headers, segments, segment_size=None):
+        """Describe a fresh download and split it into at most `segments` ranges
+
+        With `segment_size` the download is split into ranges of that size instead.
+        """
+        total_size = int(headers.get("content-length", 0))
+        count = 1
+        ranges = headers.get("accept-ranges", "").lower() == "bytes"
+        if segment_size is not None and ranges and segments > 1:
+            count = max(1, -(-total_size // segment_size))
+        elif segments > 1 and total_size >= 2 * MIN_SEGMENT_SIZE and ranges:
+            count = min(segments, total_size // MIN_SEGMENT_SIZE)
+
+        if total_size:
+            # Segments start on hash block boundaries
+            segment_size = block_count(-(-total_size // count)) * BLOCK_SIZE
+            segments = [
+                {
+                    "start": start,
+                    "end": min(start + segment_size, total_size) - 1,
+                    "written": 0,
+                    "hashes": [],
+                }
+                for start in range(0, total_size, segment_size)
+            ]
+        else:
+            # Unknown size: a single open-ended segment that ends with the stream
+            segments = [{"start": 0, "end": None, "written": 0, "hashes": []}]
+
+        return {
+            "url": video_url,
+            "size": total_size,
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "segments": segments,
+        }
+
+    def _fetch_segments(
+        self, video_url, part_path, state_path, state, response, progress, streaming=False
+    ):
+        """Fetch every unfinished segment of a download into the .part file
+
+        `response` is the already opened stream for the whole file (or None when
+        resuming) and serves as the first segment, so the probe request is not
+        wasted. Segments are fetched in parallel and their progress is recorded
+        in the sidecar, so an interrupted transfer continues where it stopped.
+
+        When `streaming`, at most `self.segments` segments run at a time: the
+        first one, then the last one (where MP4 files without "faststart" keep
+        their index), then the rest in file order. Every chunk is flushed
+        before it is reported, so readers of the file see it right away.
+
+        Each segment is fetched by a segments.SegmentFetcher, which also hedges
+        stalled transfers and moves failed ones to another route.
+        """
+        pending = [
+            segment
+            for segment in state["segments"]
+            if segment["end"] is None
+            or segment["start"] + segment["written"] <= segment["end"]
+        ]
+        if not pending:
+            # Everything was written before the process stopped, e.g. right
+            # before the rename; the caller verifies and renames the file
+            if response is not None:
+                response.close()
+            return
+
+        fetcher = SegmentFetcher(
+            self, video_url, part_path, state_path, state, progress, streaming
+        )
+        cancel = fetcher.cancel
+        with self._cancels_lock:
+            self._cancels.add(cancel)
+        if self._stopping.is_set():
+            cancel.set()
+        watchdog = fetcher.watchdog
+
+        if response is not None and pending[0]["start"] != 0:
+            response.close()
+            response = None
+        if watchdog is not None:
+            watchdog.start()
+        try:
+            if len(pending) == 1:
+                fetcher.fetch(pending[0], response)
+            else:
+                workers = len(pending)
+                if streaming:
+                    # The executor starts the segments in this order
+                    pending = [pending[0], pending[-1]] + pending[1:-1]
+                    workers = min(workers, self.segments)
+                logger.info(f"Downloading {part_path} in {len(pending)} segments")
+                executor = ThreadPoolExecutor(max_workers=workers)
+                interrupted = False
+                try:
+                    futures = [
+                        executor.submit(
+                            fetcher.fetch, segment, response if index == 0 else None
+                        )
+                        for index, segment in enumerate(pending)
+                    ]
+                    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        if future.exception():
+                            # Stop the remaining segments, their progress is kept in the sidecar
+                            cancel.set()
+                            raise future.exception()
+                except KeyboardInterrupt:
+                    interrupted = True
+                    cancel.set()
+                    raise
+                finally:
+                    # Once cancelled, the running segments stop at their next
+                    # chunk by themselves and the queued ones are dropped. After
+                    # a failure the running ones are waited for, so their
+                    # progress is saved; not on Ctrl+C.
+                    executor.shutdown(wait=not interrupted, cancel_futures=cancel.is_set())
+            if cancel.is_set():
+                raise DownloadStopped(f"Stopped downloading {part_path}")
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+            with self._cancels_lock:
+                self._cancels.discard(cancel)
+
+    def _download_video(
+        self,
+        video_url,
+        output_path,
+        episode_num,
+        total_episodes,
+        video_headers=None,
+        stream=None,
+    ):
+        """Download a video into `output_path`, resuming an interrupted .part file
+
+        Data is written to `<output_path>.part` with a `.part.json` sidecar that
+        records the expected size, validators and bytes written per segment. The
+        file is renamed into place only once it is complete and verified; files
+        that are not MP4 videos or have the wrong size are downloaded again.
+        Returns the digest of the file, which is also stored next to it.
+
+        `video_headers` are the headers of a HEAD request made while resolving
+        the episode. When they announce byte ranges, all segments are requested
+        at once instead of waiting for a probe request.
+
+        `stream` is a streaming.GrowingFile that is fed the file as it arrives;
+        the file is then downloaded in order, beginning at its start.
+        """
+        part_path = f"{output_path}.part"
+        state_path = f"{part_path}.json"
+
+        segments = self.segments
+        segment_size = STREAM_SEGMENT_SIZE if stream is not None else None
+        rejected = 0
+        while True:
+            state = self._load_part_state(part_path, state_path)
+            resumed = state is not None
+            response = None
+            if state is None:
+                if (
+                    video_headers is not None
+                    and video_headers.get("accept-ranges", "").lower() == "bytes"
+                    and int(video_headers.get("content-length", 0))
+                ):
+                    state = self._new_part_state(
+                        video_url, video_headers, segments, segment_size
+                    )
+                else:
+                    response = self.safe_request(video_url, stream=True)
+                    state = self._new_part_state(
+                        video_url, response.headers, segments, segment_size
+                    )
+                # HEAD results are only trusted for the first attempt
+                video_headers = None
+                self._create_part(part_path, state_path, state)
+            if stream is not None:
+                stream.attach(part_path, state)
 
-            response = self.safe_request(video_url, stream=True)
-            total_size = int(response.headers.get("content-length", 0))
+            total_size = state["size"]
+            done = sum(segment["written"] for segment in state["segments"])
+            self._add_total(total_size - done if total_size else 0)
 
-            with open(output_path, "wb") as f:
+            position = self._acquire_position()
+            try:
                 with tqdm(
                     total=total_size,
+                    initial=done,
                     unit="B",
                     unit_scale=True,
                     desc=f"Episode {episode_num}/{total_episodes}",
                     bar_format="{l_bar}{bar:30}{r_bar}",
+                    position=position,
+                    leave=position is None,
                 ) as pbar:
-                    for chunk in response.iter_content(chunk_size=1024 * 1024):
-                        if chunk:
-                            f.write(chunk)
-                            pbar.update(len(chunk))
+                    progress_lock = threading.Lock()
+
+                    def progress(size):
+                        with progress_lock:
+                            pbar.update(size)
+                        self._update_total(size)
+                        if stream is not None:
+                            stream.progress()
 
+                    try:
+                        self._fetch_segments(
+                            video_url,
+                            part_path,
+                            state_path,
+                            state,
+                            response,
+                            progress,
+                            streaming=stream is not None,
+                        )
+                        digest, hashes = self._verify_part(state)
+                        break
+                    except IntegrityError as e:
+                        rejected += 1
+                        self.metrics.increment(
+                            "integrity_errors", "transfer", host_of(video_url)
+                        )
+                        self._update_total(-(pbar.n - done))
+                        os.remove(part_path)
+                        os.remove(state_path)
+                        if rejected >= MAX_INTEGRITY_ATTEMPTS:
+                            raise
+                        logger.error(f"Rejected {output_path} ({e}), downloading it again")
+                        time.sleep(backoff_delay(rejected - 1))
+                    except RangeNotSupported as e:
+                        # The file changed since the .part was started, or the server
+                        # ignores byte ranges: start over.
+                        logger.info(f"Cannot resume {output_path} ({e}), starting over")
+                        self._update_total(-(pbar.n - done))
+                        os.remove(part_path)
+                        os.remove(state_path)
+                        if not resumed:
+                            # A fresh download failed, so ranges do not work
+                            segments = 1
+            finally:
+                self._release_position(position)
+
+        self._finish_part(part_path, state_path, output_path, digest, hashes)
+        return digest
+
+    def _verify_part(self, state):
+        """Check a finished .part file against its state; returns its digest and block hashes
+
+        The size must match Content-Length and every segment must have been
+        hashed completely.
+        """
+        size = sum(segment["written"] for segment in state["segments"])
+        if state["size"] and size != state["size"]:
+            raise IntegrityError(f"got {size} bytes, expected {state['size']}")
+        if not size:
+            raise IntegrityError("empty file")
+        hashes = []
+        for segment in state["segments"]:
+            if len(segment["hashes"]) != block_count(segment["written"]):
+                raise IntegrityError(
+                    f"segment at {segment['start']} has {len(segment['hashes'])} "
+                    f"block hashes for {segment['written']} bytes"
+                )
+            hashes += segment["hashes"]
+        return combine(hashes), hashes
+
+    def resolve_episode(self, url, quality):
+        """Find the video URL of an episode in the requested (or next lower) quality
+
+        Returns a dict with the chosen quality, the video URL and the headers of
+        a HEAD request for the video (None if it failed), or None when the
+        episode has no suitable video.
+        """
+        with self.metrics.timer("resolve", url):
+            return self._resolve_episode(url, quality)
+
+    def _resolve_episode(self, url, quality):
+        response = self.safe_request(url)
+        with self.metrics.timer("parse", url):
+            sources = extract.video_sources(response.content, response.encoding)
+        picked = self._pick_source(sources, quality)
+        if picked is None:
+            return None
+        current_quality, video_source = picked
+
+        video_url = video_source["src"]
+        try:
+            head = self.safe_request(video_url, method="HEAD")
+            video_headers = head.headers if head.status_code == 200 else None
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Could not get video size for {url}: {e}")
+            video_headers = None
+
+        return {
+            "url": url,
+            "quality": current_quality,
+            "video_url": video_url,
+            "video_headers": video_headers,
+        }
+
+    def _pick_source(self, sources, quality):
+        """Choose the source of the requested quality, or the next lower available one
+
+        Returns (quality, source) or None.
+        """
+        sources_by_quality = {}
+        for source in sources:
+            sources_by_quality.setdefault(source.get("res"), source)
+
+        # Attempt to find video in the specified quality
+        all_qualities = ["1080", "720", "480", "360"]
+        current_quality = quality
+        video_source = None
+
+        logger.info(f"Searching for video in {current_quality}p quality...")
+        while not video_source:
+            video_source = sources_by_quality.get(current_quality)
+
+            if not video_source:
+                try:
+                    # Trying the next lower quality
+                    quality_index = all_qualities.index(current_quality)
+                    if quality_index < len(all_qualities) - 1:
+                        current_quality = all_qualities[quality_index + 1]
+                        logger.info(
+                            f"Quality {quality} is not available, trying {current_quality}"
+                        )
+                    else:
+                        logger.error("No available video qualities found")
+                        return None
+                except ValueError:
+                    logger.error(f"Invalid quality: {current_quality}")
+                    return None
+        return current_quality, video_source
+
+    def _record_download(self, url, output_path, quality=None, checksum=None):
+        """Record the file of an episode in the manifest after a download attempt"""
+        if self.manifest is None:
+            return
+        episode = self.extract_episode_info(urlparse(url).path)
+        if episode is not None:
+            self.manifest.record_file(episode, output_path, quality, url, checksum)
+
+    def download_episode(
+        self,
+        url,
+        output_path,
+        quality,
+        episode_num,
+        total_episodes,
+        resolved=None,
+        stream=None,
+    ):
+        """Download a single episode with a progress bar
+
+        `resolved` is the result of `resolve_episode` when the episode page was
+        already resolved ahead of time; otherwise the page is resolved here.
+        `stream` is passed on to `_download_video`.
+        """
+        os.makedirs(Path("/".join(output_path.rsplit("/")[:-1])), exist_ok=True)
+
+        if os.path.exists(output_path):
+            logger.info(f"Episode already downloaded: {output_path}")
+            self._record_download(url, output_path)
+            if stream is not None:
+                stream.attach_complete(output_path)
             return True
-        except Exception as e:
-            logger.error(f"Error downloading {url}: {str(e)}")
-            if "Tunnel connection failed" in str(e) or "SOCKSHTTPConnectionPool" in str(
-                e
-            ):
-                logger.info("Problem with proxy, trying another one...")
-                if self.apply_proxy():
-                    logger.info("Trying again with a new proxy...")
-                    return self.download_episode(
-                        url, output_path, quality, episode_num, total_episodes
+
+        for attempt in range(MAX_PROXY_RETRIES + 1):
+            try:
+                if resolved is None:
+                    logger.info(
+                        f"Getting information about episode {episode_num}/{total_episodes}..."
                     )
-            return False
+                    resolved = self.resolve_episode(url, quality)
+                    if resolved is None:
+                        return False
+
+                # Downloading video with a progress bar
+                tqdm.write(
+                    f"Downloading [{episode_num}/{total_episodes}]: {output_path} ({resolved['quality']}p)"
+                )
+
+                digest = self._download_video(
+                    resolved["video_url"],
+                    output_path,
+                    episode_num,
+                    total_episodes,
+                    resolved["video_headers"],
+                    stream,
+                )
+                self._record_download(url, output_path, resolved["quality"], digest)
+                return True
+            except DownloadStopped as e:
+                # The .part file and its sidecar are kept for the next run
+                logger.info(str(e))
+                return False
+            except Exception as e:
+                logger.error(f"Error downloading {url}: {str(e)}")
+                self._record_download(url, output_path, resolved and resolved["quality"])
+                if "Tunnel connection failed" in str(
+                    e
+                ) or "SOCKSHTTPConnectionPool" in str(e):
+                    logger.info("Problem with proxy, trying another one...")
+                    if attempt < MAX_PROXY_RETRIES and self.apply_proxy():
+                        logger.info("Trying again with a new proxy...")
+                        resolved = None
+                        continue
+                return False
+
+    def _parse_page(self, url, parse, missing, failed):
+        """Request a page and parse it, through other proxies if it has nothing
+
+        A page without anything `parse` looks for may be a block or challenge
+        page served to one proxy, so it is requested again through another
+        proxy and past the page cache, like one that failed with a proxy
+        error, up to MAX_PROXY_RETRIES times. `missing` and `failed` describe
+        the two cases in the log. Returns the parsed list, empty if it failed.
+        """
+        avoid = None
+        cache = True
+        for attempt in range(MAX_PROXY_RETRIES + 1):
+            last = attempt == MAX_PROXY_RETRIES
+            try:
+                response = self.safe_request(url, avoid=avoid, cache=cache)
+                with self.metrics.timer("parse", url):
+                    items = parse(response.content, response.encoding)
+                if items:
+                    return items
+                logger.error(missing)
+                if last or self.proxy_pool is None or not self.apply_proxy():
+                    return []
+                logger.info("Trying with another proxy...")
+                avoid = getattr(response, "proxy", None)
+            except Exception as e:
+                logger.error(f"{failed}: {str(e)}")
+                if not (
+                    "Tunnel connection failed" in str(e)
+                    or "SOCKSHTTPConnectionPool" in str(e)
+                ):
+                    return []
+                logger.info("Problem with proxy, trying another one...")
+                if last or not self.apply_proxy():
+                    return []
+                logger.info("Trying again with a new proxy...")
+                avoid = getattr(self._route, "proxy", None)
+            cache = False
 
     def get_episodes_list(self, url):
         """Get the list of all anime episodes"""
         logger.info(f"Getting episode list from {url}...")
-        try:
-            response = self.safe_request(url)
-            soup = BeautifulSoup(response.text, "lxml")
-            episodes = soup.find_all("a", {"class": "video"})
-
-            if not episodes:
-                logger.error("No episodes found or page is unavailable")
-                if self.current_proxy and self.apply_proxy():
-                    logger.info("Trying with another proxy...")
-                    return self.get_episodes_list(url)
-                return []
-
+        episodes = self._parse_page(
+            url,
+            extract.episode_links,
+            "No episodes found or page is unavailable",
+            "Error getting episode list",
+        )
+        if episodes:
             logger.info(f"Found {len(episodes)} episodes")
-            return episodes
-        except Exception as e:
-            logger.error(f"Error getting episode list: {str(e)}")
-            if "Tunnel connection failed" in str(e) or "SOCKSHTTPConnectionPool" in str(
-                e
-            ):
-                logger.info("Problem with proxy, trying another one...")
-                if self.apply_proxy():
-                    logger.info("Trying again with a new proxy...")
-                    return self.get_episodes_list(url)
-            return []
+        return episodes
 
     def get_available_qualities(self, episode_url):
         """Get available video qualities"""
         logger.info(f"Getting available qualities for {episode_url}...")
-        try:
-            response = self.safe_request(episode_url)
-            soup = BeautifulSoup(response.text, "lxml")
-            sources = soup.find_all("source")
-
-            if not sources:
-                logger.error("No video sources found or page is unavailable")
-                if self.current_proxy and self.apply_proxy():
-                    logger.info("Trying with another proxy...")
-                    return self.get_available_qualities(episode_url)
-                return []
-
-            qualities = [source.get("res") for source in sources if source.get("res")]
+        sources = self._parse_page(
+            episode_url,
+            extract.video_sources,
+            "No video sources found or page is unavailable",
+            "Error getting video qualities",
+        )
+        qualities = [source.get("res") for source in sources if source.get("res")]
+        if qualities:
             logger.info(f"Available qualities: {', '.join(qualities)}")
-            return qualities
-        except Exception as e:
-            logger.error(f"Error getting video qualities: {str(e)}")
-            if "Tunnel connection failed" in str(e) or "SOCKSHTTPConnectionPool" in str(
-                e
-            ):
-                logger.info("Problem with proxy, trying another one...")
-                if self.apply_proxy():
-                    logger.info("Trying again with a new proxy...")
-                    return self.get_available_qualities(episode_url)
-            return []
+        return qualities
 
-    def download_anime(
-        self, url, quality, start_season=1, start_episode=1, include_films=False
-    ):
-        """Download all anime episodes from a specified season and episode"""
+    def plan_episodes(self, url, start_season=1, start_episode=1, include_films=False):
+        """Build the ordered list of episodes to download from a specified season and episode"""
         logger.info("Getting episode list...")
         episodes = self.get_episodes_list(url)
         if not episodes:
             logger.error("Failed to get episode list")
-            return
+            return None
+        return self._plan_from_links(
+            episodes, start_season, start_episode, include_films
+        )
 
+    def _plan_from_links(self, episodes, start_season, start_episode, include_films):
+        """Order the links of a series index and keep the ones to download"""
         logger.info("Organizing episodes by season...")
         # Organize episodes by season and number
         organized_episodes = {}
@@ -353,8 +1067,8 @@ class AnimeDownloader:
             if season not in organized_episodes:
                 organized_episodes[season] = {}
 
-            organized_episodes[season][episode_num] = {
-                "url": f"https://jut.su{href}",
+            episode_data = {
+                "url": f"{self.base_url}{href}",
                 "name": anime_name,
                 "season": season,
                 "episode": f"{episode_type}-{episode_num}.mp4",
@@ -363,45 +1077,36 @@ class AnimeDownloader:
                 "episode_type": episode_type,
             }
 
+            # Create directory structure depending on the type
+            if episode_type == "film":
+                episode_data["output_path"] = (
+                    f"{episode_data['name']}/films/{episode_data['episode']}"
+                )
+            else:
+                episode_data["output_path"] = f"{episode_data['name']}/{episode_data['season']}/{episode_data['episode']}"
+
+            organized_episodes[season][episode_num] = episode_data
+
             logger.info(
                 f"Added: {anime_name}, {season}, {episode_type} {episode_num}"
             )
 
-        # Count the total number of episodes to download
-        total_episodes = 0
-
-        for season in organized_episodes:
-            if not organized_episodes[season]:
-                continue
-
-            for episode_num in organized_episodes[season]:
-                episode_data = organized_episodes[season][episode_num]
-                season_num = episode_data["season_num"]
-                episode_type = episode_data["episode_type"]
-
-                # Check if this episode needs to be downloaded
-                if episode_type == "film" and not include_films:
-                    # Skip movies if the user did not request them
-                    continue
-
-                if season_num >= start_season or (
-                    episode_type == "film" and include_films
-                ):
-                    if (
-                        season_num > start_season
-                        or episode_num >= start_episode
-                        or episode_type == "film"
-                    ):
-                        total_episodes += 1
-
-        print(f"Total episodes found for download: {total_episodes}")
-
-        # Download episodes starting from the specified season and episode
-        if total_episodes == 0:
-            logger.error("No episodes to download from the specified season and episode")
-            return
-
-        current_episode = 1
+        if self.manifest is not None:
+            for anime_name in {
+                episode["name"]
+                for season in organized_episodes.values()
+                for episode in season.values()
+            }:
+                # Files downloaded before the manifest existed are picked up once
+                imported = not self.manifest.has_title(anime_name)
+                self.manifest.add_known(
+                    episode
+                    for season in organized_episodes.values()
+                    for episode in season.values()
+                    if episode["name"] == anime_name
+                )
+                if imported:
+                    self.manifest.rebuild(anime_name)
 
         # Sort seasons by number
         sorted_seasons = sorted(
@@ -413,6 +1118,7 @@ class AnimeDownloader:
             else 0,
         )
 
+        planned = []
         for season in sorted_seasons:
             if not organized_episodes[season]:
                 continue
@@ -420,63 +1126,954 @@ class AnimeDownloader:
             # Sort episodes by number
             for episode_num in sorted(organized_episodes[season].keys()):
                 episode_data = organized_episodes[season][episode_num]
-                season_num = episode_data["season_num"]
-                episode_type = episode_data["episode_type"]
+                if self._is_wanted(
+                    episode_data, start_season, start_episode, include_films
+                ):
+                    planned.append(episode_data)
 
-                # Skip movies if the user did not request them
-                if episode_type == "film" and not include_films:
-                    continue
+        return planned
 
-                # Skip seasons earlier than the starting one (but not movies, if they need to be downloaded)
-                if season_num < start_season and not (
-                    episode_type == "film" and include_films
-                ):
-                    continue
+    @staticmethod
+    def _is_wanted(episode_data, start_season, start_episode, include_films):
+        """Whether an episode is at or after the starting season and episode"""
+        season_num = episode_data["season_num"]
+        episode_num = episode_data["episode_num"]
+        episode_type = episode_data["episode_type"]
 
-                # Skip episodes earlier than the starting one in the starting season (but not movies)
-                if (
-                    season_num == start_season
-                    and episode_num < start_episode
-                    and episode_type != "film"
-                ):
-                    continue
+        # Skip movies if the user did not request them
+        if episode_type == "film" and not include_films:
+            return False
 
-                # Create directory structure depending on the type
-                if episode_data["episode_type"] == "film":
-                    output_path = (
-                        f"{episode_data['name']}/films/{episode_data['episode']}"
-                    )
-                else:
-                    output_path = f"{episode_data['name']}/{episode_data['season']}/{episode_data['episode']}"
+        # Skip seasons earlier than the starting one (but not movies, if they need to be downloaded)
+        if season_num < start_season and not (episode_type == "film" and include_films):
+            return False
+
+        # Skip episodes earlier than the starting one in the starting season (but not movies)
+        if (
+            season_num == start_season
+            and episode_num < start_episode
+            and episode_type != "film"
+        ):
+            return False
+        return True
+
+    def download_anime(
+        self, url, quality, start_season=1, start_episode=1, include_films=False
+    ):
+        """Download all anime episodes from a specified season and episode
+
+        Returns the list of episodes that failed to download.
+        """
+        planned = self.plan_episodes(url, start_season, start_episode, include_films)
+        if planned is None:
+            return []
+
+        total_episodes = len(planned)
+        print(f"Total episodes found for download: {total_episodes}")
+
+        # Download episodes starting from the specified season and episode
+        if total_episodes == 0:
+            logger.error("No episodes to download from the specified season and episode")
+            return []
+
+        return self._run_downloads(planned, quality)
+
+    def _start_progress(self):
+        """Set up the progress bar lines shared by parallel downloads"""
+        if self.jobs > 1:
+            # Line 0 is the total-bytes bar, lines 1..jobs belong to active episodes
+            self._positions = queue.Queue()
+            for position in range(1, self.jobs + 1):
+                self._positions.put(position)
+            self._total_pbar = tqdm(
+                total=0,
+                unit="B",
+                unit_scale=True,
+                desc="Total",
+                bar_format="{l_bar}{bar:30}{r_bar}",
+                position=0,
+            )
+
+    def _stop_progress(self):
+        if self._total_pbar is not None:
+            self._total_pbar.close()
+        self._total_pbar = None
+        self._positions = None
 
+    def _run_downloads(self, planned, quality):
+        """Download the planned episodes on a pool of `self.jobs` workers"""
+        total_episodes = len(planned)
+        failures = []
+        failures_lock = threading.Lock()
+
+        def resolve(episode_data):
+            try:
+                return self.resolve_episode(episode_data["url"], quality)
+            except Exception as e:
+                # download_episode resolves the page again with its own proxy handling
+                logger.info(f"Could not resolve {episode_data['url']} ahead of time: {e}")
+                return None
+
+        def worker(current_episode, episode_data, resolving):
+            if self._stopping.is_set():
+                free_workers.release()
+                return
+            if resolving is None and self._already_downloaded(episode_data):
+                logger.info(f"Episode already downloaded: {episode_data['output_path']}")
+                free_workers.release()
+                return
+            resolved = resolving.result() if resolving is not None else None
+            if self.concurrency is not None:
+                # Waits while the adaptive limit is below the number of workers
+                self.concurrency.acquire()
+            try:
                 success = self.download_episode(
                     episode_data["url"],
-                    output_path,
+                    episode_data["output_path"],
                     quality,
                     current_episode,
                     total_episodes,
+                    resolved=resolved,
+                )
+                error = None
+            except Exception as e:
+                success = False
+                error = str(e)
+            finally:
+                if self.concurrency is not None:
+                    self.concurrency.release()
+                free_workers.release()
+
+            if success:
+                logger.info(
+                    f"Successfully downloaded episode {current_episode}/{total_episodes}"
                 )
+                return
 
-                if success:
-                    logger.info(
-                        f"Successfully downloaded episode {current_episode}/{total_episodes}"
+            logger.error(
+                f"Failed to download episode {current_episode}/{total_episodes}"
+            )
+            with failures_lock:
+                failures.append({**episode_data, "index": current_episode, "error": error})
+
+        self._start_progress()
+
+        # Episode pages are resolved to video URLs by a small pool running up to
+        # `self.lookahead` episodes ahead of the downloads, so the page fetch is
+        # off the critical path. The bounded queue keeps the resolvers from
+        # running further ahead than that.
+        ready = queue.Queue(maxsize=max(1, self.lookahead))
+        free_workers = threading.Semaphore(self.jobs)
+        resolver = (
+            ThreadPoolExecutor(max_workers=min(self.lookahead, MAX_RESOLVERS))
+            if self.lookahead > 0
+            else None
+        )
+
+        def produce():
+            for current_episode, episode_data in enumerate(planned, start=1):
+                resolving = None
+                if resolver is not None and not self._already_downloaded(episode_data):
+                    resolving = resolver.submit(resolve, episode_data)
+                ready.put((current_episode, episode_data, resolving))
+            ready.put(None)
+
+        try:
+            threading.Thread(target=produce, daemon=True).start()
+            # Episodes are taken from the queue in season/episode order, one as
+            # soon as a download worker is free.
+            executor = ThreadPoolExecutor(max_workers=self.jobs)
+            try:
+                while True:
+                    free_workers.acquire()
+                    item = ready.get()
+                    if item is None:
+                        break
+                    executor.submit(worker, *item)
+                executor.shutdown()
+            except KeyboardInterrupt:
+                # Running downloads stop at their next chunk (their .part files
+                # are kept) and queued ones are dropped, without waiting here
+                self.stop()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        finally:
+            if resolver is not None:
+                resolver.shutdown(wait=False, cancel_futures=True)
+            self._stop_progress()
+
+        return self._report_failures(failures, total_episodes)
+
+    def _already_downloaded(self, episode_data):
+        if self.manifest is not None:
+            return self.manifest.is_complete(episode_data)
+        return os.path.exists(episode_data["output_path"])
+
+    def _report_failures(self, failures, total_episodes):
+        """Print the episodes that failed in episode order and return them"""
+        failures.sort(key=lambda f: f["index"])
+        if failures:
+            print(f"Failed to download {len(failures)} of {total_episodes} episodes:")
+            for failure in failures:
+                reason = f" ({failure['error']})" if failure["error"] else ""
+                print(f"  {failure['output_path']} <- {failure['url']}{reason}")
+        return failures
+
+    def enqueue_jobs(self, jobs, job_queue, from_catalog=False):
+        """Expand jobs (see `jobqueue.load_jobs`) into episode tasks in `job_queue`
+
+        Jobs expanded by an earlier run are not fetched again. With
+        `from_catalog` the episodes of titles in the catalog index are taken
+        from it instead of their series index. Returns the jobs whose episode
+        list could not be fetched.
+        """
+        failed = []
+        for job in jobs:
+            if job_queue.is_expanded(job):
+                logger.info(f"Job already queued: {job['url']}")
+                continue
+            title = None
+            if from_catalog and self.catalog is not None:
+                title = self.catalog.get(anime_name_from(job["url"]))
+            if title is not None:
+                planned = self._plan_from_links(
+                    title.links(),
+                    job["start_season"],
+                    job["start_episode"],
+                    job["include_films"],
+                )
+            else:
+                planned = self.plan_episodes(
+                    job["url"],
+                    job["start_season"],
+                    job["start_episode"],
+                    job["include_films"],
+                )
+            if planned is None:
+                failed.append(job)
+                continue
+            job_queue.add_job(job, planned)
+            logger.info(f"Queued {len(planned)} episodes from {job['url']}")
+        return failed
+
+    def run_queue(self, job_queue):
+        """Download the tasks of `job_queue` on `self.jobs` workers until it is empty
+
+        Other processes (on this or other hosts sharing the queue and the
+        download directory) may work on the same queue. The leases of the
+        running tasks are renewed in the background; tasks of a worker that
+        stopped are taken over once their lease runs out, and their .part files
+        let the downloads continue where they stopped. The run ends when no
+        task is pending or leased to another worker. Failed tasks go back to
+        the queue until they run out of attempts. Returns the tasks that
+        failed for good.
+        """
+        job_queue.reset_running()
+        counts = job_queue.counts()
+        total_episodes = sum(counts.values()) - counts.get("failed", 0)
+        counter = itertools.count(counts.get("done", 0) + 1)
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(job_queue.lease / 3):
+                try:
+                    job_queue.renew()
+                except sqlite3.Error as e:
+                    # Retried at the next beat, the lease has some slack
+                    logger.error(f"Could not renew leases: {e}")
+
+        def worker():
+            while not self._stopping.is_set():
+                task = job_queue.claim()
+                if task is None:
+                    expiry = job_queue.next_expiry()
+                    if expiry is None:
+                        return
+                    # Another worker still holds tasks: take them over if it
+                    # stops, or finish once it is done with them.
+                    stopped.wait(
+                        min(max(expiry - time.time(), 0), QUEUE_POLL_INTERVAL)
                     )
-                else:
+                    continue
+                current_episode = next(counter)
+                if self.concurrency is not None:
+                    self.concurrency.acquire()
+                try:
+                    success = self.download_episode(
+                        task["url"],
+                        task["output_path"],
+                        task["quality"],
+                        current_episode,
+                        total_episodes,
+                    )
+                    error = None if success else "download failed"
+                except Exception as e:
+                    error = str(e)
+                finally:
+                    if self.concurrency is not None:
+                        self.concurrency.release()
+
+                if self._stopping.is_set():
+                    # Handed back to the queue by run_queue
+                    return
+                if error is None:
+                    job_queue.complete(task)
+                    continue
+                status = job_queue.fail(task, error)
+                if status == "failed":
                     logger.error(
-                        f"Failed to download episode {current_episode}/{total_episodes}"
+                        f"Giving up on {task['output_path']} after "
+                        f"{task['attempts']} attempts: {error}"
                     )
+                elif status == "lost":
+                    logger.error(f"Lost the lease of {task['output_path']}: {error}")
+                else:
+                    logger.info(f"Will retry {task['output_path']} later: {error}")
+
+        self._start_progress()
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            workers = [
+                threading.Thread(target=worker, daemon=True) for _ in range(self.jobs)
+            ]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+        except KeyboardInterrupt:
+            # Running downloads stop at their next chunk (their .part files are
+            # kept), and their tasks can be taken over right away
+            self.stop()
+            released = job_queue.release()
+            if released:
+                logger.info(f"Returned {released} running tasks to the queue")
+            raise
+        finally:
+            stopped.set()
+            self._stop_progress()
+
+        failures = job_queue.failed()
+        if failures:
+            print(f"Failed to download {len(failures)} episodes:")
+            for failure in failures:
+                print(
+                    f"  {failure['output_path']} <- {failure['url']} "
+                    f"({failure['last_error']})"
+                )
+        return failures
+
+    def sync_title(self, series):
+        """Find the episodes of a followed title that are not downloaded yet
+
+        The index is requested with the ETag/Last-Modified of the previous
+        sync, so an unchanged index costs a 304 and no parsing. Only a changed
+        index is parsed, and its episodes are merged into the manifest. The
+        manifest then provides the wanted episodes that are not complete
+        (new ones and earlier failures). Returns None if the index could not
+        be fetched.
+        """
+        anime = series["anime"]
+        headers = {}
+        if series["digest"] is not None and self.manifest.has_title(anime):
+            if series["etag"]:
+                headers["If-None-Match"] = series["etag"]
+            if series["last_modified"]:
+                headers["If-Modified-Since"] = series["last_modified"]
+        try:
+            # Not through the page cache: it would hide new episodes for as long
+            # as the cached index is fresh, and its copies carry no validators
+            response = self.safe_request(
+                series["url"], headers=headers or None, cache=False
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error syncing {anime}: {e}")
+            return None
+
+        if response.status_code == 304:
+            self.manifest.record_check(anime)
+            changed = False
+        elif response.status_code == 200:
+            # Servers without validators still spare the parsing of an unchanged index
+            digest = hashlib.sha256(response.content).hexdigest()
+            changed = digest != series["digest"]
+            if changed:
+                with self.metrics.timer("parse", series["url"]):
+                    episodes = extract.episode_links(response.content, response.encoding)
+                if not episodes:
+                    logger.error(f"No episodes found in the index of {anime}")
+                    return None
+                self._plan_from_links(episodes, 1, 1, True)
+            self.manifest.record_check(
+                anime,
+                response.headers.get("etag"),
+                response.headers.get("last-modified"),
+                digest,
+                changed,
+            )
+        else:
+            logger.error(f"Error syncing {anime}: HTTP {response.status_code}")
+            return None
 
-                current_episode += 1
+        pending = []
+        for row in self.manifest.episodes(anime):
+            episode_data = {
+                "url": row["source_url"],
+                "name": row["anime"],
+                "season": row["season"],
+                "episode": os.path.basename(row["path"]),
+                "season_num": row["season_num"],
+                "episode_num": row["episode_num"],
+                "episode_type": row["episode_type"],
+                "output_path": row["path"],
+            }
+            if (
+                row["source_url"]
+                and self._is_wanted(
+                    episode_data,
+                    series["start_season"],
+                    series["start_episode"],
+                    series["include_films"],
+                )
+                and not self._already_downloaded(episode_data)
+            ):
+                pending.append(episode_data)
+        logger.info(
+            f"{anime}: index {'changed' if changed else 'unchanged'}, "
+            f"{len(pending)} episodes to download"
+        )
+        return pending
 
+    def sync_followed(self, names=None):
+        """Sync the followed titles (or the ones in `names`) and download what is new
 
-def main():
-    print("Starting Anime Downloader...")
-    downloader = AnimeDownloader()
+        Returns the episodes that failed to download.
+        """
+        failures = []
+        for series in self.manifest.followed():
+            if names is not None and series["anime"] not in names:
+                continue
+            pending = self.sync_title(series)
+            if pending is None:
+                print(f"{series['anime']}: could not fetch the episode list")
+                continue
+            if not pending:
+                print(f"{series['anime']}: up to date")
+                continue
+            print(f"{series['anime']}: {len(pending)} episodes to download")
+            failures += self._run_downloads(pending, series["quality"])
+        return failures
+
+    def watch(self, interval, jitter=0.2):
+        """Sync the followed titles forever, each one about every `interval` seconds
+
+        Every check schedules the next one of its title at a random point
+        within `jitter` (a fraction of `interval`) around the interval, so the
+        checks of many titles spread out instead of arriving together. The
+        schedule is kept in the manifest and survives restarts.
+        """
+        while True:
+            followed = self.manifest.followed()
+            if not followed:
+                logger.error("No followed titles, add some with the sync command")
+                return
+            now = time.time()
+            due = [series for series in followed if series["next_check"] <= now]
+            if not due:
+                next_check = min(series["next_check"] for series in followed)
+                # Titles followed in the meantime are noticed within an interval
+                time.sleep(min(next_check - now, interval))
+                continue
+            for series in due:
+                self.sync_followed([series["anime"]])
+                self.manifest.schedule(
+                    series["anime"],
+                    time.time() + interval * random.uniform(1 - jitter, 1 + jitter),
+                )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download anime from jut.su")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of episodes to download at the same time (default 1)",
+    )
+    parser.add_argument(
+        "-s",
+        "--segments",
+        type=int,
+        default=1,
+        help="number of parallel connections used for a single episode (default 1)",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=2,
+        help="number of episode pages resolved ahead of the downloads (default 2, 0 disables)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=3600,
+        help="seconds a cached page is used without asking the server (default 3600)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="maximum size of the page cache in MB (default 64)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not use the page cache"
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=parse_rate,
+        help="total download speed limit in bytes per second, e.g. 500K or 10M",
+    )
+    parser.add_argument(
+        "--page-rate",
+        type=float,
+        help="maximum number of page requests per second to the same host",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="start with one download and add more (up to --jobs) while the speed improves",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=parse_size,
+        default=CHUNK_SIZE,
+        help="size of the read/write buffer of each connection, e.g. 4M (default 1M)",
+    )
+    parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="flush downloads to disk before their resume state is saved and before "
+        "finished episodes are renamed into place",
+    )
+    parser.add_argument(
+        "--stall-rate",
+        type=parse_rate,
+        default=STALL_RATE,
+        help="hedge a video transfer through another route when it gets slower than "
+        "this many bytes per second, e.g. 16K; 0 turns it off (default 32K, "
+        "--engine threads)",
+    )
+    parser.add_argument(
+        "--stall-window",
+        type=float,
+        default=STALL_WINDOW,
+        help=f"seconds a transfer's speed is measured over (default {STALL_WINDOW})",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("threads", "async"),
+        default="threads",
+        help="run downloads on threads or on asyncio/aiohttp (needs the 'async' extra)",
+    )
+    parser.add_argument(
+        "--connections-per-host",
+        type=int,
+        default=16,
+        help="open connections per host with --engine async (default 16)",
+    )
+    parser.add_argument(
+        "--base-url",
+        default="https://jut.su",
+        help="address of the site, e.g. a local benchmark server (default https://jut.su)",
+    )
+    parser.add_argument(
+        "--stats",
+        help="write timings per phase and host of the run to this JSON file",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="keep a Prometheus text file with the metrics up to date during the run",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve the metrics for Prometheus at http://127.0.0.1:PORT/metrics",
+    )
+    parser.add_argument(
+        "--manifest",
+        default="downloads.db",
+        help="database that records downloaded episodes (default downloads.db)",
+    )
+    parser.add_argument(
+        "--catalog",
+        default="catalog.idx",
+        help="index of the site's titles written by 'crawl', used to look names up "
+        "(default catalog.idx)",
+    )
+
+    commands = parser.add_subparsers(dest="command")
+    status = commands.add_parser(
+        "status", help="show which episodes of a title are downloaded (no network)"
+    )
+    status.add_argument("title", help="anime URL or name")
+    status.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="rescan the download directory before showing the status",
+    )
+    commands.add_parser(
+        "duplicates",
+        help="list downloaded episodes with identical content, from their digests (no network)",
+    )
+    batch = commands.add_parser(
+        "batch", help="download the titles of a job file without any prompts"
+    )
+    batch.add_argument(
+        "job_file",
+        nargs="?",
+        help="JSON file with the titles to download (omit to only work on the queue)",
+    )
+    batch.add_argument(
+        "--queue",
+        default="jobs.db",
+        help="database holding the queued episodes (default jobs.db)",
+    )
+    batch.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="attempts per episode before it is given up (default 3)",
+    )
+    batch.add_argument(
+        "--lease",
+        type=float,
+        default=60,
+        help="seconds after which the episodes of a worker that stopped are taken over (default 60)",
+    )
+    batch.add_argument(
+        "--worker-id",
+        help="name of this worker in the queue (default HOSTNAME:PID)",
+    )
+    batch.add_argument(
+        "--from-catalog",
+        action="store_true",
+        help="take the episodes of the titles from the catalog index instead of their pages",
+    )
+    sync = commands.add_parser(
+        "sync",
+        help="follow titles and download their new episodes (all followed titles if none given)",
+    )
+    sync.add_argument("titles", nargs="*", metavar="TITLE", help="anime URL or name")
+    sync.add_argument(
+        "--quality",
+        default="1080",
+        choices=("1080", "720", "480", "360"),
+        help="quality of newly followed titles (default 1080)",
+    )
+    sync.add_argument(
+        "--from-season", type=int, default=1, help="first season to download (default 1)"
+    )
+    sync.add_argument(
+        "--from-episode",
+        type=int,
+        default=1,
+        help="first episode of the first season to download (default 1)",
+    )
+    sync.add_argument("--films", action="store_true", help="also download the films")
+    stream = commands.add_parser(
+        "stream", help="download one episode from its start and play it while it arrives"
+    )
+    stream.add_argument(
+        "episode", help="episode URL or path, e.g. naruuto/season-1/episode-3"
+    )
+    stream.add_argument(
+        "--quality",
+        default="1080",
+        choices=("1080", "720", "480", "360"),
+        help="video quality, lower ones are used if it is missing (default 1080)",
+    )
+    stream.add_argument(
+        "-o",
+        "--output",
+        help="write the video in order to this file or named pipe, '-' for stdout "
+        "(the default without --serve)",
+    )
+    stream.add_argument(
+        "--serve",
+        type=int,
+        metavar="PORT",
+        help="serve the video at http://127.0.0.1:PORT/ for a player (0 picks a port)",
+    )
+    crawl = commands.add_parser(
+        "crawl",
+        help="index the titles of the site's catalog (or only the given ones) for name lookups",
+    )
+    crawl.add_argument("titles", nargs="*", metavar="TITLE", help="anime URL or name")
+    crawl.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="pages loaded at the same time (default 8)",
+    )
+    crawl.add_argument(
+        "--qualities",
+        action="store_true",
+        help="also record the qualities of every title (one more page per title)",
+    )
+    search = commands.add_parser(
+        "search", help="look titles up in the catalog index (no network)"
+    )
+    search.add_argument("query", help="URL name, its beginning or a misspelled name")
+    search.add_argument(
+        "--limit", type=int, default=10, help="maximum number of titles shown (default 10)"
+    )
+    unfollow = commands.add_parser("unfollow", help="stop following a title")
+    unfollow.add_argument("title", help="anime URL or name")
+    watch = commands.add_parser(
+        "watch", help="keep syncing the followed titles on a schedule"
+    )
+    watch.add_argument(
+        "--interval",
+        type=float,
+        default=6 * 3600,
+        help="seconds between two checks of the same title (default 21600)",
+    )
+    watch.add_argument(
+        "--jitter",
+        type=float,
+        default=0.2,
+        help="random spread of the interval as a fraction of it (default 0.2)",
+    )
+    return parser.parse_args(argv)
+
+
+def anime_name_from(title):
+    """Name of an anime as used in jut.su URLs and download directories"""
+    if title.startswith("http"):
+        title = urlparse(title).path
+    return title.strip("/").split("/")[0]
+
+
+def show_status(args):
+    """Print the complete/partial/missing episodes of a title from the manifest"""
+    manifest = Manifest(args.manifest)
+    anime = anime_name_from(args.title)
+    if args.rebuild or not manifest.has_title(anime):
+        manifest.rebuild(anime)
+
+    rows = manifest.episodes(anime)
+    if not rows:
+        print(f"No episodes of {anime} are known yet.")
+        return
+
+    counts = {"complete": 0, "partial": 0, "missing": 0}
+    for row in rows:
+        counts[row["status"]] += 1
+        quality = f"{row['quality']}p" if row["quality"] else ""
+        size = tqdm.format_sizeof(row["size"], "B", 1024) if row["size"] else ""
+        print(f"  {row['path']:<45} {row['status']:<9} {quality:>6} {size:>9}")
+    print(
+        f"{anime}: {len(rows)} episodes, {counts['complete']} complete, "
+        f"{counts['partial']} partial, {counts['missing']} missing"
+    )
+
+
+def show_duplicates(args):
+    """Print groups of downloaded files with the same digest"""
+    groups = Manifest(args.manifest).duplicates()
+    if not groups:
+        print("No duplicate episodes found.")
+        return
+    wasted = 0
+    for checksum, rows in groups.items():
+        size = rows[0]["size"] or 0
+        wasted += size * (len(rows) - 1)
+        print(f"{checksum[:16]} ({tqdm.format_sizeof(size, 'B', 1024)}):")
+        for row in rows:
+            print(f"  {row['path']}")
+    print(
+        f"{len(groups)} sets of identical files, "
+        f"{tqdm.format_sizeof(wasted, 'B', 1024)} could be freed"
+    )
+
+
+def load_catalog(path):
+    """The catalog index at `path`, or None if it was not crawled yet"""
+    try:
+        return CatalogIndex.load(path)
+    except ValueError as e:
+        logger.error(f"Ignoring the catalog index: {e}")
+        return None
+
+
+def resolve_title(catalog, title):
+    """The URL name meant by a title typed by the user, looked up in the catalog
+
+    URLs, paths and names that are in the catalog are used as they are. A
+    name that only one title starts with resolves to that title; otherwise
+    the closest titles are suggested and the name is used as typed.
+    """
+    if catalog is None or title.startswith("http") or "/" in title.strip("/"):
+        return title
+    match, suggestions = catalog.resolve(title)
+    if match is None:
+        if suggestions:
+            print(
+                f"{title} is not in the catalog, similar titles: "
+                + ", ".join(suggestion.name for suggestion in suggestions)
+            )
+        return title
+    if match.name != title.strip("/"):
+        print(f"Using {match.name} ({match.title}) for {title}")
+    return match.name
+
+
+def describe_title(title):
+    """One line about a title of the catalog index"""
+    parts = [f"{title.seasons} seasons", f"{title.episodes} episodes"]
+    if title.films:
+        parts.append(f"{title.films} films")
+    if title.qualities:
+        parts.append(" ".join(f"{quality}p" for quality in title.qualities))
+    return f"{title.name:<32} {title.title:<32} {', '.join(parts)}"
+
+
+def show_search(args):
+    """Print the titles of the catalog index that match a query"""
+    catalog = load_catalog(args.catalog)
+    if catalog is None:
+        print("No catalog index yet: python main.py crawl")
+        return
+    titles = catalog.search(args.query, args.limit)
+    if not titles:
+        print(f"No titles match {args.query}.")
+        return
+    for title in titles:
+        print(f"  {describe_title(title)}")
+
+
+def run_crawl(downloader, args):
+    """Index the catalog (or the titles given on the command line) into --catalog"""
+    names = [anime_name_from(title) for title in args.titles] or None
+    entries, failed = crawl_catalog(downloader, names, args.concurrency, args.qualities)
+    if downloader.catalog is not None:
+        catalog = downloader.catalog.merge(entries)
+    else:
+        catalog = CatalogIndex.build(entries)
+    catalog.save(args.catalog)
+    downloader.catalog = catalog
+    episodes = sum(entry.episodes for entry in entries)
+    films = sum(entry.films for entry in entries)
+    print(
+        f"Indexed {len(entries)} titles ({episodes} episodes, {films} films); "
+        f"{args.catalog} holds {len(catalog)} titles in "
+        f"{tqdm.format_sizeof(os.path.getsize(args.catalog), 'B', 1024)}"
+    )
+    for name in failed:
+        print(f"  Could not index {name}")
+    return failed
+
+
+def unfollow_title(args):
+    anime = anime_name_from(args.title)
+    if Manifest(args.manifest).unfollow(anime):
+        print(f"No longer following {anime}.")
+    else:
+        print(f"{anime} is not followed.")
+
+
+def run_sync(downloader, args):
+    """Follow the titles given on the command line, then sync them (or all followed ones)"""
+    names = None
+    if args.titles:
+        names = set()
+        for title in args.titles:
+            anime = anime_name_from(resolve_title(downloader.catalog, title))
+            downloader.manifest.follow(
+                anime,
+                f"{downloader.base_url}/{anime}/",
+                args.quality,
+                args.from_season,
+                args.from_episode,
+                args.films,
+            )
+            names.add(anime)
+    elif not downloader.manifest.followed():
+        print("No followed titles yet: python main.py sync TITLE")
+        return []
+    return downloader.sync_followed(names)
+
+
+def run_stream(downloader, args, sink=None):
+    """Download one episode in order and hand it to a player while it arrives
+
+    The video goes to `sink` (or the file or named pipe of --output) and/or is
+    served over HTTP. With --serve the file stays available after the download
+    until Ctrl+C.
+    """
+    url = args.episode
+    if not url.startswith("http"):
+        url = f"{downloader.base_url}/{url.strip('/')}"
+    if not url.endswith(".html") and url.count("/") > 3:
+        url += ".html"
+    info = downloader.extract_episode_info(urlparse(url).path)
+    if info is None:
+        return [url]
+    output_path = (
+        f"{info['anime_name']}/{info['season']}/"
+        f"{info['episode_type']}-{info['episode_num']}.mp4"
+    )
+
+    def first_byte(seconds):
+        downloader.metrics.observe("seconds", seconds, "playable", host_of(url))
+        tqdm.write(f"First playable byte after {seconds:.2f}s")
+
+    growing = GrowingFile(first_byte)
+    server = None
+    if args.serve is not None:
+        server = StreamServer(growing, args.serve, os.path.basename(output_path)).start()
+        print(f"Streaming {output_path} at {server.url}")
+
+    piping = None
+    if args.output:
+        def write():
+            if sink is not None:
+                pipe(growing, sink)
+                return
+            # Opening a named pipe waits for the player to open the other end
+            with open(args.output, "wb") as f:
+                pipe(growing, f)
+
+        piping = threading.Thread(target=write, daemon=True)
+        piping.start()
 
+    try:
+        success = downloader.download_episode(
+            url, output_path, args.quality, 1, 1, stream=growing
+        )
+        growing.finish(None if success else "download failed")
+        if piping is not None:
+            piping.join()
+        if server is not None and success:
+            print(f"{output_path} is complete, still serving it. Press Ctrl+C to stop.")
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        growing.finish(growing.error)
+        if server is not None:
+            server.stop()
+        growing.close()
+    return [] if success else [url]
+
+
+def run_interactive(downloader):
+    """Ask for a title, quality and starting point, then download it"""
     # Get anime URL
-    url = input("Enter anime URL or name: ")
+    url = resolve_title(downloader.catalog, input("Enter anime URL or name: "))
     if not url.startswith("http"):
-        url = f"https://jut.su/{url}"
+        url = f"{downloader.base_url}/{url}"
 
     print(f"Getting information about {url}...")
 
@@ -490,7 +2087,7 @@ def main():
 
     # Get available qualities from the last episode
     print("Getting quality information...")
-    last_episode_url = f"https://jut.su{episodes[-1]['href']}"
+    last_episode_url = f"{downloader.base_url}{episodes[-1]['href']}"
     qualities = downloader.get_available_qualities(last_episode_url)
 
     if not qualities:
@@ -533,8 +2130,162 @@ def main():
     else:
         print("Movies will not be downloaded")
 
-    downloader.download_anime(url, quality, start_season, start_episode, include_films)
-    print("Download finished!")
+    return downloader.download_anime(
+        url, quality, start_season, start_episode, include_films
+    )
+
+
+def print_timings(summary):
+    """Print where the time of a run went, one line per phase"""
+    phases = summary["phases"]
+    if not phases:
+        return
+    print("Time per phase:")
+    for phase, values in phases.items():
+        seconds = values.get("seconds")
+        if not seconds:
+            continue
+        line = (
+            f"  {phase:<12} {seconds['count']:>5} x, p50 {seconds['p50']:.3f}s, "
+            f"p90 {seconds['p90']:.3f}s, total {seconds['sum']:.1f}s"
+        )
+        rate = values.get("bytes_per_second")
+        if rate:
+            line += f", {tqdm.format_sizeof(rate['p50'], 'B/s', 1024)} median"
+        retries = values.get("retries")
+        if retries and retries["sum"]:
+            line += f", {retries['sum']:.0f} retries"
+        if values.get("errors"):
+            line += f", {values['errors']} errors"
+        if values.get("stalls"):
+            line += f", {values['stalls']} stalls"
+        if values.get("failovers"):
+            line += f", {values['failovers']} failovers"
+        print(line)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "status":
+        show_status(args)
+        return
+    if args.command == "duplicates":
+        show_duplicates(args)
+        return
+    if args.command == "unfollow":
+        unfollow_title(args)
+        return
+    if args.command == "search":
+        show_search(args)
+        return
+    if args.command == "crawl" and args.page_rate is None:
+        # Be polite when loading the whole catalog
+        args.page_rate = CRAWL_PAGE_RATE
+
+    sink = None
+    if args.command == "stream" and args.output is None and args.serve is None:
+        args.output = "-"
+    if args.command == "stream" and args.output == "-":
+        # The video goes to stdout, everything else to stderr
+        sink = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    print("Starting Anime Downloader...")
+    metrics = Metrics()
+    metrics.start_export(args.metrics_file, args.metrics_port)
+    page_cache = None
+    if not args.no_cache:
+        page_cache = PageCache(
+            ttl=args.cache_ttl, max_size=args.cache_size * 1024 * 1024
+        )
+    engine = AnimeDownloader
+    options = {}
+    if args.engine == "async":
+        # Imported here: aiohttp is optional and async_engine builds on this module
+        from async_engine import AsyncAnimeDownloader
+
+        engine = AsyncAnimeDownloader
+        options["connections_per_host"] = args.connections_per_host
+    downloader = engine(
+        jobs=args.jobs,
+        segments=args.segments,
+        lookahead=args.lookahead,
+        page_cache=page_cache,
+        manifest=Manifest(args.manifest),
+        catalog=load_catalog(args.catalog),
+        max_rate=args.max_rate,
+        page_rate=args.page_rate,
+        adaptive=args.adaptive,
+        buffer_size=args.buffer_size,
+        fsync=args.fsync,
+        base_url=args.base_url,
+        metrics=metrics,
+        stall_rate=args.stall_rate,
+        stall_window=args.stall_window,
+        **options,
+    )
+
+    if args.command == "batch":
+        job_queue = JobQueue(
+            args.queue,
+            max_attempts=args.max_attempts,
+            lease=args.lease,
+            worker_id=args.worker_id,
+        )
+        try:
+            if args.job_file:
+                downloader.enqueue_jobs(
+                    load_jobs(args.job_file, downloader.base_url),
+                    job_queue,
+                    args.from_catalog,
+                )
+            failures = downloader.run_queue(job_queue)
+        finally:
+            job_queue.close()
+    elif args.command == "sync":
+        failures = run_sync(downloader, args)
+    elif args.command == "stream":
+        failures = run_stream(downloader, args, sink)
+    elif args.command == "crawl":
+        failures = run_crawl(downloader, args)
+    elif args.command == "watch":
+        print("Watching followed titles, press Ctrl+C to stop")
+        downloader.watch(args.interval, args.jitter)
+        failures = []
+    else:
+        failures = run_interactive(downloader)
+    if failures:
+        print("Download finished with errors, see the list above.")
+    else:
+        print("Download finished!")
+
+    if page_cache is not None:
+        stats = page_cache.stats()
+        print(
+            f"Page cache: {stats['hits']} hits, {stats['revalidated']} revalidated, "
+            f"{stats['misses']} misses"
+        )
+
+    print_timings(metrics.summary())
+    if args.stats:
+        metrics.write_summary(args.stats)
+    metrics.close(args.metrics_file)
+
+    if downloader.proxy_pool is not None:
+        print("Proxies:")
+        for proxy in downloader.proxy_pool.stats():
+            latency = f"{proxy['latency']:.2f}s" if proxy["latency"] is not None else "-"
+            throughput = (
+                tqdm.format_sizeof(proxy["throughput"], "B/s", 1024)
+                if proxy["throughput"]
+                else "-"
+            )
+            print(
+                f"  {proxy['url']}: {proxy['state']}, latency {latency}, "
+                f"{throughput}, {proxy['requests']} requests, "
+                f"{proxy['failures']} failures, {proxy['stalls']} stalls, "
+                f"{proxy['failovers']} failovers"
+            )
 
 
 if __name__ == "__main__":
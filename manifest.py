@@ -0,0 +1,327 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from integrity import read_digest
+
+EPISODE_FILE = re.compile(r"^(episode|film)-(\d+)\.mp4$")
+
+
+class Manifest:
+    """Local database of the episodes of every title and their download state
+
+    There is one row per (anime, season, episode_type, episode_num). A row is
+    "missing" when the episode is known from a series index but not on disk,
+    "partial" while a .part file exists and "complete" once the episode is
+    downloaded. The rows can always be rebuilt from the download directories.
+
+    Followed titles live in the "series" table, together with the validators
+    and digest of their index at the last sync and when to check them next.
+    """
+
+    def __init__(self, path="downloads.db"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS episodes (
+                anime TEXT NOT NULL,
+                season TEXT NOT NULL,
+                episode_type TEXT NOT NULL,
+                episode_num INTEGER NOT NULL,
+                season_num INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                path TEXT NOT NULL,
+                quality TEXT,
+                size INTEGER,
+                checksum TEXT,
+                source_url TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (anime, season, episode_type, episode_num)
+            )
+            """
+        )
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS series (
+                anime TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                start_season INTEGER NOT NULL,
+                start_episode INTEGER NOT NULL,
+                include_films INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                digest TEXT,
+                checked_at REAL,
+                changed_at REAL,
+                next_check REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(episode):
+        """Primary key of an episode
+
+        Accepts `extract_episode_info` results ("anime_name"), planned episodes
+        ("name") and manifest rows ("anime").
+        """
+        anime = episode.get("anime_name") or episode.get("name") or episode["anime"]
+        return (
+            anime,
+            episode["season"],
+            episode["episode_type"],
+            episode["episode_num"],
+        )
+
+    def get(self, episode):
+        """Return the row of an episode, or None if it was never seen"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM episodes WHERE anime = ? AND season = ? "
+                "AND episode_type = ? AND episode_num = ?",
+                self.key(episode),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_complete(self, episode):
+        """Whether an episode is recorded as complete and its file still exists"""
+        row = self.get(episode)
+        return row is not None and row["status"] == "complete" and os.path.exists(
+            row["path"]
+        )
+
+    def has_title(self, anime):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM episodes WHERE anime = ? LIMIT 1", (anime,)
+            ).fetchone()
+        return row is not None
+
+    def add_known(self, episodes):
+        """Record episodes found in a series index; existing rows keep their state"""
+        now = time.time()
+        with self._lock:
+            for episode in episodes:
+                self._db.execute(
+                    "INSERT INTO episodes (anime, season, episode_type, episode_num, "
+                    "season_num, status, path, source_url, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, 'missing', ?, ?, ?, ?) "
+                    "ON CONFLICT (anime, season, episode_type, episode_num) "
+                    "DO UPDATE SET source_url = excluded.source_url",
+                    (
+                        *self.key(episode),
+                        episode["season_num"],
+                        episode["output_path"],
+                        episode["url"],
+                        now,
+                        now,
+                    ),
+                )
+            self._db.commit()
+
+    def record(
+        self,
+        episode,
+        status,
+        path,
+        quality=None,
+        size=None,
+        checksum=None,
+        source_url=None,
+    ):
+        """Create or update the row of an episode"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO episodes (anime, season, episode_type, episode_num, "
+                "season_num, status, path, quality, size, checksum, source_url, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (anime, season, episode_type, episode_num) "
+                "DO UPDATE SET status = excluded.status, "
+                "path = excluded.path, "
+                "quality = COALESCE(excluded.quality, quality), "
+                "size = excluded.size, "
+                "checksum = COALESCE(excluded.checksum, checksum), "
+                "source_url = COALESCE(excluded.source_url, source_url), "
+                "updated_at = excluded.updated_at",
+                (
+                    *self.key(episode),
+                    episode["season_num"],
+                    status,
+                    path,
+                    quality,
+                    size,
+                    checksum,
+                    source_url,
+                    now,
+                    now,
+                ),
+            )
+            self._db.commit()
+
+    def record_file(self, episode, path, quality=None, source_url=None, checksum=None):
+        """Record an episode as complete or partial depending on what is on disk
+
+        Without `checksum` the digest stored next to the file is used, if any.
+        """
+        if os.path.exists(path):
+            self.record(
+                episode,
+                "complete",
+                path,
+                quality=quality,
+                size=os.path.getsize(path),
+                checksum=checksum or read_digest(path),
+                source_url=source_url,
+            )
+        elif os.path.exists(f"{path}.part"):
+            self.record(
+                episode,
+                "partial",
+                path,
+                quality=quality,
+                size=_part_written(f"{path}.part"),
+                source_url=source_url,
+            )
+
+    def episodes(self, anime):
+        """All rows of a title in season/episode order"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM episodes WHERE anime = ? "
+                "ORDER BY episode_type = 'film', season_num, episode_num",
+                (anime,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def duplicates(self):
+        """Complete episodes with the same checksum, grouped by checksum"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM episodes WHERE status = 'complete' AND checksum IN ("
+                "SELECT checksum FROM episodes WHERE status = 'complete' "
+                "AND checksum IS NOT NULL GROUP BY checksum HAVING COUNT(*) > 1"
+                ") ORDER BY checksum, anime, path"
+            ).fetchall()
+        groups = {}
+        for row in rows:
+            groups.setdefault(row["checksum"], []).append(dict(row))
+        return groups
+
+    def rebuild(self, anime):
+        """Bring the rows of a title in line with its download directory
+
+        Finished files become "complete", .part files "partial", and rows whose
+        file disappeared fall back to "missing". Returns the number of files found.
+        """
+        found = set()
+        if os.path.isdir(anime):
+            for season in sorted(os.listdir(anime)):
+                season_dir = os.path.join(anime, season)
+                if not os.path.isdir(season_dir):
+                    continue
+                if season == "films":
+                    season_num = 0
+                elif season.startswith("season-") and season[7:].isdigit():
+                    season_num = int(season[7:])
+                else:
+                    continue
+
+                for name in sorted(os.listdir(season_dir)):
+                    match = EPISODE_FILE.match(name.removesuffix(".part"))
+                    if not match:
+                        continue
+                    episode = {
+                        "anime_name": anime,
+                        "season": season,
+                        "season_num": season_num,
+                        "episode_type": match.group(1),
+                        "episode_num": int(match.group(2)),
+                    }
+                    if self.key(episode) in found:
+                        continue
+                    found.add(self.key(episode))
+                    self.record_file(episode, f"{anime}/{season}/{match.group(0)}")
+
+        for row in self.episodes(anime):
+            if self.key(row) not in found and row["status"] != "missing":
+                self.record(row, "missing", row["path"])
+        return len(found)
+
+    def follow(self, anime, url, quality, start_season=1, start_episode=1, include_films=False):
+        """Add a title to the followed ones, or update its settings"""
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO series (anime, url, quality, start_season, start_episode, "
+                "include_films) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (anime) DO UPDATE SET url = excluded.url, "
+                "quality = excluded.quality, start_season = excluded.start_season, "
+                "start_episode = excluded.start_episode, "
+                "include_films = excluded.include_films",
+                (anime, url, quality, start_season, start_episode, int(include_films)),
+            )
+            self._db.commit()
+
+    def unfollow(self, anime):
+        """Stop following a title; returns whether it was followed"""
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM series WHERE anime = ?", (anime,))
+            self._db.commit()
+        return cursor.rowcount > 0
+
+    def followed(self):
+        """Rows of all followed titles, the ones due first"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM series ORDER BY next_check, anime"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def record_check(self, anime, etag=None, last_modified=None, digest=None, changed=False):
+        """Remember the index of a title as seen by a sync
+
+        Unchanged indexes (304 or the same digest) keep the stored validators.
+        """
+        now = time.time()
+        with self._lock:
+            if changed:
+                self._db.execute(
+                    "UPDATE series SET etag = ?, last_modified = ?, digest = ?, "
+                    "checked_at = ?, changed_at = ? WHERE anime = ?",
+                    (etag, last_modified, digest, now, now, anime),
+                )
+            else:
+                self._db.execute(
+                    "UPDATE series SET checked_at = ? WHERE anime = ?", (now, anime)
+                )
+            self._db.commit()
+
+    def schedule(self, anime, next_check):
+        """Set when the watch loop checks a title again"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE series SET next_check = ? WHERE anime = ?", (next_check, anime)
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _part_written(part_path):
+    """Bytes already downloaded into a .part file according to its sidecar"""
+    try:
+        with open(f"{part_path}.json", "r") as f:
+            state = json.load(f)
+        return sum(segment["written"] for segment in state["segments"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
@@ -0,0 +1,239 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from lazy import LazyImport, logger
+
+# Only needed when the metrics are served over HTTP
+http_server = LazyImport("http.server")
+
+# Upper bounds of the histogram buckets for each kind of measurement
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+)
+RATE_BUCKETS = tuple(2**n for n in range(14, 31))  # 16 KiB/s .. 1 GiB/s
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10)
+BUCKETS = {
+    "seconds": SECONDS_BUCKETS,
+    "bytes_per_second": RATE_BUCKETS,
+    "retries": COUNT_BUCKETS,
+    "proxy_switches": COUNT_BUCKETS,
+}
+PREFIX = "anime_downloader"
+
+
+def host_of(url):
+    """Host part of a URL, used as the "host" label"""
+    return urlparse(url).netloc or url
+
+
+class Histogram:
+    """Counts of observations per bucket plus their sum, minimum and maximum"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[index - 1] if index > 0 else self.min
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                lower = max(lower, self.min)
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """Histograms and counters per phase and host of a run
+
+    Phases are the steps a download goes through: "proxy_check", "page"
+    (fetching an HTML page), "parse", "resolve" (finding the video of an
+    episode), "head", "ttfb" (until the headers of a video arrive) and
+    "transfer" (streaming the body). Histograms hold durations, transfer
+    rates and the retries and proxy switches per request; counters hold
+    totals such as bytes, errors, stalls and failovers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._stop = threading.Event()
+        self._server = None
+
+    def observe(self, name, value, phase, host=""):
+        key = (name, phase, host)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(BUCKETS[name])
+            histogram.observe(value)
+
+    def increment(self, name, phase, host="", amount=1):
+        key = (name, phase, host)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, phase, url=""):
+        """Record the duration of the block under `phase` and the host of `url`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("seconds", time.perf_counter() - started, phase, host_of(url))
+
+    def summary(self):
+        """Everything recorded so far, per phase (all hosts) and per host"""
+        with self._lock:
+            histograms = dict(self._histograms)
+            counters = dict(self._counters)
+
+        phases = {}
+        hosts = {}
+        merged = {}
+        for (name, phase, host), histogram in sorted(histograms.items()):
+            total = merged.setdefault((name, phase), Histogram(histogram.bounds))
+            total.merge(histogram)
+            hosts.setdefault(host, {}).setdefault(phase, {})[name] = histogram.summary()
+        for (name, phase), histogram in merged.items():
+            phases.setdefault(phase, {})[name] = histogram.summary()
+        for (name, phase, host), value in sorted(counters.items()):
+            phase_counters = phases.setdefault(phase, {})
+            phase_counters[name] = phase_counters.get(name, 0) + value
+            hosts.setdefault(host, {}).setdefault(phase, {})[name] = value
+        return {"phases": phases, "hosts": hosts}
+
+    def write_summary(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        declared = set()
+        for (name, phase, host), histogram in histograms:
+            metric = f"{PREFIX}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            labels = f'phase="{phase}",host="{host}"'
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        for (name, phase, host), value in counters:
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f'{metric}{{phase="{phase}",host="{host}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the metrics to a file atomically (e.g. for the node_exporter textfile collector)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def start_export(self, path=None, port=None, interval=10):
+        """Keep the metrics available while the run is in progress
+
+        With `path` the Prometheus text file is rewritten every `interval`
+        seconds; with `port` it is served at http://127.0.0.1:<port>/metrics.
+        """
+        if path:
+            def export():
+                while not self._stop.wait(interval):
+                    self.write_prometheus(path)
+
+            threading.Thread(target=export, daemon=True).start()
+        if port:
+            self._server = http_server.ThreadingHTTPServer(
+                ("127.0.0.1", port), _handler(self)
+            )
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            logger.info(f"Serving metrics at http://127.0.0.1:{port}/metrics")
+
+    def close(self, path=None):
+        """Stop exporting; writes the final state to `path` when given"""
+        self._stop.set()
+        if path:
+            self.write_prometheus(path)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _handler(metrics):
+    class Handler(http_server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
@@ -0,0 +1,235 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy import logger
+
+# Weight of a new sample in the moving averages of latency and throughput
+EWMA_ALPHA = 0.3
+# Amount of data a request is assumed to move when comparing throughputs
+REFERENCE_BYTES = 1024 * 1024
+
+
+class Proxy:
+    """A proxy with its measured performance and circuit breaker state
+
+    A proxy is "unchecked" until its first test. Then the breaker is "closed"
+    while the proxy works, "open" after `failure_threshold` consecutive
+    failures (no traffic is routed to it) and "half-open" while a background
+    re-test is running.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.state = "unchecked"
+        self.latency = None
+        self.throughput = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        # Transfers that slowed to a trickle, and transfers moved to another
+        # route after stalling or failing half-way
+        self.stalls = 0
+        self.failovers = 0
+        self.opened_at = None
+
+    def cost(self):
+        """Expected time to serve one more request; lower is better"""
+        latency = self.latency if self.latency is not None else 1.0
+        transfer = REFERENCE_BYTES / self.throughput if self.throughput else 0.0
+        return (latency + transfer) * (1 + self.in_flight)
+
+    def as_dict(self):
+        return {
+            "url": self.url,
+            "state": self.state,
+            "latency": self.latency,
+            "throughput": self.throughput,
+            "requests": self.requests,
+            "failures": self.failures,
+            "stalls": self.stalls,
+            "failovers": self.failovers,
+        }
+
+
+def _ewma(current, sample):
+    return sample if current is None else current + EWMA_ALPHA * (sample - current)
+
+
+class ProxyPool:
+    """Routes requests to the best healthy proxy from a list
+
+    `check` is called with a proxy URL and must return the latency of a test
+    request through it, or raise if the proxy does not work. All proxies are
+    checked concurrently by `health_check_all`, which `start` runs in the
+    background; `acquire` waits until a proxy has passed or all have failed.
+    Proxies whose breaker has opened are re-tested in the background every
+    `retest_interval` seconds.
+    """
+
+    def __init__(self, urls, check, failure_threshold=3, retest_interval=60):
+        self.proxies = [Proxy(url) for url in urls]
+        self.check = check
+        self.failure_threshold = failure_threshold
+        self.retest_interval = retest_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # Set once the first check has passed, or all of them have failed
+        self._ready = threading.Event()
+        self._retester = None
+
+    def health_check_all(self):
+        """Test every proxy at the same time; returns the number of working ones"""
+        if not self.proxies:
+            self._ready.set()
+            return 0
+        with ThreadPoolExecutor(max_workers=min(32, len(self.proxies))) as executor:
+            list(executor.map(self._test, self.proxies))
+        self._ready.set()
+        healthy = self.healthy_count()
+        logger.info(f"{healthy} of {len(self.proxies)} proxies are working")
+        if not healthy:
+            logger.info("No working proxies found. Continuing without proxies.")
+        return healthy
+
+    def _test(self, proxy):
+        try:
+            latency = self.check(proxy.url)
+        except Exception as e:
+            logger.info(f"Proxy {proxy.url} is not working: {e}")
+            with self._lock:
+                proxy.state = "open"
+                proxy.opened_at = time.monotonic()
+            return False
+        with self._lock:
+            proxy.state = "closed"
+            proxy.consecutive_failures = 0
+            proxy.latency = _ewma(proxy.latency, latency)
+        self._ready.set()
+        logger.info(f"Proxy {proxy.url} is working, latency {latency:.2f}s")
+        return True
+
+    def start(self):
+        """Check all proxies and then re-test tripped ones, in the background"""
+        if self._retester is None and self.proxies:
+            self._retester = threading.Thread(target=self._retest_loop, daemon=True)
+            self._retester.start()
+
+    def _retest_loop(self):
+        self.health_check_all()
+        while not self._stop.wait(self.retest_interval):
+            now = time.monotonic()
+            with self._lock:
+                due = [
+                    proxy
+                    for proxy in self.proxies
+                    if proxy.state == "open"
+                    and now - proxy.opened_at >= self.retest_interval
+                ]
+                for proxy in due:
+                    proxy.state = "half-open"
+            for proxy in due:
+                self._test(proxy)
+
+    def close(self):
+        self._stop.set()
+
+    def wait_ready(self, timeout=None):
+        """Wait for the first check started by `start`; False on timeout"""
+        if self._retester is None:
+            return True
+        return self._ready.wait(timeout)
+
+    def healthy_count(self):
+        with self._lock:
+            return sum(proxy.state == "closed" for proxy in self.proxies)
+
+    def acquire(self, exclude=None):
+        """Pick the healthy proxy with the lowest expected cost (None if there is none)
+
+        The proxy counts as busy until it is handed back with `release`, so
+        concurrent workers are spread over different proxies. Right after
+        `start` this waits until a proxy has passed its check or all have failed.
+        `exclude` is a proxy that must not be picked, e.g. one a transfer is
+        being moved away from.
+        """
+        self.wait_ready()
+        with self._lock:
+            healthy = [
+                proxy
+                for proxy in self.proxies
+                if proxy.state == "closed" and proxy is not exclude
+            ]
+            if not healthy:
+                return None
+            proxy = min(healthy, key=Proxy.cost)
+            proxy.in_flight += 1
+            return proxy
+
+    def hold(self, proxy):
+        """Mark `proxy` as busy, e.g. while a response body is streamed through it"""
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.in_flight += 1
+
+    def release(self, proxy):
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.in_flight -= 1
+
+    def record_success(self, proxy, latency=None):
+        """Report a request that went through `proxy` successfully"""
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.requests += 1
+            proxy.consecutive_failures = 0
+            if latency is not None:
+                proxy.latency = _ewma(proxy.latency, latency)
+
+    def record_failure(self, proxy):
+        """Report a failed request; trips the breaker after repeated failures"""
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.requests += 1
+            proxy.failures += 1
+            proxy.consecutive_failures += 1
+            if (
+                proxy.state == "closed"
+                and proxy.consecutive_failures >= self.failure_threshold
+            ):
+                proxy.state = "open"
+                proxy.opened_at = time.monotonic()
+                logger.error(
+                    f"Proxy {proxy.url} failed {proxy.consecutive_failures} times "
+                    "in a row, taking it out of rotation"
+                )
+
+    def record_transfer(self, proxy, size, seconds):
+        """Report the throughput of a body streamed through `proxy`"""
+        if proxy is None or seconds <= 0 or not size:
+            return
+        with self._lock:
+            proxy.throughput = _ewma(proxy.throughput, size / seconds)
+
+    def record_stall(self, proxy):
+        """Report a transfer through `proxy` that slowed to a trickle"""
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.stalls += 1
+
+    def record_failover(self, proxy):
+        """Report a transfer that was moved from `proxy` to another route"""
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.failovers += 1
+
+    def stats(self):
+        with self._lock:
+            return [proxy.as_dict() for proxy in self.proxies]
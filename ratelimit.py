@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from lazy import logger
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter for the given (0-based) retry attempt"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retry_after(headers, cap=60.0):
+    """Seconds to wait according to a Retry-After header (None if absent or a date)"""
+    value = headers.get("retry-after", "")
+    if not value.strip().isdigit():
+        return None
+    return min(cap, float(value))
+
+
+def parse_size(value):
+    """Parse a size such as "64K", "4M" or "1.5G" (bytes)"""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().removesuffix("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def parse_rate(value):
+    """Parse a rate such as "500K", "10M" or "1.5G" (bytes per second)"""
+    return parse_size(value.strip().upper().removesuffix("/S"))
+
+
+class TokenBucket:
+    """Caps the total number of bytes per second across all threads
+
+    A consumer may take more tokens than are available; it then sleeps for
+    as long as the bucket needs to pay the debt back, which keeps the
+    average rate at `rate` even with large chunks.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    def reserve(self, amount):
+        """Take `amount` tokens and return how long the caller must wait (seconds)"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class HostRateLimiter:
+    """Spaces requests to the same host at least 1/`rate` seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        delay = self.reserve(url)
+        if delay:
+            time.sleep(delay)
+
+    def reserve(self, url):
+        """Book the next slot for the host of `url`; returns the seconds until it"""
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        return start - now
+
+
+class AIMDController:
+    """Adapts the number of parallel transfers to what the network sustains
+
+    Works like a semaphore whose size changes: every `window` seconds the
+    total throughput is compared with the previous window, and the limit
+    grows by one while it keeps improving (additive increase). An error or
+    a 429/503 answer halves the limit (multiplicative decrease), at most
+    once per window so that a burst of errors does not collapse it.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=1, window=10.0, gain=1.05):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = max(minimum, min(initial, maximum))
+        self.window = window
+        self.gain = gain
+        self._active = 0
+        self._bytes = 0
+        self._window_start = time.monotonic()
+        self._last_throughput = None
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def record_bytes(self, amount):
+        """Account transferred bytes and re-evaluate the limit once per window"""
+        with self._condition:
+            self._bytes += amount
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.window:
+                return
+            throughput = self._bytes / elapsed
+            self._bytes = 0
+            self._window_start = now
+
+            # Only grow when the current limit is actually used
+            if self._active >= self.limit and self.limit < self.maximum and (
+                self._last_throughput is None
+                or throughput > self._last_throughput * self.gain
+            ):
+                self.limit += 1
+                logger.info(
+                    f"Throughput improving, raising parallel transfers to {self.limit}"
+                )
+                self._condition.notify_all()
+            self._last_throughput = throughput
+
+    def on_error(self):
+        """Cut the limit in half after an error or a throttling answer"""
+        with self._condition:
+            now = time.monotonic()
+            if (
+                self._last_decrease is not None
+                and now - self._last_decrease < self.window
+            ):
+                return
+            self._last_decrease = now
+            limit = max(self.minimum, self.limit // 2)
+            if limit < self.limit:
+                logger.info(
+                    f"Server is struggling, lowering parallel transfers to {limit}"
+                )
+            self.limit = limit
+            # The throughput of the old window is no longer comparable
+            self._last_throughput = None
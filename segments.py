@@ -0,0 +1,418 @@
+import threading
+import time
+
+from diskio import abort, fsync_path, stream_into
+from integrity import BlockHasher, IntegrityError, is_mp4_start
+from lazy import LazyImport, logger
+from metrics import host_of
+from stalls import CHECK_INTERVAL, MAX_HEDGES, Route, StallWatchdog, Transfer
+
+# Only needed when a transfer fails
+requests = LazyImport("requests")
+
+# How often the resume state of a .part file is written to its sidecar
+STATE_SAVE_INTERVAL = 8 * 1024 * 1024
+# Times a segment whose connection fails half-way continues through another route
+MAX_FAILOVERS = 3
+
+
+class RangeNotSupported(Exception):
+    """The server ignored a Range request and answered with the whole file"""
+
+
+class SegmentFetcher:
+    """Fetches the segments of one download into its .part file
+
+    `fetch` streams one segment and may run in several threads at once, one
+    per segment. Each segment writes through its own file object, hashes what
+    it writes and keeps its progress in a stalls.Transfer until `publish`
+    copies it into the shared `state`: only after a flush, because every
+    segment saves the whole sidecar.
+
+    A segment whose transfer slows to a trickle is raced by a hedged request
+    for the rest of its range through another proxy (or a new direct
+    connection), started by the StallWatchdog. The hedge only hashes what it
+    reads; once it has caught up with the segment it hands its route over
+    and the segment continues through it. A segment whose connection fails
+    half-way continues from the same byte through another route, up to
+    MAX_FAILOVERS times. Either way the bytes already written are kept.
+
+    Setting `cancel` stops every segment at its next chunk.
+    """
+
+    def __init__(
+        self, downloader, video_url, part_path, state_path, state, progress, streaming=False
+    ):
+        self.downloader = downloader
+        self.video_url = video_url
+        self.part_path = part_path
+        self.state_path = state_path
+        self.state = state
+        self.progress = progress
+        self.streaming = streaming
+        self.cancel = threading.Event()
+        self.host = host_of(video_url)
+        self._state_lock = threading.Lock()
+        # A trickle must show up as the bytes it brings, not as one read that
+        # waits a whole window for the buffer to fill like a dead connection
+        self.interval = CHECK_INTERVAL if downloader.stall_rate else None
+        self.watchdog = None
+        if downloader.stall_rate:
+            self.watchdog = StallWatchdog(
+                downloader.stall_rate,
+                downloader.stall_window,
+                self._stalled,
+                self._cancel_hedge,
+            )
+
+    def fetch(self, segment, response=None):
+        """Fetch the rest of `segment`, through `response` if it is already open"""
+        if self.cancel.is_set():
+            # Another segment failed or the download was stopped before this
+            # one started; don't open a connection for it
+            if response is not None:
+                response.close()
+            return
+        position = segment["start"] + segment["written"]
+        if response is None:
+            response = self.open_range(segment, position)
+        # Hashed as the data is written, so the file is never read back
+        transfer = Transfer(
+            segment,
+            self._open_route(response),
+            BlockHasher(list(segment["hashes"])),
+            position,
+        )
+        if self.watchdog is not None:
+            self.watchdog.add(transfer)
+        started = time.monotonic()
+        try:
+            with open(self.part_path, "r+b", buffering=self.downloader.buffer_size) as f:
+                f.seek(position)
+                complete = self._transfer(transfer, f)
+        finally:
+            self._end(transfer)
+            self._record_metrics(transfer, time.monotonic() - started)
+
+        if not complete:
+            return
+        if segment["end"] is None:
+            segment["end"] = segment["start"] + segment["written"] - 1
+        transfer.hasher.finish()
+        self._publish(transfer)
+        self.save_state()
+
+    def save_state(self):
+        if self.downloader.fsync:
+            # The sidecar must not record bytes that are not on the disk yet
+            fsync_path(self.part_path)
+        with self._state_lock:
+            self.downloader._save_part_state(self.state_path, self.state)
+
+    def open_range(self, segment, position, avoid=None):
+        """Request the rest of a segment from `position`, not through proxy `avoid`"""
+        range_end = "" if segment["end"] is None else segment["end"]
+        headers = {"Range": f"bytes={position}-{range_end}"}
+        validator = self.state["etag"] or self.state["last_modified"]
+        if validator:
+            # The server answers with the whole file if it has changed
+            headers["If-Range"] = validator
+        response = self.downloader.safe_request(
+            self.video_url, stream=True, headers=headers, avoid=avoid
+        )
+        content_range = response.headers.get("content-range", "")
+        size = self.state["size"]
+        if (
+            response.status_code != 206
+            or not content_range.startswith(f"bytes {position}-")
+            or (size and not content_range.endswith(f"/{size}"))
+        ):
+            response.close()
+            raise RangeNotSupported(
+                f"Unexpected answer to a range request: {response.status_code}"
+            )
+        return response
+
+    def _transfer(self, transfer, f):
+        """Stream a segment into `f` until it is complete; False if it was cancelled
+
+        When its route ends early, the segment continues through a hedge that
+        caught up, or else through a new range request.
+        """
+        segment = transfer.segment
+        # One buffer per segment is reused for the whole transfer
+        buffer = bytearray(self.downloader.buffer_size)
+        failovers = 0
+        while True:
+            route = transfer.route
+            error = self._stream(transfer, route, f, buffer)
+            if self.cancel.is_set():
+                return False
+
+            with transfer.lock:
+                takeover, transfer.takeover = transfer.takeover, None
+            if takeover is None and error is None and (
+                segment["end"] is None or transfer.position > segment["end"]
+            ):
+                return True
+
+            if takeover is None:
+                error = self._route_failed(transfer, route, error)
+                takeover = self._wait_for_hedge(transfer)
+            if takeover is not None:
+                self._take_over(transfer, f, route, takeover)
+                continue
+
+            failovers += 1
+            if failovers > MAX_FAILOVERS or self.cancel.is_set():
+                raise error
+            self._fail_over(transfer, route, error)
+
+    def _stream(self, transfer, route, f, buffer):
+        """Write what `route` brings until it ends, fails or a hedge overtakes it
+
+        Returns the transport error that ended the route, if any. The route is
+        closed afterwards.
+        """
+        segment = transfer.segment
+        limit = None if segment["end"] is None else segment["end"] - transfer.position + 1
+        try:
+            for chunk in stream_into(route.response, buffer, limit, self.interval):
+                if self.cancel.is_set():
+                    break
+                if transfer.position == 0 and not is_mp4_start(chunk):
+                    # E.g. an HTML error page served with status 200
+                    raise IntegrityError(
+                        f"not an MP4 file, starts with {bytes(chunk[:16])!r}"
+                    )
+                if self.downloader.bandwidth is not None:
+                    self.downloader.bandwidth.consume(len(chunk))
+                with transfer.lock:
+                    if transfer.takeover is not None:
+                        # A hedged request has overtaken this route
+                        break
+                    f.write(chunk)
+                    if self.streaming:
+                        f.flush()
+                    transfer.hasher.update(chunk)
+                    transfer.position += len(chunk)
+                    route.add(len(chunk))
+                self._advance(transfer, f, len(chunk))
+        except requests.exceptions.RequestException as e:
+            return e
+        finally:
+            self._close_route(route)
+        return None
+
+    def _route_failed(self, transfer, route, error):
+        """Account for a route that failed or closed half-way; returns the error
+
+        Raises it right away when the segment has no known end to resume to.
+        """
+        segment = transfer.segment
+        if error is not None:
+            if self.downloader.proxy_pool is not None:
+                self.downloader.proxy_pool.record_failure(route.proxy)
+            self.downloader.metrics.increment("errors", "transfer", self.host)
+        else:
+            error = IOError(
+                f"Connection closed after {transfer.position} of {segment['end'] + 1} bytes"
+            )
+        if segment["end"] is None:
+            raise error
+        return error
+
+    def _wait_for_hedge(self, transfer):
+        """Wait for a running hedge to hand over or end; returns its takeover, if any
+
+        A hedge that is already running catches up with the failed route
+        sooner than a new request.
+        """
+        with transfer.lock:
+            while transfer.hedging and transfer.takeover is None and not self.cancel.is_set():
+                transfer.changed.wait(CHECK_INTERVAL)
+            takeover, transfer.takeover = transfer.takeover, None
+        return takeover
+
+    def _take_over(self, transfer, f, route, takeover):
+        """Continue a segment through the route of a hedge that replaced `route`"""
+        new_route, hasher, ahead = takeover
+        with transfer.lock:
+            # The blocks hashed by the hedge replace those of the old route
+            transfer.route = new_route
+            transfer.hasher = hasher
+            f.seek(transfer.position)
+            f.write(ahead)
+            if self.streaming:
+                f.flush()
+            transfer.position += len(ahead)
+        self._advance(transfer, f, len(ahead))
+        self._record_failover(route)
+        logger.info(
+            f"Hedged request for {self.part_path} took over at byte {transfer.position}"
+        )
+
+    def _fail_over(self, transfer, route, error):
+        """Continue a segment from the same byte through a route other than `route`"""
+        try:
+            response = self.open_range(transfer.segment, transfer.position, avoid=route.proxy)
+        except RangeNotSupported:
+            # Without byte ranges the download can only start over
+            raise error
+        self._record_failover(route)
+        logger.info(
+            f"Transfer of {self.part_path} failed at {transfer.position} ({error}), "
+            "continuing through another route"
+        )
+        with transfer.lock:
+            transfer.route = self._open_route(response)
+
+    def _advance(self, transfer, f, size):
+        """Count `size` bytes written to `f`, saving the sidecar now and then"""
+        if self.downloader.concurrency is not None:
+            self.downloader.concurrency.record_bytes(size)
+        transfer.written += size
+        transfer.unsaved += size
+        if self.streaming:
+            # Already flushed; readers of the file wait for `written`
+            self._publish(transfer)
+        self.progress(size)
+        if transfer.unsaved >= STATE_SAVE_INTERVAL:
+            f.flush()
+            self._publish(transfer)
+            self.save_state()
+            transfer.unsaved = 0
+
+    def _publish(self, transfer):
+        """Record the progress of a segment in the shared state
+
+        Every segment saves the whole sidecar, so the state may only hold what
+        this segment has already flushed to the file, or a kill could leave a
+        sidecar that claims bytes (and block hashes) that were still in
+        another thread's buffer.
+        """
+        segment = transfer.segment
+        with self._state_lock:
+            segment["written"] = transfer.position - segment["start"]
+            segment["hashes"] = list(transfer.hasher.hashes)
+
+    def _end(self, transfer):
+        """Stop the hedge of a segment that ended, and save what it has written"""
+        with transfer.lock:
+            transfer.finished = True
+            hedge_route = transfer.hedge
+            takeover = transfer.takeover
+        if hedge_route is not None:
+            hedge_route.cancelled = True
+            abort(hedge_route.response)
+        if takeover is not None:
+            self._close_route(takeover[0])
+        if self.watchdog is not None:
+            self.watchdog.remove(transfer)
+        # The file is closed (and flushed) here, so every counted byte is on disk
+        self._publish(transfer)
+        self.save_state()
+
+    def _record_metrics(self, transfer, elapsed):
+        metrics = self.downloader.metrics
+        metrics.observe("seconds", elapsed, "transfer", self.host)
+        metrics.increment("bytes", "transfer", self.host, transfer.written)
+        if transfer.written and elapsed > 0:
+            metrics.observe(
+                "bytes_per_second", transfer.written / elapsed, "transfer", self.host
+            )
+
+    def _open_route(self, response):
+        # The proxy stays busy while the body streams through it, so other
+        # workers are routed to other proxies.
+        route = Route(response, getattr(response, "proxy", None), self.downloader.stall_window)
+        if self.downloader.proxy_pool is not None:
+            self.downloader.proxy_pool.hold(route.proxy)
+        return route
+
+    def _close_route(self, route):
+        route.response.close()
+        proxy_pool = self.downloader.proxy_pool
+        if proxy_pool is not None:
+            proxy_pool.release(route.proxy)
+            proxy_pool.record_transfer(route.proxy, route.received, route.elapsed())
+
+    def _record_failover(self, route):
+        self.downloader.metrics.increment("failovers", "transfer", self.host)
+        if self.downloader.proxy_pool is not None:
+            self.downloader.proxy_pool.record_failover(route.proxy)
+
+    def _stalled(self, transfer, route):
+        """Watchdog callback: hedge a transfer whose `route` has stalled"""
+        self.downloader.metrics.increment("stalls", "transfer", self.host)
+        if self.downloader.proxy_pool is not None:
+            self.downloader.proxy_pool.record_stall(route.proxy)
+        via = route.proxy.url if route.proxy is not None else "a direct connection"
+        logger.info(
+            f"Transfer of {self.part_path} through {via} stalled at byte "
+            f"{transfer.position}, hedging it through another route"
+        )
+        threading.Thread(target=self._hedge, args=(transfer, route), daemon=True).start()
+
+    def _cancel_hedge(self, transfer, route):
+        """Watchdog callback: stop a hedge that is no faster than the route it races"""
+        logger.info(f"Hedged request for {self.part_path} is not faster, cancelling it")
+        abort(route.response)
+
+    def _hedge(self, transfer, stalled):
+        """Read the rest of a stalled segment through another route until it catches up
+
+        Nothing is written here: the bytes are only hashed, with a copy of the
+        segment's hasher, and the route is handed over to the thread that
+        fetches the segment once it has reached the same position.
+        """
+        segment = transfer.segment
+        with transfer.lock:
+            position = transfer.position
+            hasher = transfer.hasher.copy()
+        route = None
+        replaced = None
+        try:
+            route = self._open_route(self.open_range(segment, position, avoid=stalled.proxy))
+            with transfer.lock:
+                if transfer.finished:
+                    return
+                transfer.hedge = route
+            limit = None if segment["end"] is None else segment["end"] - position + 1
+            buffer = bytearray(self.downloader.buffer_size)
+            for chunk in stream_into(route.response, buffer, limit, self.interval):
+                if route.cancelled or self.cancel.is_set():
+                    return
+                if position == 0 and not is_mp4_start(chunk):
+                    raise IntegrityError(f"not an MP4 file, starts with {bytes(chunk[:16])!r}")
+                if self.downloader.bandwidth is not None:
+                    self.downloader.bandwidth.consume(len(chunk))
+                hasher.update(chunk)
+                position += len(chunk)
+                with transfer.lock:
+                    route.add(len(chunk))
+                    if transfer.finished:
+                        return
+                    if position >= transfer.position:
+                        # Only the bytes past the stalled route are new
+                        ahead = position - transfer.position
+                        transfer.takeover = (route, hasher, bytes(chunk[len(chunk) - ahead :]))
+                        replaced = transfer.route
+                        return
+        except RangeNotSupported as e:
+            logger.info(f"Cannot hedge {self.part_path}: {e}")
+            with transfer.lock:
+                transfer.hedges = MAX_HEDGES
+        except (requests.exceptions.RequestException, IntegrityError) as e:
+            logger.info(f"Hedged request for {self.part_path} failed: {e}")
+        finally:
+            if route is not None and replaced is None:
+                self._close_route(route)
+            with transfer.lock:
+                transfer.hedge = None
+                transfer.hedging = False
+                transfer.hedge_ended = time.monotonic()
+                transfer.changed.notify_all()
+            if replaced is not None:
+                # Wakes the fetching thread up if it is blocked on a read
+                abort(replaced.response)
@@ -0,0 +1,179 @@
+import collections
+import threading
+import time
+
+from lazy import logger
+
+# Seconds of a transfer its throughput is judged by
+STALL_WINDOW = 15
+# A transfer that moves fewer bytes per second than this over a whole window
+# has stalled
+STALL_RATE = 32 * 1024
+# How often the watchdog looks at the running transfers
+CHECK_INTERVAL = 1
+# Hedged requests started for one segment before it is left to its route
+MAX_HEDGES = 3
+
+
+class ThroughputWindow:
+    """Bytes per second of a transfer over its last `seconds` seconds"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self._samples = collections.deque()
+        self._bytes = 0
+
+    def add(self, size, now=None):
+        now = time.monotonic() if now is None else now
+        self._samples.append((now, size))
+        self._bytes += size
+        self._expire(now)
+
+    def full(self, now=None):
+        """Whether the transfer has run for a whole window"""
+        now = time.monotonic() if now is None else now
+        return now - self.started >= self.seconds
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        elapsed = min(now - self.started, self.seconds)
+        return self._bytes / elapsed if elapsed > 0 else 0.0
+
+    def _expire(self, now):
+        while self._samples and self._samples[0][0] <= now - self.seconds:
+            self._bytes -= self._samples.popleft()[1]
+
+
+class Route:
+    """A streamed response, the proxy it comes through (None when direct) and its throughput"""
+
+    def __init__(self, response, proxy, window=STALL_WINDOW):
+        self.response = response
+        self.proxy = proxy
+        self.window = ThroughputWindow(window)
+        self.received = 0
+        self.cancelled = False
+
+    def add(self, size):
+        self.received += size
+        self.window.add(size)
+
+    def elapsed(self):
+        return time.monotonic() - self.window.started
+
+
+class Transfer:
+    """A segment being streamed into the .part file, shared with its hedged request
+
+    The thread that fetches the segment writes through `route` and advances
+    `position` (the next byte of the file) under `lock`. A hedge reads the
+    rest of the range through another route and hashes it with a copy of
+    `hasher`; once it has caught up with `position` it leaves its route,
+    hasher and the bytes it read past `position` in `takeover`, and the
+    fetching thread continues from them. `changed` is notified whenever a
+    hedge ends or hands over.
+    """
+
+    def __init__(self, segment, route, hasher, position):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.segment = segment
+        self.route = route
+        self.hasher = hasher
+        self.position = position
+        # A hedge has been started and not ended yet; `hedge` is its route
+        # once the request has been answered
+        self.hedging = False
+        self.hedge = None
+        self.hedges = 0
+        self.hedge_ended = None
+        self.takeover = None
+        self.finished = False
+        # Bytes this run has written, and those not in the sidecar yet; only
+        # used by the fetching thread
+        self.written = 0
+        self.unsaved = 0
+
+
+class StallWatchdog:
+    """Hedges transfers whose throughput has dropped below `rate` bytes per second
+
+    Every CHECK_INTERVAL seconds, a transfer whose route has moved less than
+    `rate` bytes per second over the last `window` seconds is passed to
+    `on_stall`, which starts a hedged request for the rest of its range. A
+    hedge that has not caught up after a whole window and is no faster than
+    the route it races is passed to `on_cancel`. A transfer is hedged at most
+    MAX_HEDGES times, and not again within a window of the last hedge.
+    """
+
+    def __init__(self, rate, window, on_stall, on_cancel):
+        self.rate = rate
+        self.window = window
+        self.on_stall = on_stall
+        self.on_cancel = on_cancel
+        self._transfers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, transfer):
+        with self._lock:
+            self._transfers.append(transfer)
+
+    def remove(self, transfer):
+        with self._lock:
+            self._transfers.remove(transfer)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(CHECK_INTERVAL):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Stall check failed: {e}")
+
+    def check(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            transfers = list(self._transfers)
+        for transfer in transfers:
+            stalled = cancelled = None
+            with transfer.lock:
+                if transfer.finished or transfer.takeover is not None:
+                    continue
+                route = transfer.route
+                hedge = transfer.hedge
+                if hedge is not None:
+                    if (
+                        not hedge.cancelled
+                        and hedge.window.full(now)
+                        and hedge.window.rate(now) <= route.window.rate(now)
+                    ):
+                        hedge.cancelled = True
+                        cancelled = hedge
+                elif (
+                    not transfer.hedging
+                    and transfer.hedges < MAX_HEDGES
+                    and (
+                        transfer.hedge_ended is None
+                        or now - transfer.hedge_ended >= self.window
+                    )
+                    and route.window.full(now)
+                    and route.window.rate(now) < self.rate
+                ):
+                    transfer.hedging = True
+                    transfer.hedges += 1
+                    stalled = route
+            if cancelled is not None:
+                self.on_cancel(transfer, cancelled)
+            if stalled is not None:
+                self.on_stall(transfer, stalled)
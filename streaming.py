@@ -0,0 +1,220 @@
+import os
+import re
+import threading
+import time
+
+from lazy import LazyImport, logger
+
+# Only needed when an episode is served over HTTP
+http_server = LazyImport("http.server")
+
+# Amount of data handed to a player at a time
+READ_SIZE = 256 * 1024
+
+
+class GrowingFile:
+    """An episode that can be read while its segments are still downloading
+
+    The downloader attaches the .part file and its resume state, and calls
+    `progress` whenever bytes were written. Readers block until the bytes
+    they ask for have arrived. The file descriptor stays valid when the .part
+    file is renamed into place. `on_first_byte` is called with the seconds
+    from creation to the first bytes handed to a reader.
+    """
+
+    def __init__(self, on_first_byte=None):
+        self.on_first_byte = on_first_byte
+        self.created = time.monotonic()
+        self.first_byte = None
+        self.finished = False
+        self.error = None
+        self._state = None
+        self._fd = None
+        self._cond = threading.Condition()
+
+    def attach(self, path, state):
+        """Read from `path`, whose written ranges are described by `state`"""
+        fd = os.open(path, os.O_RDONLY)
+        with self._cond:
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = fd
+            self._state = state
+            self._cond.notify_all()
+
+    def attach_complete(self, path):
+        """Read from a file that is already downloaded"""
+        size = os.path.getsize(path)
+        segment = {"start": 0, "end": size - 1, "written": size}
+        self.attach(path, {"size": size, "segments": [segment]})
+        self.finish()
+
+    def progress(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        """No more bytes will arrive; `error` tells readers why if it failed"""
+        with self._cond:
+            self.finished = True
+            self.error = error
+            self._cond.notify_all()
+
+    def size(self, timeout=None):
+        """Total size once known (None if the server did not send one)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._state is not None or self.finished, timeout)
+            if self._state is None:
+                return None
+            return self._state["size"] or None
+
+    def _available(self, offset):
+        for segment in self._state["segments"]:
+            end = segment["end"]
+            if segment["start"] <= offset and (end is None or offset <= end):
+                return max(0, segment["start"] + segment["written"] - offset)
+        return 0
+
+    def read(self, offset, size=READ_SIZE):
+        """Up to `size` bytes at `offset`, waiting for them; b"" at the end
+
+        Raises IOError if the download failed before the bytes arrived.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.finished
+                or (self._state is not None and self._available(offset) > 0)
+            )
+            available = self._available(offset) if self._state is not None else 0
+            if not available:
+                if self.error:
+                    raise IOError(self.error)
+                return b""
+            data = os.pread(self._fd, min(size, available), offset)
+            if self.first_byte is None and data:
+                self.first_byte = time.monotonic() - self.created
+                if self.on_first_byte is not None:
+                    self.on_first_byte(self.first_byte)
+        return data
+
+    def close(self):
+        with self._cond:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def pipe(growing, sink):
+    """Write an episode to `sink` (stdout or a named pipe) in order as it arrives
+
+    Returns the number of bytes written; a reader that goes away (e.g. the
+    player was closed) ends the stream but not the download.
+    """
+    position = 0
+    try:
+        while True:
+            data = growing.read(position)
+            if not data:
+                break
+            sink.write(data)
+            sink.flush()
+            position += len(data)
+    except BrokenPipeError:
+        logger.info("The player closed the stream, the download continues")
+    except IOError as e:
+        logger.error(f"Stream ended early: {e}")
+    return position
+
+
+class StreamServer:
+    """Serves a GrowingFile over HTTP with Range support, for video players
+
+    Requests for bytes that have not arrived yet wait for them, so a player
+    can open the URL right away and seek within what is downloaded.
+    """
+
+    def __init__(self, growing, port=0, name="episode.mp4"):
+        self.growing = growing
+        self.name = name
+        self._httpd = http_server.ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self._httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/{self.name}"
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _handler(server):
+    class Handler(http_server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.respond(head=True)
+
+        def do_GET(self):
+            self.respond()
+
+        def respond(self, head=False):
+            growing = server.growing
+            size = growing.size()
+            start, end = 0, size - 1 if size else None
+            match = re.match(r"^bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+            partial = bool(size and match and (match.group(1) or match.group(2)))
+            if partial:
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or size - 1), size - 1)
+                else:
+                    # A suffix range: the last N bytes
+                    start = max(0, size - int(match.group(2)))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+            self.send_response(206 if partial else 200)
+            self.send_header("Content-Type", "video/mp4")
+            if size:
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end - start + 1))
+            else:
+                # Unknown size: the body ends when the connection is closed
+                self.close_connection = True
+            if partial:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if head:
+                return
+
+            position = start
+            try:
+                while end is None or position <= end:
+                    limit = READ_SIZE if end is None else min(READ_SIZE, end - position + 1)
+                    data = growing.read(position, limit)
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    position += len(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # Players drop connections all the time when seeking
+                pass
+            except IOError as e:
+                logger.error(f"Stream ended early: {e}")
+            if end is not None and position <= end:
+                self.close_connection = True
+
+    return Handler